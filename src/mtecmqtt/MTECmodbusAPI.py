@@ -3,20 +3,91 @@
 Modbus API for M-TEC Energybutler
 (c) 2023 by Christian Rödel 
 """
-from datetime import datetime, timedelta
-from mtecmqtt.config import cfg, register_map
+from collections import OrderedDict, ChainMap
+from mtecmqtt.config import cfg, register_map, register_table, register_groups, get_cache_file
+from mtecmqtt import metrics
 from pymodbus.client import ModbusTcpClient
 from pymodbus.constants import Endian
+import json
 import logging
+import math
+import os
+import struct
+import threading
+import time
+
+# String templates for the decoded values of BYTE and BIT registers (per register length) and DAT registers
+# Unsupported lengths decode to None (see _formatter) 
+_BYTE_FORMATS = { 
+  1: "{:02d} {:02d}", 
+  2: "{:02d} {:02d}  {:02d} {:02d}", 
+  4: "{:02d} {:02d} {:02d} {:02d}  {:02d} {:02d} {:02d} {:02d}" 
+}
+_BIT_FORMATS = { 
+  1: "{:08b}", 
+  2: "{:08b} {:08b}" 
+}
+_DAT_FORMAT = "{:02d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}"
+
+# Encoding of writable register types
+_WRITE_FORMATS = { "U16": ">H", "I16": ">h", "U32": ">I", "I32": ">i" }
+
+# Weight of a new request in the moving averages of latency and error rate
+_REQUEST_STATS_WEIGHT = 0.2
+
+#-------------------------------------------------
+# Ports which worked last per Modbus server - kept in the cache directory, so that they are tried first after a restart 
+def _load_known_ports():
+  try:
+    with open(get_cache_file("ports.json"), "r") as f:
+      return json.load(f)
+  except Exception:
+    return {}
+
+def _save_known_port( ip_addr, port ):
+  fname = get_cache_file("ports.json")
+  try: # write to temp file and rename, as several processes might share the file
+    ports = _load_known_ports()
+    if ports.get(ip_addr) == port:
+      return
+    ports[ip_addr] = port
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    fname_tmp = "{}.{}".format(fname, os.getpid())
+    with open(fname_tmp, "w") as f:
+      json.dump(ports, f)
+    os.replace(fname_tmp, fname)
+  except Exception as err:
+    logging.debug("Couldn't write {}: {}".format(fname, str(err)))
+
+def _formatter( template ):
+  if template is None: # unsupported length
+    return lambda values: None
+  return lambda values: template.format(*values)
 
 #=====================================================
 class MTECmodbusAPI:
   #-------------------------------------------------
-  def __init__( self ):
+  # inverter: Optional dict of connection settings (MODBUS_IP, MODBUS_PORT, MODBUS_SLAVE, ...) 
+  # which override the global config for this instance
+  def __init__( self, inverter=None ):
+    self.cfg = ChainMap(inverter or {}, cfg)
+    self.name = self.cfg.get("NAME") or self.cfg["MODBUS_IP"]
     self.modbus_client = None
-    self.last_reconnect = None
-    self._cluster_cache = {}
-    self.slave = cfg['MODBUS_SLAVE']
+    self.port = None             # port which worked last
+    self._reconnecting = False   # background reconnect in progress
+    self._reconnect_lock = threading.Lock()
+    self._stop = threading.Event() # set by disconnect(): stops the background reconnect
+    self._last_success = time.monotonic() # time of the last successful request
+    self._cluster_cache = OrderedDict() # LRU cache: frozenset of addresses -> cluster list
+    self._cluster_cache_size = self.cfg.get("MODBUS_CLUSTER_CACHE_SIZE", 32)
+    self._failures = {}   # address -> consecutive failed reads
+    self._quarantine = {} # address -> time (monotonic clock) when the register gets probed again
+    self.connection_error = False # last read failed because of the connection (not because of the registers)
+    self._latency = None    # moving average of the request latency (s)
+    self._error_rate = 0.0  # moving average of the share of requests failed because of the connection
+    self._requests = 0
+    self.slave = self.cfg['MODBUS_SLAVE']
+    self._warm_cluster_cache()
     logging.debug("API initialized")
 
   def __del__(self):
@@ -24,18 +95,33 @@ class MTECmodbusAPI:
 
   #-------------------------------------------------
   # Connect to Modbus server
+  # Tries MODBUS_PORT and MODBUS_PORT2 (defaults to 502) - the port which worked last first
   def connect(self):
-    # try with configured port
-    connected = self._connect(ip_addr=cfg['MODBUS_IP'], port=cfg['MODBUS_PORT'], framer=cfg.get("MODBUS_FRAMER", "rtu"),
-                               timeout=cfg["MODBUS_TIMEOUT"], retries=cfg["MODBUS_RETRIES"])
-    if not connected:
-      # try alternative port (defaults to 502)
-      connected = self._connect(ip_addr=cfg['MODBUS_IP'], port=cfg.get('MODBUS_PORT2',"502"), framer=cfg.get("MODBUS_FRAMER", "rtu"),
-                               timeout=cfg["MODBUS_TIMEOUT"], retries=cfg["MODBUS_RETRIES"])
-      if not connected:    
-        logging.fatal( "Can't connect to MODBUS server: {}".format(cfg['MODBUS_IP']) )
-
-    return connected      
+    self._stop.clear()
+    return self._open()
+
+  def _open( self ):
+    for port in self._get_ports():
+      if self._connect(ip_addr=self.cfg['MODBUS_IP'], port=port, framer=self.cfg.get("MODBUS_FRAMER", "rtu"),
+                       timeout=self.cfg["MODBUS_TIMEOUT"], retries=self.cfg["MODBUS_RETRIES"]):
+        self._connected(port)
+        return True
+    logging.error( "Can't connect to MODBUS server: {}".format(self.cfg['MODBUS_IP']) )
+    return False
+
+  def _get_ports( self ):
+    ports = [ int(self.cfg['MODBUS_PORT']), int(self.cfg.get('MODBUS_PORT2', 502)) ]
+    last_port = self.port or _load_known_ports().get(self.cfg['MODBUS_IP'])
+    if last_port in ports:
+      ports.insert(0, ports.pop(ports.index(last_port)))
+    return list(dict.fromkeys(ports))
+
+  def _connected( self, port ):
+    if port != self.port:
+      self.port = port
+      _save_known_port(self.cfg['MODBUS_IP'], port)
+    self._last_success = time.monotonic()
+    metrics.set_gauge("mtec_modbus_connected", 1, inverter=self.name)
 
   #-------------------------------------------------
   def _connect(self, ip_addr, port, framer, timeout, retries):
@@ -51,30 +137,87 @@ class MTECmodbusAPI:
       return False
 
   #-------------------------------------------------
-  # Disconnect from Modbus server
+  # Disconnect from Modbus server - and stop a background reconnect
   def disconnect( self ):
-    if self.modbus_client: 
+    self._stop.set()
+    self._close()
+
+  def _close( self ):
+    if self.modbus_client:
       logging.info("Disconnecting from Modbus server")
       try:
         if self.modbus_client.is_socket_open():
           self.modbus_client.close()
       except Exception as ex:
-        logging.debug("Exception while diconnecting: {}".format(ex))  
+        logging.debug("Exception while diconnecting: {}".format(ex))
       self.modbus_client = None
       logging.debug("Successfully disconnected from Modbus server")
 
+  # Connection is usable (not lost or re-connecting)
+  def is_connected( self ):
+    return self.modbus_client is not None and not self._reconnecting
+
   #-------------------------------------------------
-  # restart Modbus server connection
+  # restart Modbus server connection in a background thread, retrying with exponential backoff
+  # Reads fail fast in the meantime, so that the polling loop doesn't stall
   def reconnect(self):
-    now = datetime.now()
-    if not self.last_reconnect or now > self.last_reconnect+timedelta(seconds=30): 
-      logging.info("Trying to re-connect to Modbus server")
-      self.last_reconnect = now
-      self.disconnect()
-      if self.connect():
-        logging.info("Successfully re-connected to Modbus server")
-      else:
-        logging.error("Couldn't re-connect to Modbus server")
+    with self._reconnect_lock:
+      if self._reconnecting or self._stop.is_set():
+        return
+      self._reconnecting = True
+    metrics.set_gauge("mtec_modbus_connected", 0, inverter=self.name)
+    threading.Thread(target=self._reconnect_loop, daemon=True).start()
+
+  def _reconnect_loop(self):
+    delay = self.cfg.get("MODBUS_RECONNECT_DELAY", 5)
+    try:
+      while not self._stop.is_set():
+        logging.info("Trying to re-connect to Modbus server {}".format(self.name))
+        metrics.inc("mtec_modbus_reconnects_total", inverter=self.name)
+        self._close()
+        if self._open():
+          logging.info("Successfully re-connected to Modbus server {}".format(self.name))
+          break
+        logging.error("Couldn't re-connect to Modbus server {} - retrying in {}s".format(self.name, delay))
+        self._stop.wait(delay)
+        delay = self._next_reconnect_delay(delay)
+      if self._stop.is_set(): # disconnected in the meantime
+        self._close()
+    finally:
+      self._reconnecting = False
+
+  def _next_reconnect_delay( self, delay ):
+    return min( 2*delay, self.cfg.get("MODBUS_RECONNECT_MAX_DELAY", 300) )
+
+  #-------------------------------------------------
+  # Health check: Probe the connection with a single register read, if there was no successful request
+  # for MODBUS_PROBE_INTERVAL seconds - so that a half-open connection gets detected (and re-connected)
+  # before the next group is due. Returns False if the connection is down.
+  def check_connection( self ):
+    if not self._probe_due():
+      return self.is_connected()
+    logging.debug("Probing connection to Modbus server {}".format(self.name))
+    if not self.modbus_client.is_socket_open():
+      self.reconnect()
+      return False
+    self._read_registers( *self._probe_register() )
+    return not self.connection_error # an error response is fine, as the server answered
+
+  def _probe_due( self ):
+    interval = self.cfg.get("MODBUS_PROBE_INTERVAL", 60)
+    return bool(interval) and self.is_connected() and time.monotonic() - self._last_success >= interval
+
+  # (address, length) of the register used for health checks
+  def _probe_register( self ):
+    item = next(iter(register_table.values()))
+    return item["address"], item["length"]
+
+  # Time (s) until the next health check is due (infinite if disabled or not connected)
+  def get_probe_time( self ):
+    interval = self.cfg.get("MODBUS_PROBE_INTERVAL", 60)
+    if not interval or not self.is_connected():
+      return math.inf
+    return max(0, self._last_success + interval - time.monotonic())
 
 #--------------------------------
   # Get a list of all registers which belong to a given group
@@ -95,42 +238,97 @@ class MTECmodbusAPI:
     data = {}
     logging.debug("Retrieving data...")
 
-    if registers == None: # Create liset of all (numeric) registers
-      registers = []
-      for register in register_map:
-        if register.isnumeric(): # non-numeric registers are deemed to be calculated pseudo-registers
-          registers.append(register)
+    if registers == None: # Create list of all (numeric) registers
+      registers = list(register_table)
 
     cluster_list = self._get_register_clusters(registers)
     for reg_cluster in cluster_list:
-      offset = 0
-      logging.debug("Fetching data for cluster start {}, length {}, items {}".format(reg_cluster["start"], reg_cluster["length"], len(reg_cluster["items"])))
-      rawdata = self._read_registers(reg_cluster["start"], reg_cluster["length"])
-      if rawdata:
-        for item in reg_cluster["items"]:
-          if item.get("type"): # type==None means dummy
-            data_decoded = self._decode_rawdata(rawdata, offset, item)
-            if data_decoded:
-              register = str(reg_cluster["start"] + offset)
-              data.update( {register: data_decoded} )
-            else:
-              logging.error("Decoding error while decoding register {}".format(register))
-          offset += item["length"]
+      data.update( self._read_cluster(reg_cluster) )
 
     logging.debug("Data retrieval completed")
     return data
 
+  # Read and decode a cluster. A failing cluster gets retried with backoff and then split, 
+  # in order to isolate the bad registers. Registers which keep failing get quarantined.
+  def _read_cluster( self, cluster ):
+    if "split" in cluster: # cluster is known to fail as a whole
+      data = {}
+      for part in cluster["split"]:
+        data.update( self._read_cluster(part) )
+      self._split_read(cluster, data)
+      return data
+
+    for delay in self._retry_delays():
+      time.sleep(delay)
+      data = self._cluster_read(cluster, self._read_registers(cluster["start"], cluster["length"]))
+      if data is not None:
+        return data
+    return self._read_cluster(cluster) if self._cluster_exhausted(cluster) else {}
+
   #--------------------------------
-  # Write a value to a register
-  def write_register(self, register, value):
+  # Write a value to a register - 32 bit values are written to both Modbus registers at once
+  # verify: Read the register back and check that it holds the new value
+  def write_register(self, register, value, verify=False):
+    address, words = self._begin_write(register, value)
+    if address is None:
+      return False
+    try:
+      result = self._write_request(address, words)
+    except Exception as ex:
+      return self._write_failed(register, ex)
+    if result.isError():
+      return self._write_failed(register)
+    if verify:
+      return self._verify_write(register, words, self.read_modbus_data(registers=[str(register)]))
+    return True
+
+  # Write helpers shared by the sync and the asyncio version of write_register()
+  # Check and encode a value to be written; returns (address, list of 16 bit words) or (None, None) if it can't be written
+  def _begin_write(self, register, value):
+    address, words = self._prepare_write(register, value)
+    if address is not None and not self.is_connected():
+      logging.error("Can't write register {}: Not connected to Modbus server".format(register))
+      metrics.inc("mtec_modbus_write_errors_total", inverter=self.name)
+      return None, None
+    return address, words
+
+  # Modbus request for a write: FC6 for a single register, FC16 for several (awaitable for the asyncio client)
+  def _write_request(self, address, words):
+    if len(words) == 1:
+      return self.modbus_client.write_register(address=address, value=words[0], slave=self.slave )
+    return self.modbus_client.write_registers(address=address, values=words, slave=self.slave )
+
+  def _write_failed(self, register, ex=None):
+    if ex:
+      logging.error("Exception while writing register {} to pymodbus: {}".format(register, ex))
+    else:
+      logging.error("Error while writing register {} to pymodbus".format(register))
+    metrics.inc("mtec_modbus_write_errors_total", inverter=self.name)
+    return False
+
+  # Check that the data read back after a write hold the written words
+  def _verify_write(self, register, words, data):
+    value = data.get(str(register), {}).get("value")
+    if value is None or self._prepare_write(register, value)[1] != words:
+      logging.error("Verification of register {} failed: Read back {}".format(register, value))
+      metrics.inc("mtec_write_verify_failures_total", inverter=self.name)
+      return False
+    return True
+
+  # Check whether a value can be written to a register (without writing it)
+  def validate_write(self, register, value):
+    return self._prepare_write(register, value)[0] is not None
+
+  # Check, scale and encode a value to be written; returns (address, list of 16 bit words) or (None, None)   
+  def _prepare_write(self, register, value):
     # Lookup register
     item = register_map.get(str(register), None)
     if not item:
       logging.error("Can't write unknown register: {}".format(register))
-      return False
+      return None, None
     elif item.get("writable", False) == False:
       logging.error("Can't write register which is marked read-only: {}".format(register))
-      return False
+      return None, None
 
     # check value
     try:
@@ -141,143 +339,342 @@ class MTECmodbusAPI:
           value = int(value)  
     except Exception as ex:
       logging.error("Invalid numeric value: {}".format(value))
-      return False
+      return None, None
 
     # adjust scale 
     if item["scale"] > 1:
         value *= item["scale"]
 
+    # encode
     try:
-      result = self.modbus_client.write_register(address=int(register), value=int(value), slave=self.slave )
-    except Exception as ex:
-      logging.error("Exception while writing register {} to pymodbus: {}".format(register, ex))
-      return False
-
-    if result.isError():
-      logging.error("Error while writing register {} to pymodbus".format(register))
-      return False
-    return True
+      raw = struct.pack(_WRITE_FORMATS[item["type"]], int(round(value)))
+    except KeyError:
+      logging.error("Can't write register of type {}: {}".format(item["type"], register))
+      return None, None
+    except struct.error:
+      logging.error("Value out of range for register {}: {}".format(register, value))
+      return None, None
+    return item["address"], list(struct.unpack(">{}H".format(len(raw)//2), raw))
 
   #--------------------------------
-  # Cluster registers in order to optimize modbus traffic    
+  # Cluster registers in order to optimize modbus traffic
+  # 'registers' may contain register names (str) or addresses (int); pseudo-registers are ignored    
   def _get_register_clusters( self, registers ):
     # Cache clusters to avoid unnecessary overhead
-    idx = str(registers) # use stringified version of list as index
-    if idx not in self._cluster_cache:
-      self._cluster_cache[idx] = self._create_register_clusters(registers)
-    return self._cluster_cache[idx]
+    idx = self._resolve_registers(registers) # canonical, order-independent index
+    if self._quarantine:
+      idx = idx.difference( self._get_quarantined() )
+    cluster_list = self._cluster_cache.get(idx)
+    if cluster_list is None:
+      metrics.inc("mtec_cluster_cache_misses_total", inverter=self.name)
+      cluster_list = self._cluster_cache_put(idx)
+    else:
+      metrics.inc("mtec_cluster_cache_hits_total", inverter=self.name)
+      self._cluster_cache.move_to_end(idx)
+    return cluster_list
+
+  def _cluster_cache_put( self, idx ):
+    cluster_list = self._create_register_clusters(idx)
+    self._cluster_cache[idx] = cluster_list
+    while len(self._cluster_cache) > self._cluster_cache_size: # evict least recently used
+      self._cluster_cache.popitem(last=False)
+    return cluster_list
+
+  # Pre-calculate the cluster plans of all register groups and of the full register set
+  def _warm_cluster_cache( self ):
+    self._cluster_cache_put( self._resolve_registers(register_table) )
+    for group in register_groups:
+      registers = [ register for register, item in register_map.items() if item["group"] == group ]
+      self._cluster_cache_put( self._resolve_registers(registers) )
+
+  #--------------------------------
+  # Failure handling of clusters - shared by the sync and the asyncio version of _read_cluster() 
+  # Delays (s) before the attempts to read a cluster: none before the first one, a growing backoff before the retries
+  def _retry_delays( self ):
+    yield 0
+    for attempt in range( 1, self.cfg.get("MODBUS_CLUSTER_RETRIES", 1) + 1 ):
+      metrics.inc("mtec_modbus_retries_total", inverter=self.name)
+      yield self.cfg.get("MODBUS_RETRY_BACKOFF", 0.2) * 2**(attempt-1)
+
+  # Outcome of an attempt to read a cluster: the decoded data, {} if the connection is down (neither retrying 
+  # nor splitting helps), or None if the attempt failed and should be retried 
+  def _cluster_read( self, cluster, rawdata ):
+    logging.debug("Fetched data for cluster start {}, length {}, items {}".format(cluster["start"], cluster["length"], len(cluster["items"])))
+    if rawdata:
+      self._cluster_succeeded(cluster)
+      return self._decode_cluster(rawdata, cluster)
+    if self.connection_error:
+      return {}
+    return None
+
+  # All attempts to read a cluster failed: split it, or count the failure if it can't be split. 
+  # Returns True if the cluster was split and should be read again.
+  def _cluster_exhausted( self, cluster ):
+    if self._split_cluster(cluster):
+      return True
+    self._cluster_failed(cluster)
+    return False
+
+  # Split a failed cluster into two clusters - at its largest bridged gap (which might be unreadable), 
+  # or else in the middle. The split is kept in the cluster plan, until the parts were read successfully 
+  # MODBUS_SPLIT_CYCLES times in a row. Returns False if the cluster holds a single register. 
+  def _split_cluster( self, cluster ):
+    regs = [ (item["address"], item) for item in cluster["items"] if item["type"] is not None ]
+    if len(regs) < 2:
+      return False
+    gaps = [ (regs[i][0] - regs[i-1][0] - regs[i-1][1]["length"], i) for i in range(1, len(regs)) ]
+    gap, idx = max(gaps)
+    if gap <= 0:
+      idx = len(regs) // 2
+    cluster["split"] = [ self._build_cluster(regs[:idx]), self._build_cluster(regs[idx:]) ]
+    cluster["split_cycles"] = self.cfg.get("MODBUS_SPLIT_CYCLES", 10)
+    metrics.inc("mtec_cluster_splits_total", inverter=self.name)
+    logging.info("Split failing cluster start {}, length {} at register {}".format(cluster["start"], cluster["length"], regs[idx][0]))
+    return True
+
+  # Count the successful reads of a split cluster - and merge it back, as soon as the parts 
+  # delivered all registers MODBUS_SPLIT_CYCLES times in a row (the failure might have been temporary)
+  def _split_read( self, cluster, data ):
+    if self.connection_error:
+      return
+    if any( item["register"] not in data for item in cluster["items"] if item["type"] is not None ):
+      cluster["split_cycles"] = self.cfg.get("MODBUS_SPLIT_CYCLES", 10)
+      return
+    cluster["split_cycles"] -= 1
+    if cluster["split_cycles"] <= 0:
+      del cluster["split"], cluster["split_cycles"]
+      logging.info("Merged split cluster start {}, length {}".format(cluster["start"], cluster["length"]))
+
+  def _cluster_succeeded( self, cluster ):
+    if self._failures:
+      for item in cluster["items"]:
+        self._failures.pop(item.get("address"), None)
+
+  # Count the failure of a single register cluster and quarantine the register if it keeps failing 
+  def _cluster_failed( self, cluster ):
+    for item in cluster["items"]:
+      if item["type"] is None:
+        continue
+      address = item["address"]
+      self._failures[address] = self._failures.get(address, 0) + 1
+      if self._failures[address] >= self.cfg.get("MODBUS_QUARANTINE_FAILURES", 3):
+        quarantine_time = self.cfg.get("MODBUS_QUARANTINE_TIME", 600)
+        self._quarantine[address] = time.monotonic() + quarantine_time
+        logging.warning("Register {} ({}) failed {} times - excluded from reads for {}s".format(address, item["name"], self._failures[address], quarantine_time))
+        del self._failures[address]
+    metrics.set_gauge("mtec_quarantined_registers", len(self._quarantine), inverter=self.name)
+
+  # Addresses in quarantine. Registers whose quarantine expired are probed again - a single failure quarantines them again.
+  def _get_quarantined( self ):
+    now = time.monotonic()
+    for address, until in list(self._quarantine.items()):
+      if until <= now:
+        logging.info("Register {} released from quarantine".format(address))
+        del self._quarantine[address]
+        self._failures[address] = self.cfg.get("MODBUS_QUARANTINE_FAILURES", 3) - 1
+        metrics.set_gauge("mtec_quarantined_registers", len(self._quarantine), inverter=self.name)
+    return self._quarantine.keys()
+
+  # Addresses of the registers in quarantine
+  def get_quarantined_registers( self ):
+    return sorted(self._quarantine)
+
+  # Map register names (str) or addresses (int) to a frozenset of Modbus addresses; pseudo-registers are ignored
+  def _resolve_registers( self, registers ):
+    addresses = set()
+    for register in registers:
+      item = register_table.get(register) if isinstance(register, int) else register_map.get(register)
+      if item:
+        if item["address"] is not None:
+          addresses.add(item["address"])
+        else: # pseudo-register: read the Modbus registers it is calculated from
+          addresses.update( register_map[source]["address"] for source in item.get("sources", []) )
+      else:
+        logging.warning("Unknown register: {} - skipped.".format(register))
+    return frozenset(addresses)
 
   # Create clusters     
-  def _create_register_clusters( self, registers ):
+  # Registers are partitioned into clusters (=one Modbus request each) with minimal total cost.
+  # Small gaps between registers get bridged by dummy reads, if this is cheaper than an extra request.
+  # Cost model: MODBUS_CLUSTER_REQUEST_COST per request + MODBUS_CLUSTER_REGISTER_COST per register read
+  def _create_register_clusters( self, addresses ):
+    request_cost = self.cfg.get("MODBUS_CLUSTER_REQUEST_COST", 20)
+    register_cost = self.cfg.get("MODBUS_CLUSTER_REGISTER_COST", 1)
+    max_length = self.cfg.get("MODBUS_MAX_REGISTERS", 125) # Modbus limit per request
+    regs = [ (address, register_table[address]) for address in sorted(addresses) ] # list of (address, item), sorted by address
+
+    # Dynamic programming: cost[j] = minimal cost to read regs[0..j-1]; split[j] = start index of last cluster 
+    n = len(regs)
+    cost = [0] + [None]*n
+    split = [0]*(n+1)
+    for j in range(1, n+1):
+      end = 0
+      for i in range(j, 0, -1):
+        end = max(end, regs[i-1][0] + regs[i-1][1]["length"])
+        length = end - regs[i-1][0]
+        if length > max_length and i < j: # a single oversized register still gets its own cluster
+          break
+        c = cost[i-1] + request_cost + length*register_cost
+        if cost[j] is None or c < cost[j]:
+          cost[j] = c
+          split[j] = i-1
+
+    # Build cluster list 
+    cluster_list = []
+    j = n
+    while j > 0:
+      i = split[j]
+      cluster_list.insert(0, self._build_cluster(regs[i:j]))
+      j = i
+
+    return cluster_list
+
+  # Build a cluster from a list of (address, item), bridging gaps with dummy items (type==None)  
+  def _build_cluster( self, regs ):
     cluster = { 
-      "start": 0,     
+      "start": regs[0][0],     
       "length": 0,
       "items": []   
     }
-    cluster_list = []
-    
-    for register in sorted(registers):
-      if register.isnumeric(): # ignore non-numeric pseudo registers
-        item = register_map.get(register)
-        if item:
-          if int(register) > cluster["start"] + cluster["length"]: # there is a gap 
-            if cluster["start"] > 0: # except for first cluster 
-              cluster_list.append(cluster)
-            cluster = { 
-              "start": int(register),     
-              "length": 0,
-              "items": []   
-            }
-          cluster["length"] += item["length"]  
-          cluster["items"].append(item)
-        else:
-          logging.warning("Unknown register: {} - skipped.".format(register))
+    for address, item in regs:
+      gap = address - (cluster["start"] + cluster["length"])
+      if gap > 0:
+        cluster["items"].append( { "length": gap, "type": None } ) 
+        cluster["length"] += gap
+      elif gap < 0:
+        logging.warning("Overlapping register: {} - skipped.".format(address))
+        continue
+      cluster["length"] += item["length"]  
+      cluster["items"].append(item)
+    cluster["decoder"] = self._compile_decoder(cluster)
+    return cluster
 
-    if cluster["start"] > 0: # append last cluster
-      cluster_list.append(cluster)
-
-    return cluster_list
+  #--------------------------------
+  # Precompile the decode plan of a cluster: one struct format over the raw register bytes
+  # plus a list of (register, item, number of unpacked values, converter)
+  def _compile_decoder( self, cluster ):
+    fmt = ">"
+    plan = []
+    for item in cluster["items"]:
+      length = item["length"]
+      item_type = item.get("type")
+      if item_type in ("U16", "I16", "U32", "I32"):
+        fmt += { "U16":"H", "I16":"h", "U32":"I", "I32":"i" }[item_type]
+        if length > (1 if item_type[1:]=="16" else 2):
+          fmt += "{}x".format(2*length - struct.calcsize(">"+fmt[-1]))
+        plan.append( (item["register"], item, 1, None) )
+      elif item_type == "STR":
+        fmt += "{}s".format(2*length)
+        plan.append( (item["register"], item, 1, lambda values: values[0].rstrip(b"\x00").decode("utf-8")) )
+      elif item_type == "BYTE":
+        fmt += "{}B".format(2*length)
+        plan.append( (item["register"], item, 2*length, _formatter(_BYTE_FORMATS.get(length))) )
+      elif item_type == "BIT":
+        fmt += "{}H".format(length)
+        plan.append( (item["register"], item, length, _formatter(_BIT_FORMATS.get(length))) )
+      elif item_type == "DAT":
+        fmt += "{}B".format(2*length)
+        plan.append( (item["register"], item, 2*length, _formatter(_DAT_FORMAT)) )
+      else: 
+        if item_type: # type==None means dummy
+          logging.error("Unknown type {} to decode".format(item_type))
+        fmt += "{}x".format(2*length)
+    return { "raw": struct.Struct(">{}H".format(cluster["length"])), "values": struct.Struct(fmt), "plan": plan }
   
   #--------------------------------
   # Do the actual reading from modbus
   def _read_registers(self, register, length):
+    if not self._begin_read():
+      return None
+    start = time.perf_counter()
     try:
       result = self.modbus_client.read_holding_registers(address=int(register), count=length, slave=self.slave)
     except Exception as ex:
-      logging.error("Exception while reading register {}, length {} from pymodbus: {}".format(register, length, ex))
+      return self._read_failed(register, length, start, ex)
+    return self._read_done(result, register, length, start)
+
+  # Read helpers shared by the sync and the asyncio version of _read_registers()
+  # Returns False if the request must not be sent, as the connection is down (fail fast)
+  def _begin_read(self):
+    self.connection_error = not self.is_connected()
+    if self.connection_error:
+      if not self._reconnecting: # the outage was already counted - don't let skipped requests drive the error rate
+        self._record_request(0)
       self.reconnect()
-      return None
+      return False
+    return True
+
+  # The request raised an exception: the connection is considered lost
+  def _read_failed(self, register, length, start, ex):
+    logging.error("Exception while reading register {}, length {} from pymodbus: {}".format(register, length, ex))
+    metrics.inc("mtec_modbus_errors_total", cluster=register, inverter=self.name)
+    self.connection_error = True
+    self._record_request(time.perf_counter() - start)
+    self.reconnect()
+    return None
+
+  def _read_done(self, result, register, length, start):
+    self._record_request(time.perf_counter() - start)
+    metrics.observe("mtec_modbus_request_seconds", time.perf_counter() - start, cluster=register, inverter=self.name)
+    return self._check_read_result(result, register, length)
+
+  # Track latency and connection errors of the Modbus requests as exponentially weighted moving averages
+  def _record_request(self, seconds):
+    self._requests += 1
+    self._error_rate += _REQUEST_STATS_WEIGHT * ( (1 if self.connection_error else 0) - self._error_rate )
+    if not self.connection_error:
+      self._last_success = time.monotonic()
+      self._latency = seconds if self._latency is None else self._latency + _REQUEST_STATS_WEIGHT * (seconds - self._latency)
+
+  # Returns (average latency (s) or None, average error rate, number of requests)
+  def get_request_stats( self ):
+    return self._latency, self._error_rate, self._requests
+
+  def _check_read_result(self, result, register, length):
     if result.isError():
       logging.error("Error while reading register {}, length {} from pymodbus".format(register, length))
+      metrics.inc("mtec_modbus_errors_total", cluster=register, inverter=self.name)
       return None
     if len(result.registers) != length:
       logging.error("Error while reading register {} from pymodbus: Requested length {}, received {}".format(register, length, len(result.registers)))
+      metrics.inc("mtec_modbus_errors_total", cluster=register, inverter=self.name)
       return None
     return result
 
   #--------------------------------
-  # Decode the result from rawdata, starting at offset
-  def _decode_rawdata(self, rawdata, offset, item):
+  # Decode all registers of a cluster from rawdata in one pass, using the precompiled decoder
+  def _decode_cluster(self, rawdata, cluster):
+    start = time.perf_counter()
+    data = {}
+    decoder = cluster["decoder"]
     try:
-      val = None
-      if item["type"] == 'U16':
-        reg = rawdata.registers[offset:offset+1]
-        val = self.modbus_client.convert_from_registers(registers=reg, data_type=self.modbus_client.DATATYPE.UINT16)
-      elif item["type"] == 'I16':
-        reg = rawdata.registers[offset:offset+1]
-        val = self.modbus_client.convert_from_registers(registers=reg, data_type=self.modbus_client.DATATYPE.INT16)
-      elif item["type"] == 'U32':
-        reg = rawdata.registers[offset:offset+2]
-        val = self.modbus_client.convert_from_registers(registers=reg, data_type=self.modbus_client.DATATYPE.UINT32)
-      elif item["type"] == 'I32':
-        reg = rawdata.registers[offset:offset+2]
-        val = self.modbus_client.convert_from_registers(registers=reg, data_type=self.modbus_client.DATATYPE.INT32)
-      elif item["type"] == 'BYTE':
-        if item["length"] == 1:
-          reg1 = int(rawdata.registers[offset])
-          val = "{:02d} {:02d}".format( reg1>>8, reg1&0xff )
-        elif item["length"] == 2:
-          reg1 = int(rawdata.registers[offset])
-          reg2 = int(rawdata.registers[offset+1])
-          val = "{:02d} {:02d}  {:02d} {:02d}".format( reg1>>8, reg1&0xff, reg2>>8, reg2&0xff )
-        elif item["length"] == 4:
-          reg1 = int(rawdata.registers[offset])
-          reg2 = int(rawdata.registers[offset+1])
-          reg3 = int(rawdata.registers[offset+2])
-          reg4 = int(rawdata.registers[offset+3])
-          val = "{:02d} {:02d} {:02d} {:02d}  {:02d} {:02d} {:02d} {:02d}".format( reg1>>8, reg1&0xff, reg2>>8, reg2&0xff, reg3>>8, reg3&0xff, reg4>>8, reg4&0xff )
-      elif item["type"] == 'BIT':
-        if item["length"] == 1:
-          reg1 = int(rawdata.registers[offset])
-          val = "{:08b}".format( reg1 )
-        if item["length"] == 2:
-          reg1 = int(rawdata.registers[offset])
-          reg2 = int(rawdata.registers[offset+1])
-          val = "{:08b} {:08b}".format( reg1, reg2 )
-      elif item["type"] == 'DAT':
-          reg1 = int(rawdata.registers[offset])
-          reg2 = int(rawdata.registers[offset+1])
-          reg3 = int(rawdata.registers[offset+2])
-          val = "{:02d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}".format( reg1>>8, reg1&0xff, reg2>>8, reg2&0xff, reg3>>8, reg3&0xff ) 
-      elif item["type"] == 'STR':
-        reg = rawdata.registers[offset:offset+item["length"]*2+1]
-        val = self.modbus_client.convert_from_registers(registers=reg, data_type=self.modbus_client.DATATYPE.STRING)
-      else:
-        logging.error("Unknown type {} to decode".format(item["type"]))
-        return None
-      
-      if val and item["scale"] > 1:
-        val /= item["scale"]
-      data = { "name":item["name"], "value":val, "unit":item["unit"] } 
-      return data
+      values = decoder["values"].unpack( decoder["raw"].pack(*rawdata.registers) )
     except Exception as ex:
       logging.error("Exception while decoding data: {}".format(ex))
-      return None
+      metrics.inc("mtec_decode_errors_total", len(decoder["plan"]))
+      return data
+
+    idx = 0
+    for register, item, count, convert in decoder["plan"]:
+      try:
+        if convert:
+          val = convert(values[idx:idx+count])
+        else:
+          val = values[idx]
+        if val and item["scale"] > 1:
+          val /= item["scale"]
+        data[register] = { "name":item["name"], "value":val, "unit":item["unit"] } 
+      except Exception as ex:
+        logging.error("Decoding error while decoding register {}: {}".format(register, ex))
+        metrics.inc("mtec_decode_errors_total")
+      idx += count
+    metrics.observe("mtec_decode_seconds", time.perf_counter() - start)
+    return data
 
 #--------------------------------
 # The main() function is just a demo code how to use the API
 def main():
-  logging.basicConfig()
+  logging.basicConfig( level=logging.INFO, format="[%(levelname)s] %(filename)s: %(message)s" )
   if cfg['DEBUG'] == True:
     logging.getLogger().setLevel(logging.DEBUG)
 
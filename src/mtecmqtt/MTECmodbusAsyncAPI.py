@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Asyncio based Modbus API for M-TEC Energybutler
+(c) 2024 by Christian Rödel 
+"""
+from mtecmqtt.config import cfg, register_table
+from mtecmqtt.MTECmodbusAPI import MTECmodbusAPI
+from mtecmqtt import metrics
+from pymodbus.client import AsyncModbusTcpClient
+import asyncio
+import logging
+import time
+
+#=====================================================
+# Same interface as MTECmodbusAPI, but all Modbus I/O methods are coroutines.
+# Cluster planning and decoding are inherited from MTECmodbusAPI.
+class MTECmodbusAsyncAPI(MTECmodbusAPI):
+  def __init__( self, inverter=None ):
+    self._reconnect_task = None
+    super().__init__(inverter)
+
+  #-------------------------------------------------
+  # Connect to Modbus server - the port which worked last first
+  async def connect(self):
+    self._stop.clear()
+    return await self._open()
+
+  async def _open( self ):
+    for port in self._get_ports():
+      if await self._connect(ip_addr=self.cfg['MODBUS_IP'], port=port, framer=self.cfg.get("MODBUS_FRAMER", "rtu"),
+                             timeout=self.cfg["MODBUS_TIMEOUT"], retries=self.cfg["MODBUS_RETRIES"]):
+        self._connected(port)
+        return True
+    logging.error( "Can't connect to MODBUS server: {}".format(self.cfg['MODBUS_IP']) )
+    return False
+
+  #-------------------------------------------------
+  async def _connect(self, ip_addr, port, framer, timeout, retries):
+    logging.debug("Connecting to server {}:{} (framer={})".format(ip_addr, port, framer))
+    self.modbus_client = AsyncModbusTcpClient(ip_addr, port=int(port), framer=framer, timeout=timeout, retries=retries, reconnect_delay=0)
+
+    if await self.modbus_client.connect():
+      logging.info("Successfully connected to server {}:{}".format(ip_addr, port))
+      return True
+    else:
+      logging.error("Couldn't connect to server {}:{}".format(ip_addr, port))
+      self.modbus_client.close()
+      self.modbus_client = None
+      return False
+
+  #-------------------------------------------------
+  # Disconnect from Modbus server - and cancel a background reconnect
+  def disconnect( self ):
+    self._stop.set()
+    if self._reconnect_task and not self._reconnect_task.done():
+      self._reconnect_task.cancel()
+    self._reconnect_task = None
+    self._close()
+
+  def _close( self ):
+    if self.modbus_client: 
+      logging.info("Disconnecting from Modbus server")
+      try:
+        self.modbus_client.close()
+      except Exception as ex:
+        logging.debug("Exception while diconnecting: {}".format(ex))  
+      self.modbus_client = None
+      logging.debug("Successfully disconnected from Modbus server")
+
+  #-------------------------------------------------
+  # restart Modbus server connection in a background task, retrying with exponential backoff
+  # Reads fail fast in the meantime, so that the polling loop doesn't stall
+  def reconnect(self):
+    if self._reconnecting or self._stop.is_set():
+      return
+    self._reconnecting = True
+    metrics.set_gauge("mtec_modbus_connected", 0, inverter=self.name)
+    self._reconnect_task = asyncio.ensure_future( self._reconnect_loop() )
+
+  async def _reconnect_loop(self):
+    delay = self.cfg.get("MODBUS_RECONNECT_DELAY", 5)
+    try:
+      while True:
+        logging.info("Trying to re-connect to Modbus server {}".format(self.name))
+        metrics.inc("mtec_modbus_reconnects_total", inverter=self.name)
+        self._close()
+        if await self._open():
+          break
+        logging.error("Couldn't re-connect to Modbus server {} - retrying in {}s".format(self.name, delay))
+        await asyncio.sleep(delay)
+        delay = self._next_reconnect_delay(delay)
+      logging.info("Successfully re-connected to Modbus server {}".format(self.name))
+    finally:
+      self._reconnecting = False
+
+  #-------------------------------------------------
+  # Health check (see MTECmodbusAPI.check_connection)
+  async def check_connection( self ):
+    if not self._probe_due():
+      return self.is_connected()
+    logging.debug("Probing connection to Modbus server {}".format(self.name))
+    if not self.modbus_client.connected:
+      self.reconnect()
+      return False
+    await self._read_registers( *self._probe_register() )
+    return not self.connection_error # an error response is fine, as the server answered 
+
+  #--------------------------------
+  # This is the main API function. It either fetches all registers or a list of given registers
+  async def read_modbus_data(self, registers=None):
+    data = {}
+    logging.debug("Retrieving data...")
+
+    if registers == None: # Create list of all (numeric) registers
+      registers = list(register_table)
+
+    cluster_list = self._get_register_clusters(registers)
+    for reg_cluster in cluster_list:
+      data.update( await self._read_cluster(reg_cluster) )
+
+    logging.debug("Data retrieval completed")
+    return data
+
+  # Read and decode a cluster, with retries, splitting and quarantine (see MTECmodbusAPI._read_cluster)
+  async def _read_cluster( self, cluster ):
+    if "split" in cluster: # cluster is known to fail as a whole
+      data = {}
+      for part in cluster["split"]:
+        data.update( await self._read_cluster(part) )
+      self._split_read(cluster, data)
+      return data
+
+    for delay in self._retry_delays():
+      await asyncio.sleep(delay)
+      data = self._cluster_read(cluster, await self._read_registers(cluster["start"], cluster["length"]))
+      if data is not None:
+        return data
+    return await self._read_cluster(cluster) if self._cluster_exhausted(cluster) else {}
+
+  #--------------------------------
+  # Write a value to a register (see MTECmodbusAPI.write_register)
+  async def write_register(self, register, value, verify=False):
+    address, words = self._begin_write(register, value)
+    if address is None:
+      return False
+    try:
+      result = await self._write_request(address, words)
+    except Exception as ex:
+      return self._write_failed(register, ex)
+    if result.isError():
+      return self._write_failed(register)
+    if verify:
+      return self._verify_write(register, words, await self.read_modbus_data(registers=[str(register)]))
+    return True
+
+  #--------------------------------
+  # Do the actual reading from modbus
+  async def _read_registers(self, register, length):
+    if not self._begin_read():
+      return None
+    start = time.perf_counter()
+    try:
+      result = await self.modbus_client.read_holding_registers(address=int(register), count=length, slave=self.slave)
+    except Exception as ex:
+      return self._read_failed(register, length, start, ex)
+    return self._read_done(result, register, length, start)
+
+#--------------------------------
+# The main() function is just a demo code how to use the API
+async def _demo():
+  api = MTECmodbusAsyncAPI()
+  await api.connect()
+
+  # fetch all available data
+  logging.info("Fetching all data")
+  data = await api.read_modbus_data()
+  for param, val in data.items():
+    logging.info("- {} : {}".format(param, val))
+
+  api.disconnect()
+
+def main():
+  logging.basicConfig( level=logging.INFO, format="[%(levelname)s] %(filename)s: %(message)s" )
+  if cfg['DEBUG'] == True:
+    logging.getLogger().setLevel(logging.DEBUG)
+  asyncio.run(_demo())
+
+#--------------------------------------------      
+if __name__ == '__main__':
+  main()
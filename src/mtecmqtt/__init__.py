@@ -1,3 +1,3 @@
 # MTECmqtt
-__all__ = ["config", "mqtt", "hass_int", "MTECmodbusAPI"] 
+__all__ = ["config", "mqtt", "hass_int", "MTECmodbusAPI", "MTECmodbusAsyncAPI", "scheduler", "metrics", "buffer", "expressions", "commands"] 
 __version__ = "2.1.0"
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Store-and-forward buffer for samples which couldn't be published to MQTT
+(c) 2024 by Christian Rödel
+"""
+from mtecmqtt.config import cfg
+from mtecmqtt.mqtt import mqtt_publish, mqtt_is_connected
+from mtecmqtt import metrics
+from datetime import datetime
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+#=====================================================
+# SQLite backed ring buffer of (timestamp, topic, payload), bounded by number of entries and age.
+# A background drainer replays the buffered samples at a limited rate once the broker is back.
+class PublishBuffer:
+  #-------------------------------------------------
+  # path: SQLite file, max_entries: oldest entries are dropped beyond this, max_age: entries older than this (s) are dropped
+  def __init__( self, path, max_entries=1000000, max_age=7*24*3600 ):
+    self.path = path
+    self.max_entries = max_entries
+    self.max_age = max_age
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, check_same_thread=False)
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.execute("PRAGMA synchronous=NORMAL")
+    self._db.execute("CREATE TABLE IF NOT EXISTS samples (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp REAL, topic TEXT, payload TEXT)")
+    self._db.commit()
+    self.entries = self._db.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+    metrics.set_gauge("mtec_buffer_entries", self.entries)
+    if self.entries:
+      logging.info("Publish buffer {} contains {} samples to replay".format(path, self.entries))
+
+  def close( self ):
+    with self._lock:
+      self._db.close()
+
+  #-------------------------------------------------
+  # Store a list of (topic, payload) with the current time
+  def add( self, samples ):
+    if not samples:
+      return
+    now = time.time()
+    with self._lock:
+      self._db.executemany("INSERT INTO samples (timestamp, topic, payload) VALUES (?, ?, ?)", [ (now, topic, str(payload)) for topic, payload in samples ])
+      self.entries += len(samples)
+      if self.entries > self.max_entries:
+        self._delete("id IN (SELECT id FROM samples ORDER BY id LIMIT ?)", self.entries - self.max_entries)
+      self._db.commit()
+    metrics.set_gauge("mtec_buffer_entries", self.entries)
+    logging.debug("Buffered {} samples".format(len(samples)))
+
+  # Drop entries which exceed max_age
+  def expire( self ):
+    with self._lock:
+      self._delete("timestamp < ?", time.time() - self.max_age)
+      self._db.commit()
+    metrics.set_gauge("mtec_buffer_entries", self.entries)
+
+  def _delete( self, condition, param ): # call with _lock held
+    dropped = self._db.execute("DELETE FROM samples WHERE " + condition, (param,)).rowcount
+    if dropped:
+      self.entries -= dropped
+      metrics.inc("mtec_buffer_dropped_total", dropped)
+      logging.warning("Publish buffer: Dropped {} samples (limit exceeded)".format(dropped))
+
+  #-------------------------------------------------
+  # Replay up to 'count' of the oldest samples. Returns the number of replayed samples.
+  # A sample is only deleted if the broker is still connected after publishing it - it might be replayed twice, but doesn't get lost.
+  def replay( self, count ):
+    with self._lock:
+      rows = self._db.execute("SELECT id, timestamp, topic, payload FROM samples ORDER BY id LIMIT ?", (count,)).fetchall()
+    replayed = []
+    for row_id, timestamp, topic, payload in rows:
+      if not mqtt_publish( self._replay_topic(topic), self._replay_payload(timestamp, payload) ) or not mqtt_is_connected():
+        break
+      replayed.append( (row_id,) )
+    if replayed:
+      with self._lock:
+        self._db.executemany("DELETE FROM samples WHERE id = ?", replayed)
+        self._db.commit()
+        self.entries -= len(replayed)
+      metrics.inc("mtec_buffer_replayed_total", len(replayed))
+      metrics.set_gauge("mtec_buffer_entries", self.entries)
+    return len(replayed)
+
+  # Samples are replayed below <MQTT_TOPIC>/<MQTT_BUFFER_REPLAY_TOPIC>/..., so that they don't overwrite the current values
+  def _replay_topic( self, topic ):
+    base = cfg['MQTT_TOPIC'] + '/'
+    if topic.startswith(base):
+      topic = topic[len(base):]
+    return base + cfg.get("MQTT_BUFFER_REPLAY_TOPIC", "replay") + '/' + topic
+
+  # JSON documents already carry their timestamp - single values get wrapped: { "timestamp": ..., "value": ... }
+  def _replay_payload( self, timestamp, payload ):
+    if payload.startswith('{"timestamp"'):
+      return payload
+    return json.dumps( { "timestamp": datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S"), "value": payload }, separators=(',', ':') )
+
+  #-------------------------------------------------
+  # Replay buffered samples with max. 'rate' messages/s within a background thread, while the broker is reachable
+  def start_drainer( self, rate ):
+    def drain():
+      last_expire = 0
+      while True:
+        if time.monotonic() - last_expire > 60:
+          self.expire()
+          last_expire = time.monotonic()
+        if self.entries and mqtt_is_connected():
+          try:
+            if self.replay( max(1, int(rate)) ):
+              logging.debug("Publish buffer: Replayed samples, {} left".format(self.entries))
+              if not self.entries:
+                logging.info("Publish buffer: All buffered samples replayed")
+          except Exception as e:
+            logging.error("Error while replaying buffered samples: {}".format(str(e)))
+        time.sleep(1)
+    threading.Thread(target=drain, daemon=True).start()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Columnar export formats for register traces: NumPy .npy (no dependencies) and Parquet (requires pyarrow)
+(c) 2024 by Christian Rödel
+"""
+from mtecmqtt.config import register_map
+import math
+import os
+import struct
+
+try:
+  import pyarrow
+  import pyarrow.parquet
+  PARQUET_SUPPORT = True
+except ImportError:
+  PARQUET_SUPPORT = False
+
+# Max. width (bytes) of the formatted value of non-numeric registers per register length 
+# BYTE: up to 3 digits per byte plus separators, BIT: up to 16 digits per register plus separator, DAT: up to 3 digits per field  
+_STR_WIDTH = { "STR": lambda length: 2*length, "BYTE": lambda length: 8*length, "BIT": lambda length: 17*length, "DAT": lambda length: 23 }
+
+#-------------------------------------------------
+# Column type of a register: ("float", 4|8) for numeric registers, ("str", width) for all others
+# Numeric values are stored as float, so that registers which couldn't be read can be represented as NaN
+def column_type( register ):
+  item = register_map[register]
+  if item["type"] in ("U16", "I16"):
+    return ("float", 4)
+  if item["type"] in ("U32", "I32"):
+    return ("float", 8)
+  width = _STR_WIDTH.get(item["type"], lambda length: 2*length)(item["length"] or 1)
+  return ("str", width)
+
+#=====================================================
+# NumPy .npy file of a structured array: timestamp (float64, s since epoch) plus one column per register.
+# Rows are written in batches, the row count in the header gets updated after every batch,
+# so that the file is valid at any time. Load with: numpy.load(filename)
+class NpyWriter:
+  #-------------------------------------------------
+  def __init__( self, filename, columns, batch_size=1000 ):
+    self.columns = columns
+    self.batch_size = batch_size
+    self.rows = 0
+    self.batch = []
+    descr = [ ("timestamp", "<f8") ]
+    fmt = "<d"
+    self.converters = []
+    for column in columns:
+      kind, width = column_type(column)
+      if kind == "float":
+        descr.append( (column, "<f{}".format(width)) )
+        fmt += "f" if width == 4 else "d"
+        self.converters.append( self._float )
+      else:
+        descr.append( (column, "|S{}".format(width)) )
+        fmt += "{}s".format(width)
+        self.converters.append( self._str )
+    self.descr = descr
+    self.row_struct = struct.Struct(fmt)
+    self.header_size = (len(self._header(10**19)) + 63) // 64 * 64 # reserve space for the max. row count, aligned to 64 bytes
+    self.f = open(filename, "wb")
+    self.f.write( self._header(0, self.header_size) )
+
+  # .npy header: magic, version 1.0, header length, header dict (padded with spaces to 'size' bytes in total)
+  def _header( self, rows, size=0 ):
+    text = "{{'descr': {}, 'fortran_order': False, 'shape': ({},), }}".format( repr(self.descr), rows )
+    text = text.ljust( size - 10 - 1 ) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(text)) + text.encode("latin1")
+
+  @staticmethod
+  def _float( value ):
+    return float(value) if isinstance(value, (int, float)) else math.nan
+
+  @staticmethod
+  def _str( value ):
+    return b"" if value is None else str(value).encode("utf-8")
+
+  #-------------------------------------------------
+  # Add a row from a sample: (timestamp, decoded Modbus data)
+  def write( self, sample ):
+    timestamp, data = sample
+    values = [ data[column]["value"] if column in data else None for column in self.columns ]
+    self.batch.append( self.row_struct.pack( timestamp.timestamp(), *[ convert(value) for convert, value in zip(self.converters, values) ] ) )
+    if len(self.batch) >= self.batch_size:
+      self.flush()
+
+  def flush( self ):
+    if not self.batch:
+      return
+    self.f.seek(0, os.SEEK_END)
+    self.f.write( b"".join(self.batch) )
+    self.rows += len(self.batch)
+    self.batch = []
+    self.f.seek(0)
+    self.f.write( self._header(self.rows, self.header_size) )
+    self.f.flush()
+
+  def size( self ):
+    return self.header_size + (self.rows + len(self.batch)) * self.row_struct.size
+
+  def close( self ):
+    self.flush()
+    self.f.close()
+
+#=====================================================
+# Parquet file with one row group per batch: timestamp plus one typed column per register (missing values are null)
+class ParquetWriter:
+  #-------------------------------------------------
+  def __init__( self, filename, columns, batch_size=1000 ):
+    if not PARQUET_SUPPORT:
+      raise RuntimeError("Parquet export requires pyarrow")
+    self.filename = filename
+    self.columns = columns
+    self.batch_size = batch_size
+    fields = [ pyarrow.field("timestamp", pyarrow.timestamp("ms")) ]
+    self.numeric = set()
+    for column in columns:
+      kind, width = column_type(column)
+      if kind == "float":
+        fields.append( pyarrow.field(column, pyarrow.float32() if width == 4 else pyarrow.float64()) )
+        self.numeric.add(column)
+      else:
+        fields.append( pyarrow.field(column, pyarrow.string()) )
+    self.schema = pyarrow.schema(fields)
+    self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema, compression="zstd")
+    self._new_batch()
+
+  def _new_batch( self ):
+    self.batch = { field.name: [] for field in self.schema }
+    self.batch_rows = 0
+
+  #-------------------------------------------------
+  # Add a row from a sample: (timestamp, decoded Modbus data)
+  def write( self, sample ):
+    timestamp, data = sample
+    self.batch["timestamp"].append( timestamp )
+    for column in self.columns:
+      value = data[column]["value"] if column in data else None
+      if column in self.numeric:
+        value = value if isinstance(value, (int, float)) else None
+      elif value is not None:
+        value = str(value)
+      self.batch[column].append( value )
+    self.batch_rows += 1
+    if self.batch_rows >= self.batch_size:
+      self.flush()
+
+  def flush( self ):
+    if not self.batch_rows:
+      return
+    self.writer.write_table( pyarrow.Table.from_pydict(self.batch, schema=self.schema) )
+    self._new_batch()
+
+  def size( self ):
+    return os.path.getsize(self.filename)
+
+  def close( self ):
+    self.flush()
+    self.writer.close()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Queue of register writes, requested via MQTT
+(c) 2024 by Christian Rödel
+"""
+from mtecmqtt import metrics
+from collections import OrderedDict
+import asyncio
+import threading
+
+#=====================================================
+# Pending register writes of an inverter. Writes are queued by the MQTT network thread and executed by the polling loop.
+# Repeated writes to a register which is still pending get coalesced: the write keeps its position, the last value wins.
+class WriteQueue:
+  #-------------------------------------------------
+  # api: MTECmodbusAPI / MTECmodbusAsyncAPI instance of the inverter (used to validate the values)
+  def __init__( self, api ):
+    self.api = api
+    self._pending = OrderedDict() # register -> value
+    self._lock = threading.Lock()
+    self._event = threading.Event()
+    self._async_event = None
+    self._loop = None
+
+  #-------------------------------------------------
+  # Queue a write. Returns False if the value is invalid for the register.
+  def put( self, register, value ):
+    if not self.api.validate_write(register, value):
+      metrics.inc("mtec_commands_rejected_total", inverter=self.api.name)
+      return False
+    with self._lock:
+      if register in self._pending:
+        metrics.inc("mtec_commands_coalesced_total", inverter=self.api.name)
+      self._pending[register] = value
+      metrics.set_gauge("mtec_command_queue_depth", len(self._pending), inverter=self.api.name)
+    self._event.set()
+    if self._loop:
+      self._loop.call_soon_threadsafe(self._async_event.set)
+    return True
+
+  # Remove and return up to max_count writes as list of (register, value), oldest first
+  def get_batch( self, max_count ):
+    with self._lock:
+      batch = []
+      while self._pending and len(batch) < max_count:
+        batch.append( self._pending.popitem(last=False) )
+      metrics.set_gauge("mtec_command_queue_depth", len(self._pending), inverter=self.api.name)
+    return batch
+
+  #-------------------------------------------------
+  # Sleep for max. timeout (s) - return early as soon as a write is queued
+  def wait( self, timeout ):
+    if not self._pending:
+      self._event.wait(timeout)
+    self._event.clear()
+
+  # Same as wait() for the asyncio engine
+  async def wait_async( self, timeout ):
+    if self._loop is None:
+      self._async_event = asyncio.Event()
+      self._loop = asyncio.get_running_loop()
+    if not self._pending:
+      try:
+        await asyncio.wait_for(self._async_event.wait(), timeout)
+      except asyncio.TimeoutError:
+        pass
+    self._async_event.clear()
@@ -1,12 +1,24 @@
 """ 
 Read YAML config files
+cfg and the register map get loaded lazily on first access. The validated register map is cached (pickled) 
+in the user's cache directory, so that it doesn't need to be parsed from registers.yaml on every start.
 (c) 2024 by Christian Rödel 
 """
+from collections.abc import MutableMapping, MutableSequence
 import yaml
 import os
 import sys
 import logging
+import pickle
 import socket
+from mtecmqtt import expressions
+
+REGISTER_CACHE_VERSION = 2 # increment if the structure of the register map changes
+
+try: # use the (much faster) libyaml based loader if available
+  YamlLoader = yaml.CSafeLoader
+except AttributeError:
+  YamlLoader = yaml.SafeLoader
 
 #----------------------------------------
 # Create new config file
@@ -74,7 +86,7 @@ def init_config():
   for fname_conf in conf_files:
     try:
       with open(fname_conf, 'r', encoding='utf-8') as f_conf:
-        cfg = yaml.safe_load(f_conf)
+        cfg = yaml.load(f_conf, Loader=YamlLoader)
         logging.info("Using config YAML file: {}".format(fname_conf) )      
         break
     except IOError as err:
@@ -84,14 +96,71 @@ def init_config():
 
   return cfg  
 
+# Read the config - or create a new config.yaml (interactively) if none was found
+def load_config():
+  cfg = init_config()
+  if not cfg:
+    logging.info("No config.yaml found - creating new one from template.")
+    if create_config_file():  # Create a new config
+      cfg = init_config()
+      if not cfg:
+        logging.fatal("Couldn't open fresh created config YAML file")
+        sys.exit(1)
+      else:
+        logging.warning("Please edit and adapt freshly created config.yaml. Restart afterwards.")
+        sys.exit(0)      
+    else:
+      logging.fatal("Couldn't create config YAML file from templare")
+      sys.exit(1)
+  return cfg
+
 #----------------------------------------
+# Path of a file in the user's cache directory
+def get_cache_file( fname ):
+  cache_path = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser("~"), ".cache")
+  return os.path.join(cache_path, "mtecmqtt", fname)
+
+# Read inverter registers and their mapping - from the cache if it is up to date, else from YAML file
+def load_register_map():
+  BASE_DIR = os.path.dirname(__file__) # Base installation directory
+  fname_regs = os.path.join(BASE_DIR, "registers.yaml")
+  fname_cache = get_cache_file("registers.pickle")
+  try: # the cache is valid for this registers.yaml and config.py / expressions.py version only
+    key = [ REGISTER_CACHE_VERSION ]
+    for fname in (fname_regs, __file__, expressions.__file__):
+      stat = os.stat(fname)
+      key += [ fname, stat.st_mtime_ns, stat.st_size ]
+  except OSError:
+    key = None
+
+  if key:
+    try:
+      with open(fname_cache, 'rb') as f_cache:
+        cache = pickle.load(f_cache)
+      if cache["key"] == key:
+        return cache["registers"]
+    except Exception as err:
+      logging.debug("Couldn't use register cache {}: {}".format(fname_cache, str(err)))
+
+  registers = init_register_map()
+  if key:
+    try: # write to temp file and rename, so that concurrently starting processes don't read a partial file
+      os.makedirs(os.path.dirname(fname_cache), exist_ok=True)
+      fname_tmp = "{}.{}".format(fname_cache, os.getpid())
+      with open(fname_tmp, 'wb') as f_cache:
+        pickle.dump( { "key": key, "registers": registers }, f_cache, protocol=pickle.HIGHEST_PROTOCOL )
+      os.replace(fname_tmp, fname_cache)
+    except Exception as err:
+      logging.debug("Couldn't write register cache {}: {}".format(fname_cache, str(err)))
+  return registers
+
 # Read inverter registers and their mapping from YAML file
 def init_register_map():
   BASE_DIR = os.path.dirname(__file__) # Base installation directory
   try:
     fname_regs = os.path.join(BASE_DIR, "registers.yaml")
     with open(fname_regs, 'r', encoding='utf-8') as f_regs:
-      r_map = yaml.safe_load(f_regs)
+      r_map = yaml.load(f_regs, Loader=YamlLoader)
   except IOError as err:
     logging.fatal("Couldn't open registers YAML file: {}".format(str(err)))
     sys.exit(1)
@@ -113,6 +182,9 @@ def init_register_map():
     [ "writable", False ],
     [ "mqtt", None ],
     [ "group", None ],
+    [ "deadband", None ],
+    [ "deadband_percent", None ],
+    [ "expression", None ],
   ] 
   register_groups = []
 
@@ -131,35 +203,138 @@ def init_register_map():
       for p in p_optional:  
         if not item.get(p[0]):
           item[p[0]] = p[1]
+      item["register"] = key
+      item["address"] = int(key) if key.isnumeric() else None # non-numeric registers are deemed to be calculated pseudo-registers
       register_map[key] = item # Append to register_map
       if item["group"] and item["group"] not in register_groups:
         register_groups.append(item["group"]) # Append to group list
-  return register_map, register_groups
+
+  # Precompiled lookup tables: Modbus registers keyed and sorted by integer address, and pseudo-registers 
+  register_table = { item["address"]: item for item in sorted( (i for i in register_map.values() if i["address"] is not None), key=lambda i: i["address"]) }
+  pseudo_registers = init_pseudo_registers( register_map )
+  return register_map, register_groups, register_table, pseudo_registers
+
+# Validate the expressions of the calculated pseudo-registers and resolve their dependencies.
+# Adds "depends" (referenced registers) and "sources" (Modbus registers required - directly or via other pseudo-registers).
+# Returns the valid pseudo-registers in evaluation order. Invalid ones get removed from register_map.
+def init_pseudo_registers( register_map ):
+  pending = {}
+  for key, item in list(register_map.items()):
+    if item["address"] is not None:
+      continue
+    try:
+      if not item["expression"]:
+        raise ValueError("Missing expression")
+      item["depends"] = expressions.parse_expression(item["expression"])[1]
+      for dependency in item["depends"]:
+        if dependency not in register_map:
+          raise ValueError("Unknown register {}".format(dependency))
+      pending[key] = item
+    except ValueError as ex:
+      logging.warning("Skipping invalid pseudo-register {}: {}".format(key, str(ex)))
+      del register_map[key]
+
+  # Evaluation order: a pseudo-register follows the pseudo-registers it depends on
+  pseudo_registers = {}
+  while pending:
+    ready = [ key for key, item in pending.items() if all( dep in pseudo_registers or register_map[dep]["address"] is not None for dep in item["depends"] ) ]
+    if not ready: # remaining ones depend on each other or on skipped ones 
+      for key in pending:
+        logging.warning("Skipping invalid pseudo-register {}: Circular or invalid dependency".format(key))
+        del register_map[key]
+      break
+    for key in ready:
+      item = pending.pop(key)
+      item["sources"] = []
+      for dep in item["depends"]:
+        for source in (pseudo_registers[dep]["sources"] if dep in pseudo_registers else [dep]):
+          if source not in item["sources"]:
+            item["sources"].append(source)
+      pseudo_registers[key] = item
+  return pseudo_registers
 
 #----------------------------------------
-logging.basicConfig( level=logging.INFO, format="[%(levelname)s] %(filename)s: %(message)s" )
-cfg = init_config()
-if not cfg:
-  logging.info("No config.yaml found - creating new one from template.")
-  if create_config_file():  # Create a new config
-    cfg = init_config()
-    if not cfg:
-      logging.fatal("Couldn't open fresh created config YAML file")
-      sys.exit(1)
-    else:
-      logging.warning("Please edit and adapt freshly created config.yaml. Restart afterwards.")
-      sys.exit(0)      
-  else:
-    logging.fatal("Couldn't create config YAML file from templare")
-    sys.exit(1)
+# Placeholders for cfg and the register map, which load their content on first access
+class _LazyDict(MutableMapping):
+  def __init__( self, loader ):
+    self._loader = loader
+    self._data = None
+
+  def _get( self ):
+    if self._data is None:
+      self._data = self._loader()
+    return self._data
+
+  def __getitem__( self, key ):
+    return self._get()[key]
+
+  def __setitem__( self, key, value ):
+    self._get()[key] = value
+
+  def __delitem__( self, key ):
+    del self._get()[key]
+
+  def __iter__( self ):
+    return iter(self._get())
+
+  def __len__( self ):
+    return len(self._get())
+
+  def __contains__( self, key ):
+    return key in self._get()
+
+  def get( self, key, default=None ): # shortcut, as it is used frequently
+    return self._get().get(key, default)
+
+  def __repr__( self ):
+    return repr(self._get())
+
+class _LazyList(MutableSequence):
+  def __init__( self, loader ):
+    self._loader = loader
+    self._data = None
+
+  def _get( self ):
+    if self._data is None:
+      self._data = self._loader()
+    return self._data
+
+  def __getitem__( self, idx ):
+    return self._get()[idx]
+
+  def __setitem__( self, idx, value ):
+    self._get()[idx] = value
+
+  def __delitem__( self, idx ):
+    del self._get()[idx]
+
+  def __len__( self ):
+    return len(self._get())
+
+  def insert( self, idx, value ):
+    self._get().insert(idx, value)
+
+  def __repr__( self ):
+    return repr(self._get())
 
+_registers = None
 
+def _get_registers():
+  global _registers
+  if _registers is None:
+    _registers = load_register_map()
+  return _registers
 
-register_map, register_groups = init_register_map()
+cfg = _LazyDict( load_config )
+register_map = _LazyDict( lambda: _get_registers()[0] )
+register_groups = _LazyList( lambda: _get_registers()[1] )
+register_table = _LazyDict( lambda: _get_registers()[2] )
+pseudo_registers = _LazyDict( lambda: _get_registers()[3] )
 
 #--------------------------------------
 # Test code only
 if __name__ == "__main__":
+  logging.basicConfig( level=logging.INFO, format="[%(levelname)s] %(filename)s: %(message)s" )
   logging.info( "Config: {}".format( str(cfg)) )
   logging.info( "Register_map: {}".format( str(register_map)) )
   
\ No newline at end of file
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Expressions of calculated pseudo-registers
+Registers are referenced in braces, e.g. "{11016} - {11000}" or "100 * {31000} / {consumption-day}"
+(c) 2024 by Christian Rödel
+"""
+from datetime import datetime
+import ast
+import re
+
+# Functions which may be used in expressions
+FUNCTIONS = {
+  "abs": abs,
+  "min": min,
+  "max": max,
+  "round": round,
+  "now": lambda: datetime.now().strftime("%Y-%m-%d %H:%M:%S"), # local time of this server
+}
+
+_REFERENCE = re.compile(r"\{([^{}]+)\}")
+_ALLOWED_NODES = (
+  ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp, ast.Call, ast.Name, ast.Load, ast.Constant,
+  ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.USub, ast.UAdd, ast.Not, ast.And, ast.Or,
+  ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+)
+
+#-------------------------------------------------
+# Parse and validate an expression. Returns (source, dependencies): the Python source, in which
+# the register references are replaced by the arguments _0, _1, ..., and the referenced registers (in argument order).
+# Raises ValueError for invalid expressions.
+def parse_expression( expression ):
+  dependencies = []
+  def reference( match ):
+    register = match.group(1).strip()
+    if register not in dependencies:
+      dependencies.append(register)
+    return "_{}".format(dependencies.index(register))
+
+  source = _REFERENCE.sub(reference, str(expression))
+  try:
+    tree = ast.parse(source, mode="eval")
+  except SyntaxError as ex:
+    raise ValueError("Syntax error: {}".format(ex.msg))
+  args = set( "_{}".format(idx) for idx in range(len(dependencies)) )
+  for node in ast.walk(tree):
+    if not isinstance(node, _ALLOWED_NODES):
+      raise ValueError("Unsupported element: {}".format(type(node).__name__))
+    if isinstance(node, ast.Call) and not (isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS):
+      raise ValueError("Unsupported function call")
+    if isinstance(node, ast.Name) and node.id not in args and node.id not in FUNCTIONS:
+      raise ValueError("Unknown name: {} (registers need to be given in braces)".format(node.id))
+  return source, dependencies
+
+# Compile an expression into a function, which takes the values of the dependencies as arguments.
+# Returns (function, dependencies)
+def compile_expression( expression ):
+  source, dependencies = parse_expression(expression)
+  args = ", ".join( "_{}".format(idx) for idx in range(len(dependencies)) )
+  function = eval( "lambda {}: {}".format(args, source), { "__builtins__": {}, **FUNCTIONS } )
+  return function, dependencies
@@ -7,6 +7,7 @@ Auto discovery for home assistant
 from mtecmqtt.config import cfg, register_map
 import logging
 import json
+import re
 from mtecmqtt.mqtt import mqtt_publish
 
 #---------------------------------------------------
@@ -18,7 +19,9 @@ class HassIntegration:
   ]
 
   #-------------------------------------------------
-  def __init__(self):
+  # multi_inverter: Several inverters are registered, so unique ids and device names contain the serial no.
+  def __init__(self, multi_inverter=False):
+    self.multi_inverter = multi_inverter
     self.serial_no = None
     self.is_initialized = False
     self.devices_array=[]
@@ -28,7 +31,7 @@ class HassIntegration:
     self.serial_no = serial_no
     self.device_info = { 
       "identifiers": [ self.serial_no ],
-      "name": "MTEC Energybutler", 
+      "name": "MTEC Energybutler " + self.serial_no if self.multi_inverter else "MTEC Energybutler", 
       "manufacturer": "MTEC", 
       "model": "Energybutler",
       "via_device": "MTECmqtt" 
@@ -57,12 +60,12 @@ class HassIntegration:
     for item in self.buttons:
       data_item = { 
         "name": item[0], 
-        "unique_id": item[1], 
+        "unique_id": self._unique_id(item[1]), 
         "payload_press": item[2],
         "command_topic": "MTEC/" + self.serial_no + "/automations/command",
         "device": self.device_info
       }
-      topic = cfg["HASS_BASE_TOPIC"] + "/button/" + item[1] + "/config"
+      topic = cfg["HASS_BASE_TOPIC"] + "/button/" + self._unique_id(item[1]) + "/config"
       self.devices_array.append( [topic, json.dumps(data_item)] )  
 
   #---------------------------------------------------
@@ -83,41 +86,68 @@ class HassIntegration:
         if component_type == "binary_sensor":
           self._append_binary_sensor(item)   
 
+  #---------------------------------------------------
+  def _unique_id( self, unique_id ):
+    if self.multi_inverter:
+      return unique_id + "_" + self.serial_no
+    return unique_id
+
+  #---------------------------------------------------
+  # In "json" publish mode, the values are read from the group's JSON document
+  def _json_mode( self ):
+    return cfg.get("MQTT_PUBLISH_MODE", "topics") == "json"
+
+  def _state_topic( self, item ):
+    if self._json_mode():
+      return "MTEC/" + self.serial_no + "/" + item["group"]
+    return "MTEC/" + self.serial_no + "/" + item["group"] + "/" + item["mqtt"]
+
+  # Rewrite a template, which refers to the (string) topic payload 'value', to the JSON document 
+  def _value_template( self, item, template=None ):
+    json_value = "(value_json." + item["mqtt"] + " | string)"
+    if template:
+      return re.sub(r"\bvalue\b", json_value, template)
+    return "{{ " + json_value + " }}"
+
   #---------------------------------------------------
   def _append_sensor( self, item ):               
     data_item = { 
       "name": item["name"], 
-      "unique_id": "MTEC_" + item["mqtt"], 
+      "unique_id": self._unique_id("MTEC_" + item["mqtt"]), 
       "unit_of_measurement": item["unit"],
-      "state_topic": "MTEC/" + self.serial_no + "/" + item["group"] + "/" + item["mqtt"],
+      "state_topic": self._state_topic(item),
       "device": self.device_info
     }
     if item.get("hass_device_class"):
       data_item["device_class"] = item["hass_device_class"] 
-    if item.get("hass_value_template"):
+    if self._json_mode():
+      data_item["value_template"] = self._value_template(item, item.get("hass_value_template")) 
+    elif item.get("hass_value_template"):
       data_item["value_template"] = item["hass_value_template"] 
     if item.get("hass_state_class"):
       data_item["state_class"] = item["hass_state_class"] 
 
-    topic = cfg["HASS_BASE_TOPIC"] + "/sensor/" + "MTEC_" + item["mqtt"] + "/config"
+    topic = cfg["HASS_BASE_TOPIC"] + "/sensor/" + self._unique_id("MTEC_" + item["mqtt"]) + "/config"
     self.devices_array.append( [topic, json.dumps(data_item)] )  
 
 #---------------------------------------------------
   def _append_binary_sensor( self, item ):               
     data_item = { 
       "name": item["name"], 
-      "unique_id": "MTEC_" + item["mqtt"], 
-      "state_topic": "MTEC/" + self.serial_no + "/" + item["group"] + "/" + item["mqtt"],
+      "unique_id": self._unique_id("MTEC_" + item["mqtt"]), 
+      "state_topic": self._state_topic(item),
       "device": self.device_info
     }
     if item.get("hass_device_class"):
       data_item["device_class"] = item["hass_device_class"] 
+    if self._json_mode():
+      data_item["value_template"] = self._value_template(item) 
     if item.get("hass_payload_on"):
       data_item["payload_on"] = item["hass_payload_on"] 
     if item.get("hass_payload_off"):
       data_item["payload_off"] = item["hass_payload_off"] 
 
-    topic = cfg["HASS_BASE_TOPIC"] + "/binary_sensor/" + "MTEC_" + item["mqtt"] + "/config"
+    topic = cfg["HASS_BASE_TOPIC"] + "/binary_sensor/" + self._unique_id("MTEC_" + item["mqtt"]) + "/config"
     self.devices_array.append( [topic, json.dumps(data_item)] )  
 
 #---------------------------------------------------
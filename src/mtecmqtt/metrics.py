@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Lightweight metrics (counters, gauges, histograms) with a Prometheus-style HTTP endpoint
+(c) 2024 by Christian Rödel
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bisect
+import logging
+import threading
+import time
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # seconds
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_gauges = {}      # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., count, sum]
+_help = {}        # name -> (type, help text)
+_sources = {}     # source (e.g. worker process) -> snapshot of its metrics
+
+#-------------------------------------------------
+def _key( name, labels ):
+  return (name, tuple(sorted(labels.items())))
+
+def describe( name, metric_type, text ):
+  _help[name] = (metric_type, text)
+
+# Increment a counter
+def inc( name, value=1, **labels ):
+  key = _key(name, labels)
+  with _lock:
+    _counters[key] = _counters.get(key, 0) + value
+
+# Set a gauge
+def set_gauge( name, value, **labels ):
+  with _lock:
+    _gauges[_key(name, labels)] = value
+
+# Add an observation (in seconds) to a histogram
+def observe( name, value, **labels ):
+  key = _key(name, labels)
+  idx = bisect.bisect_left(BUCKETS, value)
+  with _lock:
+    hist = _histograms.get(key)
+    if hist is None:
+      hist = _histograms[key] = [0] * (len(BUCKETS) + 2)
+    hist[idx] += 1 # not cumulative - accumulated in render()
+    hist[-1] += value
+
+# Clear all metrics
+def reset():
+  with _lock:
+    _counters.clear()
+    _gauges.clear()
+    _histograms.clear()
+    _sources.clear()
+
+#-------------------------------------------------
+# Raw copy of the local metrics, e.g. to transfer them to another process
+def get_snapshot():
+  with _lock:
+    return ( dict(_counters), dict(_gauges), { key: list(hist) for key, hist in _histograms.items() } )
+
+# Store the latest snapshot of another source (e.g. a worker process). 
+# The metrics of all sources are added to the local ones when reported.
+def set_source( source, snapshot ):
+  with _lock:
+    _sources[source] = snapshot
+
+# Local metrics plus the metrics of all sources (call with _lock held)
+def _merged():
+  counters, gauges, histograms = dict(_counters), dict(_gauges), { key: list(hist) for key, hist in _histograms.items() }
+  for source_counters, source_gauges, source_histograms in _sources.values():
+    for key, value in source_counters.items():
+      counters[key] = counters.get(key, 0) + value
+    for key, value in source_gauges.items():
+      gauges[key] = gauges.get(key, 0) + value
+    for key, source_hist in source_histograms.items():
+      hist = histograms.setdefault(key, [0] * len(source_hist))
+      for idx, value in enumerate(source_hist):
+        hist[idx] += value
+  return counters, gauges, histograms
+
+#-------------------------------------------------
+# Summary of all metrics as dict (e.g. for MQTT diagnostics)
+# If labels are given (e.g. inverter="..."), only the metrics with these labels are included
+def get_summary( **labels ):
+  summary = {}
+  with _lock:
+    counters, gauges, histograms = _merged()
+  if labels:
+    selected = lambda key: set(labels.items()) <= set(key[1])
+    counters = { key: value for key, value in counters.items() if selected(key) }
+    gauges = { key: value for key, value in gauges.items() if selected(key) }
+    histograms = { key: hist for key, hist in histograms.items() if selected(key) }
+  for (name, labels), value in counters.items():
+    summary[_format_name(name, labels)] = value
+  for (name, labels), value in gauges.items():
+    summary[_format_name(name, labels)] = value
+  for (name, labels), hist in histograms.items():
+    count = sum(hist[:-1])
+    summary[_format_name(name + "_count", labels)] = count
+    summary[_format_name(name + "_avg", labels)] = hist[-1] / count if count else 0
+  return summary
+
+# Render all metrics in Prometheus text format
+def render():
+  lines = []
+  described = set()
+  def header( name, default_type ):
+    if name not in described:
+      described.add(name)
+      metric_type, text = _help.get(name, (default_type, name))
+      lines.append("# HELP {} {}".format(name, text))
+      lines.append("# TYPE {} {}".format(name, metric_type))
+
+  with _lock:
+    counters, gauges, histograms = _merged()
+  for (name, labels), value in sorted(counters.items()):
+    header(name, "counter")
+    lines.append("{} {}".format(_format_name(name, labels), value))
+  for (name, labels), value in sorted(gauges.items()):
+    header(name, "gauge")
+    lines.append("{} {}".format(_format_name(name, labels), value))
+  for (name, labels), hist in sorted(histograms.items()):
+    header(name, "histogram")
+    cumulative = 0
+    for bound, count in zip(BUCKETS + ("+Inf",), hist[:-1]):
+      cumulative += count
+      lines.append("{} {}".format(_format_name(name + "_bucket", labels + (("le", str(bound)),)), cumulative))
+    lines.append("{} {}".format(_format_name(name + "_count", labels), cumulative))
+    lines.append("{} {}".format(_format_name(name + "_sum", labels), hist[-1]))
+  return "\n".join(lines) + "\n"
+
+def _format_name( name, labels ):
+  if not labels:
+    return name
+  return name + "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels) + "}"
+
+#-------------------------------------------------
+class _MetricsHandler(BaseHTTPRequestHandler):
+  def do_GET( self ):
+    if self.path not in ("/", "/metrics"):
+      self.send_error(404)
+      return
+    data = render().encode("utf-8")
+    self.send_response(200)
+    self.send_header("Content-Type", "text/plain; version=0.0.4")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message( self, format, *args ): # don't log each request
+    pass
+
+# Serve the metrics on http://<host>:<port>/metrics within a background thread
+def start_http_server( port, host="127.0.0.1" ):
+  try:
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+  except Exception as e:
+    logging.warning("Couldn't start metrics HTTP server: {}".format(str(e)))
+    return None
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  logging.info("Metrics available on http://{}:{}/metrics".format(host, port))
+  return server
+
+# Send a snapshot of the local metrics to 'queue' every 'interval' seconds within a background thread
+# (counterpart of set_source, e.g. in a worker process)
+def start_push( queue, source, interval ):
+  def push():
+    while True:
+      time.sleep(interval)
+      try:
+        queue.put( (source, get_snapshot()) )
+      except Exception as e:
+        logging.debug("Couldn't push metrics: {}".format(str(e)))
+  threading.Thread(target=push, daemon=True).start()
+
+#-------------------------------------------------
+describe("mtec_modbus_request_seconds", "histogram", "Latency of Modbus read requests per cluster")
+describe("mtec_modbus_errors_total", "counter", "Failed Modbus read requests per cluster")
+describe("mtec_modbus_retries_total", "counter", "Repeated Modbus read requests after a failed cluster read")
+describe("mtec_cluster_splits_total", "counter", "Failing clusters split to isolate bad registers")
+describe("mtec_quarantined_registers", "gauge", "Registers excluded from reads after repeated failures")
+describe("mtec_cluster_cache_hits_total", "counter", "Reads whose cluster plan was found in the cache")
+describe("mtec_cluster_cache_misses_total", "counter", "Reads whose cluster plan had to be calculated")
+describe("mtec_modbus_reconnects_total", "counter", "Reconnects to the Modbus server")
+describe("mtec_modbus_connected", "gauge", "Connection to the Modbus server is up (1) or being re-established (0)")
+describe("mtec_decode_seconds", "histogram", "Time to decode a cluster")
+describe("mtec_decode_errors_total", "counter", "Registers which couldn't be decoded")
+describe("mtec_modbus_write_errors_total", "counter", "Failed register writes")
+describe("mtec_write_verify_failures_total", "counter", "Register writes which couldn't be verified by reading back")
+describe("mtec_command_queue_depth", "gauge", "Register writes waiting to be executed")
+describe("mtec_commands_coalesced_total", "counter", "Commands merged into a pending write of the same register")
+describe("mtec_commands_rejected_total", "counter", "Commands rejected because of an invalid value or read-only register")
+describe("mtec_pseudo_register_seconds", "histogram", "Time to assign a group and calculate its pseudo-registers")
+describe("mtec_incomplete_reads_total", "counter", "Group reads with missing registers (published partially)")
+describe("mtec_shared_register_reads_total", "counter", "Register reads saved by sharing values between groups within a cycle")
+describe("mtec_group_retries_total", "counter", "Group reads re-scheduled after a failure")
+describe("mtec_mqtt_publish_seconds", "histogram", "Time to hand over a message to the MQTT client")
+describe("mtec_mqtt_publish_errors_total", "counter", "Failed MQTT publish calls")
+describe("mtec_publish_queue_depth", "gauge", "Group data waiting to be published (asyncio engine)")
+describe("mtec_inverter_failures_total", "counter", "Inverters whose polling stopped because of an unexpected error (asyncio engine)")
+describe("mtec_poll_rate_factor", "gauge", "Factor applied to the polling intervals by the adaptive polling rate")
+describe("mtec_scheduler_missed_deadlines_total", "counter", "Skipped polling periods per group")
+describe("mtec_worker_restarts_total", "counter", "Restarts of crashed or stopped worker processes (supervisor mode)")
+describe("mtec_buffer_entries", "gauge", "Samples in the publish buffer waiting to be replayed")
+describe("mtec_buffer_replayed_total", "counter", "Buffered samples replayed to MQTT")
+describe("mtec_buffer_dropped_total", "counter", "Buffered samples dropped because of the size or age limit")
@@ -5,6 +5,7 @@ MQTT client base implemantation
 """
 import logging
 from mtecmqtt.config import cfg
+from mtecmqtt import metrics
 import time
 
 try:
@@ -12,15 +13,20 @@ try:
   import paho.mqtt.publish as publish
 except Exception as e:
   logging.warning("MQTT not set up because of: {}".format(e))
+
+_mqtt_client = None # persistent client used for all publishing (set by mqtt_start)
+_subscriptions = {} # topic -> callback( topic, payload ), None for the home assistant status topic 
     
 # ============ MQTT ================
 def on_mqtt_connect(mqttclient, userdata, flags, rc, prop):
   if rc == 0:
     logging.info("Connected to MQTT broker")
+    for topic in _subscriptions: # (re-)subscribe, as subscriptions don't survive a reconnect
+      mqttclient.subscribe(topic, qos=0)
   else:
     logging.error("Error while connecting to MQTT broker: rc={}".format(rc))
 
-def on_mqtt_disconnect(mqttclient, userdata, rc):
+def on_mqtt_disconnect(mqttclient, userdata, flags, rc, prop):
   logging.warning("MQTT broker disconnected: rc={}".format(rc))
   
 def on_mqtt_subscribe(client, userdata, mid, reason_code_list, properties):
@@ -29,29 +35,43 @@ def on_mqtt_subscribe(client, userdata, mid, reason_code_list, properties):
 def on_mqtt_message(mqttclient, userdata, message):
   try:
     msg = message.payload.decode("utf-8")
-    topic = message.topic.split("/")
+    for topic, callback in _subscriptions.items():
+      if callback and mqttcl.topic_matches_sub(topic, message.topic):
+        callback(message.topic, msg)
+        return
     if msg == "online" and userdata:
       gracetime = cfg.get("HASS_BIRTH_GRACETIME", 15)
       logging.info("Received HASS online message. Sending discovery info in {} sec".format(gracetime))
       time.sleep(gracetime) # dirty workaround: hass requires some grace period for being ready to receive discovery info
-      userdata.send_discovery_info()
+      for hass in (userdata if isinstance(userdata, list) else [userdata]): # one instance per inverter
+        if hass.is_initialized:
+          hass.send_discovery_info()
   except Exception as e:
     logging.warning("Error while handling MQTT message: {}".format(str(e)))
 
+# hass: HassIntegration instance (or list of instances, one per inverter) to re-send the discovery info to
 def mqtt_start( hass=None ): 
+  global _mqtt_client
   try: 
     client = mqttcl.Client(mqttcl.CallbackAPIVersion.VERSION2)
     client.user_data_set(hass) # register home automation instance
+    client.max_inflight_messages_set(cfg.get('MQTT_MAX_INFLIGHT', 20))
+    client.max_queued_messages_set(cfg.get('MQTT_MAX_QUEUED', 1000))
     if cfg['MQTT_LOGIN']:
       client.username_pw_set(cfg['MQTT_LOGIN'], cfg['MQTT_PASSWORD']) 
     client.on_connect = on_mqtt_connect
     client.on_disconnect = on_mqtt_disconnect
     client.on_message = on_mqtt_message
     client.on_subscribe = on_mqtt_subscribe
-    client.connect(cfg['MQTT_SERVER'], cfg['MQTT_PORT'], keepalive = 60) 
+    try:
+      client.connect(cfg['MQTT_SERVER'], cfg['MQTT_PORT'], keepalive = 60) 
+    except (ConnectionError, OSError) as e: # broker not reachable (yet) - the network loop keeps on trying
+      logging.warning("Couldn't connect to MQTT broker: {} - retrying in background".format(str(e)))
+      client.connect_async(cfg['MQTT_SERVER'], cfg['MQTT_PORT'], keepalive = 60) 
     if hass:
-      client.subscribe(cfg["HASS_BASE_TOPIC"]+"/status", qos=0)
+      _subscriptions[cfg["HASS_BASE_TOPIC"]+"/status"] = None # subscribed on connect
     client.loop_start()
+    _mqtt_client = client
     logging.info('MQTT server started')
     return client
   except Exception as e:
@@ -59,21 +79,95 @@ def mqtt_start( hass=None ):
     return None
 
 def mqtt_stop(client):
+  global _mqtt_client
+  if client is _mqtt_client:
+    _mqtt_client = None
   try: 
+    client.disconnect() # flushes in-flight messages before the loop terminates
     client.loop_stop()
     logging.info('MQTT server stopped')
   except Exception as e:
     logging.warning("Couldn't stop MQTT: {}".format(str(e)))
 
+# Publish via the persistent client started by mqtt_start(). Messages are queued
+# by the client's network loop, so publishing doesn't block on the broker.  
 def mqtt_publish( topic, payload ):
   if cfg['MQTT_DISABLE']: # Don't do anything - just logg
     logging.info("- {}: {}".format(topic, str(payload)))
-  else:  
+    return True
+
+  logging.debug("- {}: {}".format(topic, str(payload)))
+  if _mqtt_client is None: # no persistent client (e.g. standalone tools) - fall back to one-shot connection
     auth = None
     if cfg['MQTT_LOGIN']:
       auth = { 'username': cfg['MQTT_LOGIN'], 'password': cfg['MQTT_PASSWORD'] }  
-    logging.debug("- {}: {}".format(topic, str(payload)))
     try:
       publish.single(topic, payload=payload, hostname=cfg['MQTT_SERVER'], port=cfg['MQTT_PORT'], auth=auth)
     except Exception as e:
       logging.error("Could't send MQTT command: {}".format(str(e)))
+      metrics.inc("mtec_mqtt_publish_errors_total")
+      return False
+    return True
+
+  start = time.perf_counter()
+  try:
+    info = _mqtt_client.publish(topic, payload=payload, qos=cfg.get('MQTT_QOS', 0))
+  except Exception as e:
+    logging.error("Could't send MQTT command: {}".format(str(e)))
+    metrics.inc("mtec_mqtt_publish_errors_total")
+    return False
+  metrics.observe("mtec_mqtt_publish_seconds", time.perf_counter() - start)
+  if info.rc != mqttcl.MQTT_ERR_SUCCESS:
+    logging.error("Could't send MQTT command: {}".format(mqttcl.error_string(info.rc)))
+    metrics.inc("mtec_mqtt_publish_errors_total")
+    return False
+  return True
+
+# Subscribe to a topic (wildcards allowed). callback( topic, payload ) gets called by the client's network thread.
+def mqtt_subscribe( topic, callback ):
+  _subscriptions[topic] = callback
+  if _mqtt_client is not None and _mqtt_client.is_connected():
+    _mqtt_client.subscribe(topic, qos=0)
+
+# True, if the persistent client is currently not connected to the broker
+def mqtt_is_offline():
+  if cfg['MQTT_DISABLE'] or _mqtt_client is None:
+    return False
+  return not _mqtt_client.is_connected()
+
+# True, if the persistent client is connected to the broker (or MQTT is disabled)
+def mqtt_is_connected():
+  if cfg['MQTT_DISABLE']:
+    return True
+  return _mqtt_client is not None and _mqtt_client.is_connected()
+
+#=====================================================
+# Suppress publishing of unchanged values. A value is published, if  
+# - it differs from the last published payload and is outside of the (optional) deadband, or
+# - it hasn't been published for more than max_silence seconds (heartbeat)
+class PublishFilter:
+  def __init__( self, max_silence ):
+    self.max_silence = max_silence
+    self.last = {} # topic -> (payload, value, timestamp)
+    self.suppressed = 0
+
+  def is_due( self, topic, payload, value=None, deadband=None, deadband_percent=None ):
+    last = self.last.get(topic)
+    if last is None or time.monotonic() - last[2] >= self.max_silence:
+      return True
+    last_payload, last_value = last[0], last[1]
+    due = True 
+    if payload == last_payload:
+      due = False
+    elif (deadband or deadband_percent) and isinstance(value, (int, float)) and isinstance(last_value, (int, float)):
+      diff = abs(value - last_value)
+      if deadband and diff < deadband:
+        due = False
+      elif deadband_percent and diff < abs(last_value) * deadband_percent / 100:
+        due = False
+    if not due:
+      self.suppressed += 1
+    return due
+
+  def update( self, topic, payload, value=None ):
+    self.last[topic] = (payload, value, time.monotonic())
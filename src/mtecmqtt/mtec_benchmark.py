@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the poll-decode-publish cycle.
+Runs against the local Modbus simulator and a minimal local MQTT broker stand-in
+and writes the results as JSON.
+(c) 2024 by Christian Rödel
+"""
+import logging
+FORMAT = '[%(levelname)s] %(message)s'
+logging.basicConfig(format=FORMAT, level=logging.WARNING)
+
+from mtecmqtt import __version__
+from mtecmqtt.config import cfg, register_table, register_groups
+from mtecmqtt.MTECmodbusAPI import MTECmodbusAPI
+from mtecmqtt.mtec_simulator import SimulatorContext, run_simulator
+from mtecmqtt import mqtt
+from mtecmqtt import mtec_mqtt
+import pymodbus
+import argparse
+import asyncio
+import json
+import platform
+import random
+import statistics
+import sys
+import threading
+import time
+
+#=====================================================
+# Minimal MQTT broker stand-in: accepts connections and counts PUBLISH packets (MQTT 3.1.1)
+class MQTTStandIn:
+  def __init__( self ):
+    self.published = 0
+
+  async def handle( self, reader, writer ):
+    try:
+      while True:
+        header = await reader.readexactly(1)
+        length, multiplier = 0, 1
+        while True: # variable length encoding of the remaining length
+          byte = (await reader.readexactly(1))[0]
+          length += (byte & 0x7f) * multiplier
+          multiplier *= 128
+          if not byte & 0x80:
+            break
+        body = await reader.readexactly(length)
+        packet_type = header[0] >> 4
+        if packet_type == 1:    # CONNECT
+          writer.write(b"\x20\x02\x00\x00")
+        elif packet_type == 3:  # PUBLISH
+          self.published += 1
+          qos = (header[0] >> 1) & 0x03
+          if qos:
+            topic_len = int.from_bytes(body[0:2], "big")
+            writer.write(b"\x40\x02" + body[2+topic_len:4+topic_len]) # PUBACK
+        elif packet_type == 8:  # SUBSCRIBE
+          writer.write(bytes([0x90, 3]) + body[0:2] + b"\x00")
+        elif packet_type == 12: # PINGREQ
+          writer.write(b"\xd0\x00")
+        elif packet_type == 14: # DISCONNECT
+          break
+        await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+      pass
+    writer.close()
+
+  async def run( self, host, port ):
+    server = await asyncio.start_server(self.handle, host, port)
+    async with server:
+      await server.serve_forever()
+
+#-----------------------------
+# Run the stand-ins within a background thread
+def start_stand_ins( simulator, args ):
+  broker = MQTTStandIn()
+  loop = asyncio.new_event_loop()
+  loop.create_task( run_simulator(simulator, "127.0.0.1", args.modbus_port, cfg['MODBUS_SLAVE'], cfg.get("MODBUS_FRAMER", "rtu")) )
+  loop.create_task( broker.run("127.0.0.1", args.mqtt_port) )
+  threading.Thread(target=loop.run_forever, daemon=True).start()
+  time.sleep(1) # let the servers start up
+  return broker
+
+#-----------------------------
+# Summary statistics (ms)
+def stats( values ):
+  values = sorted(values)
+  if not values:
+    return {}
+  return {
+    "mean": statistics.mean(values) * 1000,
+    "p50": statistics.median(values) * 1000,
+    "p95": values[min(len(values)-1, int(len(values)*0.95))] * 1000,
+    "max": values[-1] * 1000,
+  }
+
+#-----------------------------
+# Requests per cycle and cluster planning time per group
+def bench_planning( api, repeat ):
+  result = {}
+  for group in sorted(register_groups):
+    idx = api._resolve_registers( api.get_register_list(group) )
+    t = time.perf_counter()
+    for i in range(repeat):
+      clusters = api._create_register_clusters(idx)
+    result[group] = {
+      "registers": len(idx),
+      "requests": len(clusters),
+      "registers_read": sum( cluster["length"] for cluster in clusters ),
+      "plan_time_us": (time.perf_counter() - t) / repeat * 1e6,
+    }
+  return result
+
+# Decode time per register type, based on random raw data
+def bench_decode( api, repeat ):
+  class RawData:
+    pass
+  result = {}
+  for item_type in sorted( set( item["type"] for item in register_table.values() ) ):
+    items = [ item for item in register_table.values() if item["type"] == item_type ]
+    samples = []
+    for item in items:
+      cluster = api._create_register_clusters( frozenset([item["address"]]) )[0]
+      rawdata = RawData()
+      rawdata.registers = [ random.randrange(0x3030, 0x3039) for i in range(cluster["length"]) ] # valid for all types
+      samples.append( (rawdata, cluster) )
+    t = time.perf_counter()
+    for i in range(repeat):
+      for rawdata, cluster in samples:
+        api._decode_cluster(rawdata, cluster)
+    result[item_type] = {
+      "registers": len(items),
+      "ns_per_register": (time.perf_counter() - t) / (repeat * len(items)) * 1e9,
+    }
+  return result
+
+# Read, publish and total latency per group
+def bench_cycles( api, simulator, broker, topic_base, cycles ):
+  result = {}
+  for group in sorted(register_groups):
+    read, publish, total = [], [], []
+    requests = simulator.requests
+    published = broker.published
+    for i in range(cycles):
+      t0 = time.perf_counter()
+      pvdata = mtec_mqtt.read_MTEC_data( api, group )
+      t1 = time.perf_counter()
+      if pvdata:
+        mtec_mqtt.write_to_MQTT( pvdata, topic_base + group + '/' )
+      t2 = time.perf_counter()
+      read.append(t1 - t0)
+      publish.append(t2 - t1)
+      total.append(t2 - t0)
+    result[group] = {
+      "requests_per_cycle": (simulator.requests - requests) / cycles,
+      "messages_per_cycle": (broker.published - published) / cycles, # might lag behind slightly
+      "read_ms": stats(read),
+      "publish_ms": stats(publish),
+      "total_ms": stats(total),
+    }
+  return result
+
+# MQTT publish throughput via the persistent client
+def bench_publish( broker, messages ):
+  time.sleep(0.5) # let messages of previous tests arrive
+  start_count = broker.published
+  t = time.perf_counter()
+  for i in range(messages):
+    mqtt.mqtt_publish( "MTEC/benchmark/value{}".format(i % 100), "{:.3f}".format(i) )
+  queued = time.perf_counter() - t
+  while broker.published - start_count < messages and time.perf_counter() - t < 30:
+    time.sleep(0.001)
+  elapsed = time.perf_counter() - t
+  return {
+    "messages": messages,
+    "received": broker.published - start_count,
+    "publish_call_us": queued / messages * 1e6,
+    "messages_per_s": (broker.published - start_count) / elapsed,
+  }
+
+#-----------------------------
+def parse_options():
+  parser = argparse.ArgumentParser(description='MTEC benchmark. Measures the poll-decode-publish cycle against a local Modbus simulator and MQTT broker stand-in.',
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument( '-c', '--cycles', type=int, default=20, help='Number of read cycles per group' )
+  parser.add_argument( '-l', '--latency', type=float, default=0, help='Simulated Modbus latency per request (ms)' )
+  parser.add_argument( '-j', '--jitter', type=float, default=0, help='Simulated additional random Modbus latency (ms)' )
+  parser.add_argument( '-m', '--messages', type=int, default=10000, help='Number of messages for the MQTT throughput test' )
+  parser.add_argument( '--modbus-port', type=int, default=15743, help='Port of the Modbus simulator' )
+  parser.add_argument( '--mqtt-port', type=int, default=11883, help='Port of the MQTT broker stand-in' )
+  parser.add_argument( '-f', '--file', help='Write results to <FILE> instead of stdout' )
+  return parser.parse_args()
+
+#-------------------------------
+def main():
+  args = parse_options()
+
+  # Redirect all connections to the local stand-ins
+  cfg.update({
+    "MODBUS_IP": "127.0.0.1", "MODBUS_PORT": args.modbus_port, "MODBUS_PORT2": args.modbus_port,
+    "MQTT_SERVER": "127.0.0.1", "MQTT_PORT": args.mqtt_port, "MQTT_DISABLE": False, "MQTT_LOGIN": None,
+  })
+  simulator = SimulatorContext( latency=args.latency/1000, jitter=args.jitter/1000 )
+  broker = start_stand_ins( simulator, args )
+
+  api = MTECmodbusAPI()
+  if not api.connect():
+    logging.fatal("Can't connect to Modbus simulator")
+    sys.exit(1)
+  mqttclient = mqtt.mqtt_start()
+  while mqttclient and not mqttclient.is_connected():
+    time.sleep(0.01)
+
+  results = {
+    "version": __version__,
+    "python": platform.python_version(),
+    "pymodbus": pymodbus.__version__,
+    "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+    "settings": {
+      "cycles": args.cycles,
+      "latency_ms": args.latency,
+      "jitter_ms": args.jitter,
+      "publish_mode": cfg.get("MQTT_PUBLISH_MODE", "topics"),
+      "cluster_request_cost": cfg.get("MODBUS_CLUSTER_REQUEST_COST", 20),
+      "cluster_register_cost": cfg.get("MODBUS_CLUSTER_REGISTER_COST", 1),
+    },
+    "planning": bench_planning( api, 100 ),
+    "decode": bench_decode( api, 1000 ),
+    "cycle": bench_cycles( api, simulator, broker, "MTEC/benchmark/", args.cycles ),
+    "publish": bench_publish( broker, args.messages ),
+  }
+
+  api.disconnect()
+  mqtt.mqtt_stop(mqttclient)
+
+  output = json.dumps(results, indent=2)
+  if args.file:
+    with open(args.file, "w") as f:
+      f.write(output + "\n")
+  else:
+    print(output)
+
+#-------------------------------
+if __name__ == '__main__':
+  main()
@@ -3,10 +3,21 @@
 This tool enables to query MTECmodbusapi and export the data in various ways.
 (c) 2024 by Christian Rödel 
 """
-from mtecmqtt.config import cfg, register_groups
+import logging
+FORMAT = '[%(levelname)s] %(message)s'
+logging.basicConfig(format=FORMAT, level=logging.INFO)
+
+from mtecmqtt.config import register_groups, register_map, register_table
+from datetime import datetime
 import argparse
+import json
+import os
+import signal
 import sys
+import threading
+import time
 from mtecmqtt.MTECmodbusAPI import MTECmodbusAPI
+from mtecmqtt.columnar import NpyWriter, ParquetWriter, PARQUET_SUPPORT
 
 #-----------------------------
 def parse_options():
@@ -20,14 +31,167 @@ def parse_options():
   parser.add_argument( '-c', '--csv', action='store_true', help='Export as CSV')
   parser.add_argument( '-f', '--file', help='Write data to <FILE> instead of stdout')
   parser.add_argument( '-a', '--append', action='store_true', help='Use as modifier in combination with --file argument to append data to file instead of replacing it')
+  parser.add_argument( '--follow', action='store_true', help='Streaming mode: Keep on reading and append one row per read (CSV or JSON Lines) until interrupted')
+  parser.add_argument( '-i', '--interval', type=float, default=10, help='Streaming mode: Read interval (s)')
+  parser.add_argument( '-j', '--jsonl', action='store_true', help='Streaming mode: Export as JSON Lines instead of CSV')
+  parser.add_argument( '--rotate-size', type=float, help='Streaming mode: Start a new file when the current one exceeds <ROTATE_SIZE> MB')
+  parser.add_argument( '--rotate-daily', action='store_true', help='Streaming mode: Start a new file every day')
+  parser.add_argument( '--npy', action='store_true', help='Export as columnar NumPy .npy file (requires --file)')
+  parser.add_argument( '--parquet', action='store_true', help='Export as columnar Parquet file (requires --file and pyarrow)')
+  parser.add_argument( '--batch', type=int, default=1000, help='Columnar formats: Rows per batch resp. Parquet row group')
   return parser.parse_args()
+
+#-------------------------------
+# Streaming mode: generator pipeline poll -> format -> write 
+
+# Read the registers every 'interval' seconds (on a fixed grid, so that reading time doesn't accumulate as drift)
+# until the streaming mode gets stopped
+def poll( api, registers, interval ):
+  deadline = time.monotonic()
+  while not stop.is_set():
+    yield datetime.now(), api.read_modbus_data( registers=registers )
+    deadline += interval
+    stop.wait( max(0, deadline - time.monotonic()) )
+
+# CSV rows with fixed column order. Registers which couldn't be read are left empty.
+def format_csv( samples, columns ):
+  for timestamp, data in samples:
+    yield timestamp.strftime("%Y-%m-%d %H:%M:%S") + ";" + ";".join( str(data[column]["value"]) if column in data else "" for column in columns )
+
+# JSON Lines with fixed key order. Registers which couldn't be read are null.
+def format_jsonl( samples, columns ):
+  for timestamp, data in samples:
+    row = { "timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S") }
+    for column in columns:
+      row[column] = data[column]["value"] if column in data else None
+    yield json.dumps( row, separators=(',', ':') )
+
+# Text file (CSV, JSON Lines), starting with 'header' (if given)
+class TextWriter:
+  def __init__( self, filename, header=None ):
+    self.f = open(filename, "w")
+    if header:
+      self.f.write( header + "\n" )
+
+  def write( self, line ):
+    self.f.write( line + "\n" )
+    self.f.flush()
+
+  def size( self ):
+    return self.f.tell()
+
+  def close( self ):
+    self.f.close()
+
+# Write records to files <name>-<date>_<time><ext> which get rotated by size and/or day.
+# open_writer(filename) returns a writer (TextWriter, NpyWriter, ParquetWriter) for a new file.
+def write_rotating( records, path, open_writer, rotate_size=None, rotate_daily=False ):
+  name, ext = os.path.splitext(path)
+  writer = None
+  day = None
+  try:
+    for record in records:
+      now = datetime.now()
+      if writer and ( (rotate_size and writer.size() >= rotate_size) or (rotate_daily and now.date() != day) ):
+        writer.close()
+        writer = None
+      if not writer:
+        day = now.date()
+        filename = "{}-{}{}".format( name, now.strftime("%Y%m%d_%H%M%S"), ext )
+        idx = 1
+        while os.path.exists(filename): # don't overwrite on fast rotation
+          filename = "{}-{}_{}{}".format( name, now.strftime("%Y%m%d_%H%M%S"), idx, ext )
+          idx += 1
+        print( "Writing output to '{}'".format(filename) )
+        writer = open_writer(filename)
+      writer.write( record )
+  finally:
+    if writer:
+      writer.close()
+
+# Export samples as CSV / JSON Lines (to stdout or rotated files) or in a columnar format (to rotated files)
+def export_samples( samples, columns, args ):
+  rotate_size = args.rotate_size * 1024 * 1024 if args.rotate_size else None
+  if args.npy or args.parquet:
+    writer_class = NpyWriter if args.npy else ParquetWriter
+    write_rotating( samples, args.file, lambda filename: writer_class(filename, columns, args.batch), rotate_size, args.rotate_daily )
+    return
+
+  if args.jsonl:
+    lines, header = format_jsonl( samples, columns ), None
+  else:
+    lines, header = format_csv( samples, columns ), "timestamp;" + ";".join(columns)
+  if args.file:
+    write_rotating( lines, args.file, lambda filename: TextWriter(filename, header), rotate_size, args.rotate_daily )
+  else:
+    if header:
+      print( header )
+    for line in lines:
+      print( line, flush=True )
+
+# Numeric registers of the given list (default: all) in fixed order
+def get_columns( registers ):
+  if registers is None: # all registers
+    registers = [ item["register"] for item in register_table.values() ]
+  return [ register for register in registers if register in register_map and register_map[register]["address"] is not None ]
+
+# SIGTERM (e.g. systemctl stop) and Ctrl-C end the streaming mode after the current sample, so that the current file gets completed
+stop = threading.Event()
+
+def signal_handler( signal_number, frame ):
+  stop.set()
+
+def follow( api, registers, args ):
+  columns = get_columns( registers )
+  signal.signal( signal.SIGTERM, signal_handler )
+  signal.signal( signal.SIGINT, signal_handler )
+  export_samples( poll( api, columns, args.interval ), columns, args )
  
 #-------------------------------
 def main():
   args = parse_options()
   api = MTECmodbusAPI()
+
+  registers = None
+  if args.group and args.group != "all":
+    registers = sorted(api.get_register_list(args.group))
+
+  if args.registers:
+    registers = []
+    reg_str = args.registers.split(",")
+    for addr in reg_str:
+      registers.append(addr.strip())  
+
+  if (args.npy or args.parquet) and not args.file:
+    print( "ERROR - Columnar formats require an output file (--file)" )
+    exit(1)
+  if args.follow and args.append:
+    print( "ERROR - Streaming mode always writes new files (--append isn't supported with --follow)" )
+    exit(1)
+  if args.parquet and not PARQUET_SUPPORT:
+    print( "ERROR - Parquet export requires pyarrow (pip install pyarrow)" )
+    exit(1)
+
+  if args.follow:
+    if not api.connect():
+      print( "ERROR - Can't connect to MODBUS server" )
+      exit(1)
+    follow( api, registers, args )
+    api.disconnect()
+    print( "Data completed" )
+    return
+
   print( "Reading data..." )
 
+  if args.npy or args.parquet: # single sample in columnar format
+    columns = get_columns( registers )
+    api.connect()
+    sample = ( datetime.now(), api.read_modbus_data( registers=columns ) )
+    api.disconnect()
+    export_samples( [sample], columns, args )
+    print( "Data completed" )
+    return
+
   # redirect stdout to file (if defined as command line parameter)
   if args.file:  
     try:
@@ -45,18 +209,8 @@ def main():
       print( "ERROR - Unable to open output file '{}'".format(args.file) )
       exit(1)
 
-  registers = None
-  if args.group and args.group != "all":
-    registers = sorted(api.get_register_list(args.group))
-
-  if args.registers:
-    registers = []
-    reg_str = args.registers.split(",")
-    for addr in reg_str:
-      registers.append(addr.strip())  
-
   # Do the export
-  api.connect( ip_addr=cfg['MODBUS_IP'], port=cfg['MODBUS_PORT'], slave=cfg['MODBUS_SLAVE'] )
+  api.connect()
   data = api.read_modbus_data( registers=registers )
   api.disconnect()
 
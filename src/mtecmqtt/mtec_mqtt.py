@@ -9,13 +9,24 @@ import logging
 FORMAT = '[%(levelname)s] %(message)s'
 logging.basicConfig(format=FORMAT, level=logging.INFO)
 
-from mtecmqtt.config import cfg, register_map
-from datetime import datetime, timedelta
+from mtecmqtt.config import cfg, register_map, register_groups, pseudo_registers
+from mtecmqtt.expressions import compile_expression
+from datetime import datetime
+import functools
 import time
 import signal
-from mtecmqtt.mqtt import mqtt_start, mqtt_stop, mqtt_publish
+import asyncio
+import json
+import multiprocessing
+from queue import Empty
+from mtecmqtt.mqtt import mqtt_start, mqtt_stop, mqtt_publish, mqtt_subscribe, mqtt_is_offline, PublishFilter
+from mtecmqtt.buffer import PublishBuffer
+from mtecmqtt.commands import WriteQueue
 from mtecmqtt.MTECmodbusAPI import MTECmodbusAPI
+from mtecmqtt.MTECmodbusAsyncAPI import MTECmodbusAsyncAPI
 from mtecmqtt.hass_int import HassIntegration
+from mtecmqtt.scheduler import GroupScheduler, AdaptiveRate
+from mtecmqtt import metrics
 
 #----------------------------------
 def signal_handler(signal_number, frame):
@@ -25,179 +36,563 @@ def signal_handler(signal_number, frame):
 
 # =============================================
 # read data from MTEC modbus
-def read_MTEC_data( api, group ):
+# If 'data' is given, the group is assigned from these (already fetched) Modbus data 
+def read_MTEC_data( api, group, data=None ):
   logging.info("Reading registers for group: {}".format(group))
   registers = api.get_register_list( group )
-  now = datetime.now()
-  data = api.read_modbus_data(registers=registers)
+  if not registers:
+    return None
+  if data is None:
+    data = api.read_modbus_data(registers=get_group_registers(group))
+  # Registers which couldn't be read (e.g. quarantined ones) are left out. The group fails only if nothing could be read.
+  required = get_group_registers( group )
+  missing = [ register for register in required if register not in data ]
+  if missing:
+    if len(missing) == len(required):
+      logging.warning("Couldn't retrieve any Modbus data of group {}".format(group))
+      return None
+    logging.debug("Retrieved Modbus data of group {} is incomplete - missing registers: {}".format(group, ", ".join(missing)))
+    metrics.inc("mtec_incomplete_reads_total", group=group)
+
+  start = time.perf_counter()
   pvdata = {}
-  try: # assign all data
-    for register in registers:
-      item = register_map[register]
-      if item["mqtt"]:
-        if register.isnumeric():  
-          pvdata[item["mqtt"]] = data[register]
-        else: # non-numeric registers are deemed to be calculated pseudo-registers  
-          if register == "consumption":  
-            pvdata[item["mqtt"]] = data["11016"]["value"] - data["11000"]["value"]  # power consumption 
-          elif register == "consumption-day":
-            pvdata[item["mqtt"]] = data["31005"]["value"] + data["31001"]["value"] + data["31004"]["value"] - data["31000"]["value"] - data["31003"]["value"]  # power consumption 
-          elif register == "autarky-day":
-            pvdata[item["mqtt"]] = 100*(1 - (data["31001"]["value"] / pvdata["consumption_day"])) if pvdata["consumption_day"]>0 else 0
-          elif register == "ownconsumption-day":
-            pvdata[item["mqtt"]] = 100*(1-data["31000"]["value"] / data["31005"]["value"]) if data["31005"]["value"]>0 else 0
-          elif register == "consumption-total":
-            pvdata[item["mqtt"]] = data["31112"]["value"] + data["31104"]["value"] + data["31110"]["value"] - data["31102"]["value"] - data["31108"]["value"]  # power consumption 
-          elif register == "autarky-total":
-            pvdata[item["mqtt"]] = 100*(1 - (data["31104"]["value"] / pvdata["consumption_total"])) if pvdata["consumption_total"]>0 else 0
-          elif register == "ownconsumption-total":
-            pvdata[item["mqtt"]] = 100*(1-data["31102"]["value"] / data["31112"]["value"]) if data["31112"]["value"]>0 else 0
-          elif register == "api-date":    
-            pvdata[item["mqtt"]] = now.strftime("%Y-%m-%d %H:%M:%S") # Local time of this server
-          else:  
-            logging.warning("Unknown calculated pseudo-register: {}".format(register))
-
-          if isinstance(pvdata[item["mqtt"]], float) and pvdata[item["mqtt"]] < 0: # Avoid to report negative values, which might occur in some edge cases  
-            pvdata[item["mqtt"]] = 0 
+  # calculate pseudo-registers
+  values = {}
+  for register, function, dependencies in get_pseudo_plan( group ):
+    try:
+      value = function( *[ values[dep] if dep in values else data[dep]["value"] for dep in dependencies ] )
+    except KeyError: # dependency missing
+      continue
+    except Exception as e:
+      logging.warning("Couldn't calculate register {}: {}".format(register, str(e)))
+      continue
+    if isinstance(value, float) and value < 0: # Avoid to report negative values, which might occur in some edge cases  
+      value = 0 
+    values[register] = value
+
+  # assign all data
+  for register in registers:
+    item = register_map[register]
+    if item["mqtt"]:
+      if register in data:  
+        pvdata[item["mqtt"]] = data[register]
+      elif register in values:
+        pvdata[item["mqtt"]] = values[register]
  
-  except Exception as e:
-    logging.warning("Retrieved Modbus data is incomplete: {}".format(str(e)))
-    return None
+  metrics.observe("mtec_pseudo_register_seconds", time.perf_counter() - start, group=group)
+  return pvdata
+
+# Calculated pseudo-registers of a group as list of (register, function, dependencies) in evaluation order,
+# including the pseudo-registers of other groups they depend on. The expressions get compiled on first use.
+@functools.lru_cache(maxsize=None)
+def get_pseudo_plan( group ):
+  needed = set( register for register, item in pseudo_registers.items() if item["group"] == group )
+  for register in reversed(list(pseudo_registers)): # dependencies precede their dependents
+    if register in needed:
+      needed.update( dep for dep in pseudo_registers[register]["depends"] if dep in pseudo_registers )
+  plan = []
+  for register, item in pseudo_registers.items():
+    if register in needed:
+      function, dependencies = compile_expression( item["expression"] )
+      plan.append( (register, function, dependencies) )
+  return plan
+
+#----------------------------------
+# Modbus registers a group depends on: its own registers plus the ones its pseudo-registers are calculated from
+@functools.lru_cache(maxsize=None)
+def get_group_registers( group ):
+  registers = []
+  for register, item in register_map.items():
+    if item["group"] == group:
+      registers += [register] if item["address"] is not None else item.get("sources", [])
+  return tuple(dict.fromkeys(registers))
+
+# Plan the Modbus reads for several groups: returns a list of (registers, groups) 
+# Groups are combined into one read if MODBUS_CLUSTER_ACROSS_GROUPS is set
+def plan_MTEC_reads( groups ):
+  if cfg.get("MODBUS_CLUSTER_ACROSS_GROUPS", False) and len(groups) > 1:
+    registers = []
+    for group in groups:
+      registers += get_group_registers( group )
+    return [ (list(dict.fromkeys(registers)), groups) ]
+  return [ (get_group_registers( group ), [group]) for group in groups ]
+
+# Registers of a read which haven't been read within this cycle yet
+def _unread_registers( registers, data, group ):
+  unread = [ register for register in registers if register not in data ]
+  if len(unread) < len(registers):
+    metrics.inc( "mtec_shared_register_reads_total", len(registers) - len(unread), group=group )
+  return unread
+
+# read data of several groups
+# Values read within this cycle are shared by all groups, so that every register is read once at most 
+def read_MTEC_groups( api, groups ):
+  return run_steps( api, read_steps( api, groups ) )
+
+# read data of several groups (asyncio version)
+async def read_MTEC_groups_async( api, groups ):
+  return await run_steps_async( api, read_steps( api, groups ) )
+
+# Steps of read_MTEC_groups() - see poll_steps()
+def read_steps( api, groups ):
+  pvdata = {}
+  data = {}
+  for registers, read_groups in plan_MTEC_reads( groups ):
+    registers = _unread_registers( registers, data, read_groups[0] )
+    if registers:
+      data.update( (yield ("read", registers)) )
+    for group in read_groups:
+      pvdata[group] = read_MTEC_data( api, group, data )
   return pvdata
 
 #----------------------------------
 # write data to MQTT
+publish_filter = None # PublishFilter, if MQTT_ONLY_CHANGES is set
+publish_buffer = None # PublishBuffer, if MQTT_BUFFER_FILE is set
+
+# MQTT parameter -> register config
+@functools.lru_cache(maxsize=None)
+def get_mqtt_items():
+  return { item["mqtt"]: item for item in register_map.values() if item["mqtt"] }
+
 def write_to_MQTT( pvdata, base_topic ):
+  mode = cfg.get("MQTT_PUBLISH_MODE", "topics")
+  buffered = []
+  if mode in ("topics", "both"):
+    write_topics_to_MQTT( pvdata, base_topic, buffered )
+  if mode in ("json", "both"):
+    write_json_to_MQTT( pvdata, base_topic, buffered )
+  if buffered:
+    publish_buffer.add( buffered )
+
+# Publish a sample. If the broker isn't reachable, the sample is appended to 'buffered' 
+# for the publish buffer instead (if enabled). Returns True only if the sample was published while connected to the broker. 
+def publish_sample( topic, payload, buffered ):
+  if publish_buffer and mqtt_is_offline():
+    buffered.append( (topic, payload) )
+    return False
+  if mqtt_publish( topic, payload ):
+    return not mqtt_is_offline()
+  if publish_buffer:
+    buffered.append( (topic, payload) )
+  return False
+
+# One topic per value: <base_topic>/<param>
+def write_topics_to_MQTT( pvdata, base_topic, buffered ):
   for param, data in pvdata.items():
     topic = base_topic + param
-    if isinstance(data, dict):
-      if isinstance(data["value"], float):  
-        payload = cfg['MQTT_FLOAT_FORMAT'].format( data["value"] )
-      elif isinstance(data["value"], bool):  
-        payload = "{:d}".format( data["value"] )
-      else:
-        payload = data["value"]
-    else:   
-      if isinstance(data, float):  
-        payload = cfg['MQTT_FLOAT_FORMAT'].format( data )
-      elif isinstance(data, bool):  
-        payload = "{:d}".format( data )
-      else:
-        payload = data  
-    mqtt_publish( topic, payload )
+    value = data["value"] if isinstance(data, dict) else data
+    if isinstance(value, float):  
+      payload = cfg['MQTT_FLOAT_FORMAT'].format( value )
+    elif isinstance(value, bool):  
+      payload = "{:d}".format( value )
+    else:
+      payload = value
 
-#==========================================
-def main():
-  global run_status
-  run_status = True 
+    if publish_filter:
+      item = get_mqtt_items().get(param, {})
+      if not publish_filter.is_due( topic, payload, value, item.get("deadband"), item.get("deadband_percent") ):
+        continue
+      if publish_sample( topic, payload, buffered ):
+        publish_filter.update( topic, payload, value )
+    else:
+      publish_sample( topic, payload, buffered )
 
-  # Initialization
-  signal.signal(signal.SIGTERM, signal_handler)
-  signal.signal(signal.SIGINT, signal_handler)
-  if cfg['DEBUG'] == True:
-    logging.getLogger().setLevel(logging.DEBUG)
-  logging.info("Starting")
+# One compact JSON document per group: <base_topic> = { "timestamp": ..., <param>: <value>, ... }
+def write_json_to_MQTT( pvdata, base_topic, buffered ):
+  topic = base_topic.rstrip('/')
+  values = {}
+  for param, data in pvdata.items():
+    value = data["value"] if isinstance(data, dict) else data
+    if isinstance(value, float):  
+      value = float( cfg['MQTT_FLOAT_FORMAT'].format( value ) )
+    elif isinstance(value, bool):  
+      value = int(value)
+    values[param] = value
+  values_json = json.dumps( values, separators=(',', ':') )
 
-  next_read_config = datetime.now()
-  next_read_day = datetime.now()
-  next_read_total = datetime.now()
-  now_ext_idx = 0
-  topic_base = None
+  if publish_filter and not publish_filter.is_due( topic, values_json ):
+    return
+  payload = '{{"timestamp":"{}",{}'.format( datetime.now().strftime("%Y-%m-%d %H:%M:%S"), values_json[1:] ) if values else values_json
+  if publish_sample( topic, payload, buffered ) and publish_filter:
+    publish_filter.update( topic, values_json )
 
-  api = MTECmodbusAPI()
-  if not api.connect():
-    logging.fatal("Can't connect to MODBUS server - exiting")
+#----------------------------------
+# Publish a summary of the metrics of an inverter to <topic_base>diagnostics every METRICS_MQTT_INTERVAL seconds
+last_diagnostics = {} # topic base -> time of last publish
+
+def write_diagnostics_to_MQTT( topic_base, inverter ):
+  interval = cfg.get("METRICS_MQTT_INTERVAL", 0)
+  if not interval or time.monotonic() - last_diagnostics.get(topic_base, 0) < interval:
     return
+  last_diagnostics[topic_base] = time.monotonic()
+  mqtt_publish( topic_base + "diagnostics", json.dumps( metrics.get_summary( inverter=inverter ), separators=(',', ':') ) )
 
-  if cfg["HASS_ENABLE"]:
-    hass = HassIntegration()
-  else:
-    hass = None
-  mqttclient = mqtt_start( hass )
+#----------------------------------
+# Commands: Register writes requested via <MQTT_TOPIC>/<serial_no>/<group>/<parameter>/set
+write_queues = {} # serial no -> WriteQueue of the inverter
+
+# Start accepting commands for an inverter, if COMMANDS_ENABLE is set. Returns its WriteQueue (or None). 
+def start_commands( api, serial_no ):
+  if not cfg.get("COMMANDS_ENABLE", False):
+    return None
+  write_queues[serial_no] = WriteQueue( api )
+  mqtt_subscribe( cfg['MQTT_TOPIC'] + '/' + serial_no + '/+/+/set', on_set_message )
+  logging.info("Accepting commands for inverter {} (serial no. {})".format(api.name, serial_no))
+  return write_queues[serial_no]
+
+# Called by the MQTT network thread
+def on_set_message( topic, payload ):
+  levels = topic.split("/")
+  write_queue = write_queues.get(levels[-4]) if len(levels) >= 5 else None
+  item = get_mqtt_items().get(levels[-2])
+  if not write_queue or not item or item["group"] != levels[-3]:
+    logging.warning("Command for unknown inverter, group or parameter ignored: {}".format(topic))
+    return
+  logging.info("Command received: Set {} to {}".format(item["mqtt"], payload))
+  write_queue.put( item["register"], payload.strip() )
+
+# Execute pending writes - max. COMMANDS_MAX_WRITES per cycle, so that polling doesn't starve 
+# Returns the groups of the written registers, which should be re-read in this cycle
+def execute_writes( api, write_queue ):
+  return run_steps( api, write_steps( write_queue ) )
+
+# Execute pending writes (asyncio version)
+async def execute_writes_async( api, write_queue ):
+  return await run_steps_async( api, write_steps( write_queue ) )
+
+# Steps of execute_writes() - see poll_steps()
+def write_steps( write_queue ):
+  groups = []
+  for register, value in write_queue.get_batch( cfg.get("COMMANDS_MAX_WRITES", 5) ):
+    if (yield ("write", register, value)):
+      logging.info("Register {} set to {}".format(register, value))
+    if register_map[register]["group"] not in groups:
+      groups.append( register_map[register]["group"] )
+  return groups
+
+#----------------------------------
+# Create the polling schedule from POLL_SCHEDULE in config.yaml 
+# If not configured, the default schedule is derived from the REFRESH_* settings 
+def create_scheduler():
+  schedule = cfg.get("POLL_SCHEDULE") or default_schedule()
+  groups = {}
+  for group, entry in schedule.items():
+    if group not in register_groups:
+      logging.warning("POLL_SCHEDULE: Unknown register group {} - skipped.".format(group))
+      continue
+    entry = entry or {}
+    if not entry.get("enabled", True):
+      logging.info("POLL_SCHEDULE: Group {} is disabled".format(group))
+      continue
+    if not entry.get("interval") or entry["interval"] <= 0:
+      logging.warning("POLL_SCHEDULE: Missing or invalid interval for group {} - skipped.".format(group))
+      continue
+    groups[group] = entry
+
+  tick = min( [entry["interval"] for entry in groups.values()] or [cfg['REFRESH_NOW']] )
+  scheduler = GroupScheduler( tick )
+  for group, entry in groups.items():
+    scheduler.add_group( group, entry["interval"], offset=entry.get("offset", 0), heavy=entry.get("heavy", False), priority=entry.get("priority", 0) )
+  return scheduler
+
+# Controller which adapts the polling intervals to the latency of the Modbus server, if POLL_ADAPTIVE is set
+def create_rate_control( api ):
+  if not api.cfg.get("POLL_ADAPTIVE", False):
+    return None
+  return AdaptiveRate( target_latency=api.cfg.get("POLL_ADAPTIVE_TARGET_LATENCY", 0.5), max_error_rate=api.cfg.get("POLL_ADAPTIVE_MAX_ERROR_RATE", 0.05),
+                       min_factor=api.cfg.get("POLL_ADAPTIVE_MIN_FACTOR", 0.5), max_factor=api.cfg.get("POLL_ADAPTIVE_MAX_FACTOR", 4) )
+
+# Default schedule: "now-base" every REFRESH_NOW, the "now extended" groups in a round robin (one per tick), 
+# and "day", "total" and "config" spread so that they never share a tick 
+def default_schedule():
+  tick = cfg['REFRESH_NOW']
+  schedule = { "now-base": { "interval": tick, "priority": 1 } }
+  now_ext_groups = [ "now-grid", "now-inverter", "now-backup", "now-battery", "now-pv" ]
+  for idx, group in enumerate(now_ext_groups):
+    schedule[group] = { "interval": tick*len(now_ext_groups), "offset": tick*idx, "priority": 2 }
+  schedule["day"] = { "interval": cfg['REFRESH_DAY'], "priority": 3, "heavy": True }
+  schedule["total"] = { "interval": cfg['REFRESH_TOTAL'], "priority": 3, "heavy": True }
+  schedule["config"] = { "interval": cfg['REFRESH_CONFIG'], "priority": 3, "heavy": True }
+  return schedule
+
+#----------------------------------
+# Polling of an inverter, shared by the sync and the asyncio engine:
+# poll_steps() is a generator which yields the Modbus I/O (and the waits) it needs as steps and gets their results sent back.
+# run_steps() resp. run_steps_async() execute these steps with the API of the engine.
+#   ("connect",)                       -> True, if connected
+#   ("check",)                         -> None (health check of the connection)
+#   ("read", registers)                -> Modbus data
+#   ("write", register, value)         -> True, if written
+#   ("sleep", seconds, write_queue)    -> None (wakes up early if a command is queued)
+
+# Poll a single inverter until shutdown. 'publish( pvdata, base_topic )' gets called with the data of each group read.
+def poll_steps( api, hass, publish ):
+  if not (yield ("connect",)): # inverter is unreachable - keep on trying in the background
+    logging.warning("Can't connect to MODBUS server {} - retrying in the background".format(api.name))
+    api.reconnect()
 
   # Initialize  
   pv_config = None
   while run_status and not pv_config:
-    pv_config = read_MTEC_data( api, "config" )
+    pv_config = (yield from read_steps( api, ["config"] ))["config"]
+    if pv_config and "serial_no" not in pv_config: # incomplete - the serial no. is needed to identify the inverter
+      pv_config = None
     if not pv_config:
-      logging.warning("Cant retrieve initial config - retry in 10 s")
-      time.sleep(10)
+      logging.warning("Cant retrieve initial config of {} - retry in 10 s".format(api.name))
+      yield ("sleep", 10, None)
   
   if not pv_config:
-    logging.fatal("Cant retrieve initial config.")
+    logging.fatal("Cant retrieve initial config of {}.".format(api.name))
+    api.disconnect()
     return
   
   topic_base = cfg['MQTT_TOPIC'] + '/' + pv_config["serial_no"]["value"] + '/'  
+  logging.info("Polling inverter {} (serial no. {})".format(api.name, pv_config["serial_no"]["value"]))
   if hass and not hass.is_initialized:
     hass.initialize( pv_config["serial_no"]["value"] )
+  write_queue = start_commands( api, pv_config["serial_no"]["value"] )
 
   # Main loop - exit on signal only
+  scheduler = create_scheduler()
+  rate_control = create_rate_control( api )
   while run_status: 
-    now = datetime.now()
-
-    # Now base
-    pvdata = read_MTEC_data( api, "now-base" )
-    if pvdata:
-      write_to_MQTT( pvdata, topic_base + 'now-base/' )
-
-    # Now extended - read groups in a round robin - one per loop
-    if now_ext_idx == 0:
-      pvdata = read_MTEC_data( api, "now-grid" )
-      if pvdata:
-        write_to_MQTT( pvdata, topic_base + 'now-grid/' )
-    elif now_ext_idx == 1:
-      pvdata = read_MTEC_data( api, "now-inverter" )
-      if pvdata:
-        write_to_MQTT( pvdata, topic_base + 'now-inverter/' )
-    elif now_ext_idx == 2:
-      pvdata = read_MTEC_data( api, "now-backup" )
-      if pvdata:
-        write_to_MQTT( pvdata, topic_base + 'now-backup/' )
-    elif now_ext_idx == 3:
-      pvdata = read_MTEC_data( api, "now-battery" )
-      if pvdata:
-        write_to_MQTT( pvdata, topic_base + 'now-battery/' )
-    elif now_ext_idx == 4:
-      pvdata = read_MTEC_data( api, "now-pv" )
-      if pvdata:
-        write_to_MQTT( pvdata, topic_base + 'now-pv/' )
-    
-    if now_ext_idx >= 4:
-      now_ext_idx = 0
-    else:  
-      now_ext_idx += 1
-
-    # Day
-    if next_read_day <= now:
-      pvdata = read_MTEC_data( api, "day" )
+    yield ("check",)
+    written_groups = (yield from write_steps( write_queue )) if write_queue else []
+    groups = scheduler.get_due_groups()
+    groups += [ group for group in written_groups if group not in groups and group in register_groups ]
+    for group, pvdata in (yield from read_steps( api, groups )).items():
       if pvdata:
-        write_to_MQTT( pvdata, topic_base + 'day/' )
-        next_read_day = datetime.now() + timedelta(seconds=cfg['REFRESH_DAY'])
-
-    # Total
-    if next_read_total <= now:
-      pvdata = read_MTEC_data( api, "total" )
-      if pvdata:
-        write_to_MQTT( pvdata, topic_base + 'total/' )
-        next_read_total = datetime.now() + timedelta(seconds=cfg['REFRESH_TOTAL'])
-
-    # Config
-    if next_read_config <= now:
-      pvdata = read_MTEC_data( api, "config" )
-      if pvdata:
-        write_to_MQTT( pvdata, topic_base + 'config/' )
-        next_read_config = datetime.now() + timedelta(seconds=cfg['REFRESH_CONFIG'])
+        publish( pvdata, topic_base + group + '/' )
+      else:
+        metrics.inc( "mtec_group_retries_total", group=group, inverter=api.name )
+        scheduler.retry( group )
+    if rate_control:
+      scheduler.set_rate_factor( rate_control.update( *api.get_request_stats(), missed=scheduler.get_missed_deadlines() ) )
+      metrics.set_gauge( "mtec_poll_rate_factor", scheduler.rate_factor, inverter=api.name )
+    write_diagnostics_to_MQTT( topic_base, api.name )
 
-    logging.debug("Sleep {}s".format( cfg['REFRESH_NOW'] ))
-    time.sleep(cfg['REFRESH_NOW'])
+    sleep_time = min( scheduler.get_sleep_time(), api.get_probe_time() ) # wake up for health checks of the connection
+    logging.debug("Sleep {:.3f}s".format( sleep_time ))
+    yield ("sleep", sleep_time, write_queue) # wake up for commands
 
   # clean up
   if hass:
     hass.send_unregister_info()
   api.disconnect()
+
+# Execute the steps with a MTECmodbusAPI. Returns the result of the generator.
+def run_steps( api, steps ):
+  result = None
+  while True:
+    try:
+      step = steps.send( result )
+    except StopIteration as stop:
+      return stop.value
+    if step[0] == "read":
+      result = api.read_modbus_data( registers=step[1] )
+    elif step[0] == "write":
+      result = api.write_register( step[1], step[2], verify=cfg.get("COMMANDS_VERIFY", True) )
+    elif step[0] == "check":
+      result = api.check_connection()
+    elif step[0] == "connect":
+      result = api.connect()
+    elif step[2]:
+      result = step[2].wait( step[1] )
+    else:
+      result = time.sleep( step[1] )
+
+# Execute the steps with a MTECmodbusAsyncAPI (asyncio version)
+async def run_steps_async( api, steps ):
+  result = None
+  while True:
+    try:
+      step = steps.send( result )
+    except StopIteration as stop:
+      return stop.value
+    if step[0] == "read":
+      result = await api.read_modbus_data( registers=step[1] )
+    elif step[0] == "write":
+      result = await api.write_register( step[1], step[2], verify=cfg.get("COMMANDS_VERIFY", True) )
+    elif step[0] == "check":
+      result = await api.check_connection()
+    elif step[0] == "connect":
+      result = await api.connect()
+    elif step[2]:
+      result = await step[2].wait_async( step[1] )
+    else:
+      result = await asyncio.sleep( step[1] )
+
+#----------------------------------
+# MQTT publisher task of the asyncio engine: publishes the queued group data, 
+# so that the next Modbus read doesn't have to wait for the publishing
+async def mqtt_publisher( queue ):
+  loop = asyncio.get_event_loop()
+  while True:
+    pvdata, base_topic = await queue.get()
+    try:
+      await loop.run_in_executor( None, write_to_MQTT, pvdata, base_topic )
+    except Exception as e:
+      logging.error("Error while publishing to MQTT: {}".format(str(e)))
+    queue.task_done()
+    metrics.set_gauge( "mtec_publish_queue_depth", queue.qsize() )
+
+#==========================================
+# List of inverters to poll: INVERTERS from config.yaml, or a single inverter using the global MODBUS_* settings
+def get_inverters():
+  return cfg.get("INVERTERS") or [{}]
+
+#==========================================
+# Initialization of the daemon resp. of a worker process
+def init():
+  global run_status, publish_filter
+  run_status = True 
+
+  signal.signal(signal.SIGTERM, signal_handler)
+  signal.signal(signal.SIGINT, signal_handler)
+  if cfg['DEBUG'] == True:
+    logging.getLogger().setLevel(logging.DEBUG)
+
+  if cfg.get("MQTT_ONLY_CHANGES", False):
+    publish_filter = PublishFilter( cfg.get("MQTT_MAX_SILENCE", 300) )
+
+# Open the publish buffer and start replaying its samples (if a file is given)
+def start_publish_buffer( path ):
+  global publish_buffer
+  if not path:
+    return
+  try:
+    publish_buffer = PublishBuffer( path, max_entries=cfg.get("MQTT_BUFFER_MAX_ENTRIES", 1000000), max_age=cfg.get("MQTT_BUFFER_MAX_AGE", 7*24*3600) )
+  except Exception as e:
+    logging.error("Couldn't open publish buffer {}: {}".format(path, str(e)))
+    return
+  publish_buffer.start_drainer( cfg.get("MQTT_BUFFER_REPLAY_RATE", 50) )
+
+#==========================================
+def main():
+  init()
+  logging.info("Starting")
+
+  if cfg.get("METRICS_HTTP_PORT"):
+    metrics.start_http_server( cfg["METRICS_HTTP_PORT"], cfg.get("METRICS_HTTP_HOST", "127.0.0.1") )
+
+  workers = min( cfg.get("WORKER_PROCESSES", 0) or 0, len(get_inverters()) )
+  if workers > 1: # the inverters are sharded across worker processes
+    run_supervisor( workers )
+    return
+
+  start_publish_buffer( cfg.get("MQTT_BUFFER_FILE") )
+
+  if cfg.get("ASYNC_ENGINE", False) or len(get_inverters()) > 1: # several inverters are polled concurrently by the asyncio engine
+    asyncio.run( main_async() )
+    return
+
+  if cfg["HASS_ENABLE"]:
+    hass = HassIntegration()
+  else:
+    hass = None
+  mqttclient = mqtt_start( hass )
+
+  api = MTECmodbusAPI( get_inverters()[0] )
+  run_steps( api, poll_steps( api, hass, write_to_MQTT ) )
+
   mqtt_stop(mqttclient)
   logging.info("Exiting")
+
+#==========================================
+# asyncio engine: Modbus reads, decoding and MQTT publishing overlap
+# All inverters (default: get_inverters()) are polled concurrently and share one MQTT connection and publisher task
+async def main_async( inverters=None ):
+  logging.info("Using asyncio engine")
+
+  inverters = inverters or get_inverters()
+  multi_inverter = len(get_inverters()) > 1
+  if cfg["HASS_ENABLE"]:
+    hass_list = [ HassIntegration( multi_inverter=multi_inverter ) for inverter in inverters ]
+  else:
+    hass_list = [ None for inverter in inverters ]
+  mqttclient = mqtt_start( [hass for hass in hass_list if hass] if multi_inverter else hass_list[0] )
+
+  queue = asyncio.Queue()
+  publisher = asyncio.ensure_future( mqtt_publisher(queue) )
+
+  await asyncio.gather( *[ poll_inverter( inverter, hass, queue ) for inverter, hass in zip(inverters, hass_list) ] )
+
+  # clean up
+  await queue.join() # publish pending data
+  publisher.cancel()
+  mqtt_stop(mqttclient)
+  logging.info("Exiting")
+
+# Poll a single inverter until shutdown. Data get queued for the publisher task.
+# A failure stops the polling of this inverter only, not of the others.
+async def poll_inverter( inverter, hass, queue ):
+  def publish( pvdata, base_topic ):
+    queue.put_nowait( (pvdata, base_topic) )
+    metrics.set_gauge( "mtec_publish_queue_depth", queue.qsize() )
+
+  api = MTECmodbusAsyncAPI( inverter )
+  try:
+    await run_steps_async( api, poll_steps( api, hass, publish ) )
+  except Exception as e:
+    logging.error("Polling of inverter {} failed: {}".format(api.name, repr(e)))
+    metrics.inc( "mtec_inverter_failures_total", inverter=api.name )
+    api.disconnect()
  
+#==========================================
+# Supervisor mode: The inverters are sharded across 'workers' processes, which run the asyncio engine each.
+# Crashed (or stopped) workers get restarted. The metrics of all workers are aggregated and served by the supervisor.
+def run_supervisor( workers ):
+  inverters = get_inverters()
+  shards = [ inverters[idx::workers] for idx in range(workers) ]
+  restart_delay = cfg.get("WORKER_RESTART_DELAY", 10)
+  context = multiprocessing.get_context("spawn") # a forked worker could inherit locks held by the threads of the supervisor (metrics server, MQTT)
+  metrics_queue = context.Queue()
+  processes = {}     # worker id -> Process
+  not_before = {}    # worker id -> earliest (re)start time
+  logging.info("Supervisor: Starting {} worker processes for {} inverters".format(workers, len(inverters)))
+
+  while run_status:
+    for worker_id, shard in enumerate(shards):
+      process = processes.get(worker_id)
+      if process and process.is_alive():
+        continue
+      if process: # worker has terminated
+        logging.warning("Supervisor: Worker {} exited with code {} - restarting in {} s".format(worker_id, process.exitcode, restart_delay))
+        metrics.inc( "mtec_worker_restarts_total", worker=worker_id )
+        processes[worker_id] = None
+        not_before[worker_id] = time.monotonic() + restart_delay
+      if time.monotonic() >= not_before.get(worker_id, 0):
+        process = context.Process( target=run_worker, args=(worker_id, shard, metrics_queue), name="mtec_worker_{}".format(worker_id), daemon=True )
+        process.start()
+        processes[worker_id] = process
+
+    try: # collect metrics of the workers
+      source, snapshot = metrics_queue.get( timeout=1 )
+      metrics.set_source( source, snapshot )
+    except Empty:
+      pass
+
+  # clean up: workers shut down gracefully on SIGTERM
+  for process in processes.values():
+    if process and process.is_alive():
+      process.terminate()
+  for process in processes.values():
+    if process:
+      process.join( timeout=cfg["MODBUS_TIMEOUT"] + 10 )
+      if process.is_alive():
+        process.kill()
+  logging.info("Exiting")
+
+# Worker process: polls a shard of the inverters and pushes its metrics to the supervisor
+def run_worker( worker_id, inverters, metrics_queue ):
+  init()
+  logging.info("Worker {}: Polling {}".format(worker_id, ", ".join( str(inverter.get("NAME") or inverter.get("MODBUS_IP")) for inverter in inverters )))
+  metrics.start_push( metrics_queue, worker_id, cfg.get("WORKER_METRICS_INTERVAL", 5) )
+  if cfg.get("MQTT_BUFFER_FILE"):
+    start_publish_buffer( "{}.{}".format(cfg["MQTT_BUFFER_FILE"], worker_id) ) # one buffer file per worker
+  asyncio.run( main_async(inverters) )
+
 #---------------------------------------------------
 if __name__ == '__main__':
   main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Local Modbus simulator for M-TEC Energybutler.
+Serves the holding registers defined in registers.yaml with plausible, time-varying values.
+(c) 2024 by Christian Rödel
+"""
+from mtecmqtt.config import cfg, register_table
+from pymodbus import FramerType
+from pymodbus.datastore import ModbusBaseSlaveContext, ModbusServerContext
+from pymodbus.pdu import ExceptionResponse
+from pymodbus.server import StartAsyncTcpServer
+from datetime import datetime
+import argparse
+import asyncio
+import logging
+import math
+import random
+import struct
+import time
+
+# Fixed values of registers without a physical unit (by MQTT parameter)
+FIXED_VALUES = {
+  "serial_no": "SIMULATOR0001",
+  "firmware_version": [27, 52, 4, 0, 0, 0, 0, 0],
+  "inverter_status": 2,     # on-grid
+  "mode": 257,              # General mode
+  "grid_inject_switch": 1,
+  "grid_inject_limit": 70,
+  "on_grid_soc_switch": 1,
+  "on_grid_soc_limit": 10,
+  "off_grid_soc_switch": 1,
+  "off_grid_soc_limit": 5,
+  "battery_soh": 98,
+}
+
+# Decoding of written (numeric) registers
+_RAW_FORMATS = { "U16": ">H", "I16": ">h", "U32": ">I", "I32": ">i" }
+
+#=====================================================
+# Slave context which computes the register values on request
+class SimulatorContext(ModbusBaseSlaveContext):
+  #-------------------------------------------------
+  def __init__( self, latency=0, jitter=0, error_rate=0, timeout_rate=0, strict=False ):
+    self.latency = latency          # Response latency (s)
+    self.jitter = jitter            # Additional random latency (s)
+    self.error_rate = error_rate    # Probability of a SLAVE_FAILURE exception response
+    self.timeout_rate = timeout_rate # Probability of not responding at all
+    self.strict = strict            # Respond with ILLEGAL_ADDRESS for undefined registers
+    self.written = {}               # Values written by clients: address -> raw value
+    self.start = time.time()
+    self.requests = 0
+
+    # Lookup: address -> start address of the register covering it
+    self.cover = {}
+    for address, item in register_table.items():
+      for i in range(item["length"]):
+        self.cover[address+i] = address
+
+  #-------------------------------------------------
+  async def async_getValues( self, fc_as_hex, address, count=1 ):
+    self.requests += 1
+    delay = self.latency + random.uniform(0, self.jitter)
+    if random.random() < self.timeout_rate:
+      delay += cfg.get("MODBUS_TIMEOUT", 5) * 2 # let the client time out
+    if delay > 0:
+      await asyncio.sleep(delay)
+    if random.random() < self.error_rate:
+      return ExceptionResponse.SLAVE_FAILURE
+    return self.getValues(fc_as_hex, address, count)
+
+  def getValues( self, fc_as_hex, address, count=1 ):
+    now = time.time()
+    words = {}
+    for addr in range(address, address+count):
+      start = self.cover.get(addr)
+      if start is None:
+        if self.strict:
+          return ExceptionResponse.ILLEGAL_ADDRESS
+        words[addr] = 0
+      elif addr not in words:
+        for i, word in enumerate(self._encode(register_table[start], now)):
+          words[start+i] = word
+    return [ words[addr] for addr in range(address, address+count) ]
+
+  def setValues( self, fc_as_hex, address, values ):
+    for i in range(len(values)):
+      start = self.cover.get(address+i)
+      if start is None or not register_table[start]["writable"]:
+        return ExceptionResponse.ILLEGAL_ADDRESS
+    for i, value in enumerate(values):
+      self.written[address+i] = value
+    return None
+
+  #-------------------------------------------------
+  # Encode the current value of a register as list of 16 bit words
+  def _encode( self, item, now ):
+    length = item["length"]
+    value = self._value(item, now)
+    if item["type"] in ("U16", "I16", "U32", "I32"):
+      raw = int(round(value * item["scale"]))
+      if item["type"] == "U16":
+        data = struct.pack(">H", min(max(raw, 0), 0xffff))
+      elif item["type"] == "I16":
+        data = struct.pack(">h", min(max(raw, -0x8000), 0x7fff))
+      elif item["type"] == "U32":
+        data = struct.pack(">I", min(max(raw, 0), 0xffffffff))
+      else:
+        data = struct.pack(">i", min(max(raw, -0x80000000), 0x7fffffff))
+    elif item["type"] == "STR":
+      data = str(value).encode("utf-8")[:2*length]
+    elif item["type"] in ("BYTE", "DAT"):
+      data = bytes(value)[:2*length]
+    else: # BIT
+      data = b""
+    data = data.ljust(2*length, b"\x00")
+    return list(struct.unpack(">{}H".format(length), data))
+
+  # Plausible value of a register at time 'now' (already scaled, i.e. in its unit)
+  def _value( self, item, now ):
+    mqtt = item["mqtt"] or ""
+    if item["address"] in self.written:
+      words = [ self.written.get(item["address"]+i, 0) for i in range(item["length"]) ]
+      raw = struct.unpack(_RAW_FORMATS[item["type"]], struct.pack(">{}H".format(len(words)), *words))[0]
+      return raw / item["scale"]
+    if mqtt in FIXED_VALUES:
+      return FIXED_VALUES[mqtt]
+    if item["type"] == "DAT":
+      t = datetime.fromtimestamp(now)
+      return [ t.year % 100, t.month, t.day, t.hour, t.minute, t.second ]
+
+    t = datetime.fromtimestamp(now)
+    hour = t.hour + t.minute/60 + t.second/3600
+    sun = max(0, math.sin(math.pi * (hour-6) / 12)) # 0 at night, 1 at noon
+    wave = math.sin(now / 60 + item["address"]) # slow variation, individual phase per register
+    noise = random.uniform(-0.02, 0.02)
+    unit = item["unit"]
+    if unit == "W":
+      if "pv" in mqtt:
+        return 5000 * sun * (1 + noise)
+      if "grid" in mqtt or "battery" in mqtt:
+        return 2000 * wave * (1 + noise)
+      return 1500 + 500 * wave
+    if unit == "V":
+      if "cell" in mqtt:
+        return 3.3 + 0.05 * wave
+      if "battery" in mqtt:
+        return 410 + 10 * wave
+      if "pv" in mqtt:
+        return (350 + 20 * wave) if sun > 0 else 0
+      if "_b_" in mqtt or "_c_" in mqtt or mqtt.endswith("_a_b"): # line voltages
+        return 400 + 3 * wave
+      return 230 + 2 * wave
+    if unit == "A":
+      return 5 + 3 * wave
+    if unit == "Hz":
+      return 50 + 0.05 * wave
+    if unit == "%":
+      return 50 + 40 * math.sin(now / 3600)
+    if unit == "°C":
+      return 30 + 5 * wave
+    if unit == "kWh":
+      if item["group"] == "day":
+        return 3 * hour * (1 + item["address"] % 7 / 10)
+      return 10000 + (now - self.start) / 3600 * (1 + item["address"] % 7 / 10)
+    if unit == "h":
+      return 5000 + (now - self.start) / 3600
+    return 0
+
+#-----------------------------
+def parse_options():
+  parser = argparse.ArgumentParser(description='MTEC Modbus simulator. Serves the registers defined in registers.yaml with simulated values.',
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument( '--host', default="127.0.0.1", help='Address to listen on' )
+  parser.add_argument( '-p', '--port', type=int, default=cfg.get('MODBUS_PORT', 5743), help='Port to listen on' )
+  parser.add_argument( '-s', '--slave', type=int, default=cfg.get('MODBUS_SLAVE', 252), help='Modbus slave id' )
+  parser.add_argument( '--framer', default=cfg.get("MODBUS_FRAMER", "rtu"), help='Modbus framer' )
+  parser.add_argument( '-l', '--latency', type=float, default=0, help='Response latency (ms)' )
+  parser.add_argument( '-j', '--jitter', type=float, default=0, help='Additional random latency (ms)' )
+  parser.add_argument( '-e', '--error-rate', type=float, default=0, help='Probability (0..1) of an exception response' )
+  parser.add_argument( '-t', '--timeout-rate', type=float, default=0, help='Probability (0..1) of not responding in time' )
+  parser.add_argument( '--strict', action='store_true', help='Respond with ILLEGAL ADDRESS when undefined registers are read' )
+  return parser.parse_args()
+
+# Start simulator server with the given SimulatorContext (runs until cancelled)
+async def run_simulator( context, host, port, slave, framer="rtu" ):
+  server_context = ModbusServerContext(slaves={ slave: context }, single=False)
+  logging.info("Modbus simulator listening on {}:{} (slave={}, framer={})".format(host, port, slave, framer))
+  await StartAsyncTcpServer(server_context, address=(host, port), framer=FramerType(framer))
+
+#-------------------------------
+def main():
+  logging.basicConfig( level=logging.INFO, format="[%(levelname)s] %(message)s" )
+  args = parse_options()
+  try:
+    context = SimulatorContext( latency=args.latency/1000, jitter=args.jitter/1000, error_rate=args.error_rate, 
+                                timeout_rate=args.timeout_rate, strict=args.strict )
+    asyncio.run( run_simulator( context, args.host, args.port, args.slave, args.framer ) )
+  except KeyboardInterrupt:
+    pass
+  logging.info("Simulator stopped")
+
+#-------------------------------
+if __name__ == '__main__':
+  main()
@@ -8,7 +8,7 @@ import logging
 FORMAT = '[%(levelname)s] %(message)s'
 logging.basicConfig(format=FORMAT, level=logging.INFO)
 
-from mtecmqtt.config import cfg, register_map, register_groups
+from mtecmqtt.config import cfg, register_groups, register_table, pseudo_registers
 from mtecmqtt.MTECmodbusAPI import MTECmodbusAPI
 
 #-------------------------------
@@ -48,8 +48,8 @@ def write_register(api):
   print( "Current settings of writable registers:" )
   print( "Reg   Name                           Value  Unit" )
   print( "----- ------------------------------ ------ ----" )
-  register_map_sorted = dict(sorted(register_map.items()))
-  for register, item in register_map_sorted.items():
+  for item in register_table.values(): # sorted by address
+    register = item["register"]
     if item["writable"]: 
       data = api.read_modbus_data( registers=[register] )
       value = ""
@@ -78,10 +78,8 @@ def list_register_config(api):
   print( "-------------------------------------" )
   print( "Reg   MQTT Parameter                 Unit Mode Group           Name                   " )
   print( "----- ------------------------------ ---- ---- --------------- -----------------------" )
-  register_map_sorted = dict(sorted(register_map.items()))
-  for register, item in register_map_sorted.items():
-    if not register.isnumeric(): # non-numeric registers are deemed to be calculated pseudo-registers
-      register = "" 
+  for item in list(register_table.values()) + list(pseudo_registers.values()): # sorted by address, pseudo-registers last
+    register = item["register"] if item["address"] is not None else ""
     mqtt = item["mqtt"] if item["mqtt"] else ""
     unit = item["unit"] if item["unit"] else ""
     group = item["group"] if item["group"] else ""
@@ -96,11 +94,9 @@ def list_register_config_by_groups(api):
     print( "" )
     print( "Reg   MQTT Parameter                 Unit Mode Name                   " )
     print( "----- ------------------------------ ---- ---- -----------------------" )
-    register_map_sorted = dict(sorted(register_map.items()))
-    for register, item in register_map_sorted.items():
+    for item in list(register_table.values()) + list(pseudo_registers.values()): # sorted by address, pseudo-registers last
       if item["group"]==group: 
-        if not register.isnumeric(): # non-nu1meric registers are deemed to be calculated pseudo-registers
-          register = "" 
+        register = item["register"] if item["address"] is not None else ""
         mqtt = item["mqtt"] if item["mqtt"] else ""
         unit = item["unit"] if item["unit"] else ""
         mode = "RW" if item["writable"] else "R"
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Drift-free deadline scheduler for register groups
+(c) 2024 by Christian Rödel
+"""
+import time
+import logging
+from mtecmqtt import metrics
+
+#=====================================================
+class GroupScheduler:
+  #-------------------------------------------------
+  # tick: Base period (s). Deadlines which are due within the same tick get served together.
+  def __init__( self, tick ):
+    self.tick = tick
+    self.base_tick = tick
+    self.rate_factor = 1.0
+    self.start = time.monotonic()
+    self.groups = {}
+
+  #-------------------------------------------------
+  # Add a group to the schedule
+  # interval: Period (s), offset: Phase of first deadline (s), heavy: Don't serve with other heavy groups in the same tick
+  # priority: Groups which are due in the same tick are served in ascending order of priority 
+  def add_group( self, group, interval, offset=0, heavy=False, priority=0 ):
+    self.groups[group] = {
+      "interval": interval * self.rate_factor,
+      "base_interval": interval,
+      "priority": priority,
+      "deadline": self.start + offset, # next deadline (monotonic clock)
+      "last_deadline": None,           # deadline served last
+      "not_before": 0,                 # postponed (retry or spreading) until this time
+      "heavy": heavy,
+      "runs": 0,
+      "missed": 0,
+      "max_lateness": 0,
+    }
+
+  #-------------------------------------------------
+  # Return the list of groups which are due now. Their deadlines get advanced on a fixed grid,
+  # so that the time spent for reading and publishing doesn't accumulate as drift.
+  def get_due_groups( self ):
+    now = time.monotonic()
+    due = [ (item["priority"], item["deadline"], group) for group, item in self.groups.items() if self._next_time(item) <= now + self.tick/2 ]
+    groups = []
+    heavy_served = False
+    for priority, deadline, group in sorted(due):
+      item = self.groups[group]
+      if item["heavy"]:
+        if heavy_served: # spread heavy groups: serve at next tick
+          item["not_before"] = now + self.tick
+          continue
+        heavy_served = True
+
+      lateness = max(0, now - deadline)
+      item["max_lateness"] = max(item["max_lateness"], lateness)
+      if lateness >= item["interval"]: # whole periods have been skipped
+        missed = int(lateness // item["interval"])
+        item["missed"] += missed
+        metrics.inc("mtec_scheduler_missed_deadlines_total", missed, group=group)
+        logging.warning("Scheduler: Group {} missed {} deadline(s) ({:.1f}s late)".format(group, missed, lateness))
+        deadline += missed * item["interval"]
+      item["last_deadline"] = deadline
+      item["deadline"] = deadline + item["interval"]
+      item["runs"] += 1
+      groups.append(group)
+    return groups
+
+  #-------------------------------------------------
+  # Re-schedule a group for the next tick (e.g. after a failed read), keeping its deadline grid
+  # Groups which are polled every tick anyway (or are not scheduled at all) are not affected 
+  def retry( self, group ):
+    item = self.groups.get(group)
+    if item and item["last_deadline"] is not None and item["interval"] > self.tick:
+      item["deadline"] = item["last_deadline"]
+      item["not_before"] = time.monotonic() + self.tick
+
+  #-------------------------------------------------
+  # Stretch (factor > 1) or shorten (factor < 1) all intervals relative to the configured ones.
+  # The next deadline of each group gets moved accordingly.
+  def set_rate_factor( self, factor ):
+    if factor == self.rate_factor:
+      return
+    self.rate_factor = factor
+    self.tick = self.base_tick * factor
+    for item in self.groups.values():
+      item["interval"] = item["base_interval"] * factor
+      if item["last_deadline"] is not None:
+        item["deadline"] = item["last_deadline"] + item["interval"]
+
+  #-------------------------------------------------
+  # Time (s) until the next deadline is due
+  def get_sleep_time( self ):
+    if not self.groups:
+      return self.tick
+    next_time = min( self._next_time(item) for item in self.groups.values() )
+    return max(0, next_time - time.monotonic())
+
+  def _next_time( self, item ):
+    return max(item["deadline"], item["not_before"])
+
+  # Total number of missed deadlines
+  def get_missed_deadlines( self ):
+    return sum( item["missed"] for item in self.groups.values() )
+
+  #-------------------------------------------------
+  # Statistics per group for diagnostics
+  def get_stats( self ):
+    return { group: { "runs": item["runs"], "missed": item["missed"], "max_lateness": item["max_lateness"], "interval": item["interval"] } for group, item in self.groups.items() }
+
+#=====================================================
+# Controller for the polling rate: backs off quickly if the Modbus requests get slow or fail, 
+# or if the polling can't keep up with the schedule, and speeds up slowly while there is headroom (AIMD). The result is the factor for GroupScheduler.set_rate_factor
+class AdaptiveRate:
+  #-------------------------------------------------
+  # target_latency: Max. average latency (s) of a Modbus request, max_error_rate: Max. share of failed requests
+  # min_factor, max_factor: Bounds of the factor, window: Min. number of requests between two adjustments
+  def __init__( self, target_latency, max_error_rate=0.05, min_factor=0.5, max_factor=4, window=10 ):
+    self.target_latency = target_latency
+    self.max_error_rate = max_error_rate
+    self.min_factor = min_factor
+    self.max_factor = max_factor
+    self.window = window
+    self.factor = 1.0
+    self.next_update = window
+    self.missed = 0
+
+  #-------------------------------------------------
+  # Adjust the factor to the current request statistics (see MTECmodbusAPI.get_request_stats) 
+  # and the number of missed deadlines of the scheduler. Returns the factor.
+  def update( self, latency, error_rate, requests, missed=0 ):
+    if requests < self.next_update:
+      return self.factor
+    self.next_update = requests + self.window
+    latency = latency or 0 # no successful request yet
+    overloaded = missed > self.missed
+    self.missed = missed
+    factor = self.factor
+    if error_rate > self.max_error_rate or latency > self.target_latency or overloaded:
+      factor = min(self.max_factor, factor * 1.5)
+    elif error_rate < self.max_error_rate / 2 and latency < self.target_latency * 0.7:
+      factor = max(self.min_factor, factor - 0.1)
+    factor = round(factor, 2)
+    if factor != self.factor:
+      logging.info("Adaptive polling: Latency {:.3f}s, error rate {:.1%}{} - polling intervals x{:.2f}".format(latency, error_rate, ", missed deadlines" if overloaded else "", factor))
+      self.factor = factor
+    return self.factor
@@ -46,7 +46,7 @@ class MTECmodbusAPI:
 #--------------------------------
 # The main() function is just a demo code how to use the API
 def main():
-  logging.basicConfig()
+  logging.basicConfig( level=logging.INFO, format="[%(levelname)s] %(filename)s: %(message)s" )
   logging.getLogger().setLevel(logging.DEBUG)
 
   print( "Please enter" )
@@ -0,0 +1,63 @@
+"""
+Test setup: config.yaml gets created from config-template.yaml in a temporary config directory,
+caches (register map, ports) go to a temporary cache directory - so the tests don't depend on a local installation.
+(c) 2024 by Christian Rödel
+"""
+import os
+import shutil
+import tempfile
+
+_tmp_dir = tempfile.mkdtemp(prefix="mtecmqtt-test-")
+os.environ["XDG_CONFIG_HOME"] = os.path.join(_tmp_dir, "config")
+os.environ["XDG_CACHE_HOME"] = os.path.join(_tmp_dir, "cache")
+os.makedirs(os.path.join(_tmp_dir, "config", "mtecmqtt"))
+shutil.copy( os.path.join(os.path.dirname(__file__), "..", "src", "mtecmqtt", "config-template.yaml"), 
+             os.path.join(_tmp_dir, "config", "mtecmqtt", "config.yaml") )
+
+import pytest
+import types
+
+#-------------------------------------------------
+# Stand-in for a pymodbus read response
+def modbus_result( registers ):
+  return types.SimpleNamespace( registers=list(registers), isError=lambda: False )
+
+@pytest.fixture
+def api():
+  from mtecmqtt.MTECmodbusAPI import MTECmodbusAPI
+  return MTECmodbusAPI( { "MODBUS_RETRY_BACKOFF": 0 } )
+
+# Modbus simulator serving on a free local port: yields (SimulatorContext, port)
+@pytest.fixture(scope="module")
+def simulator():
+  import asyncio
+  import socket
+  import threading
+  import time
+  from mtecmqtt.config import cfg
+  from mtecmqtt.mtec_simulator import SimulatorContext, run_simulator
+  with socket.socket() as sock:
+    sock.bind( ("127.0.0.1", 0) )
+    port = sock.getsockname()[1]
+  context = SimulatorContext()
+  loop = asyncio.new_event_loop()
+  task = loop.create_task( run_simulator( context, "127.0.0.1", port, cfg["MODBUS_SLAVE"] ) )
+  thread = threading.Thread( target=loop.run_forever, daemon=True )
+  thread.start()
+  for _ in range(100): # wait until the server accepts connections
+    with socket.socket() as sock:
+      if sock.connect_ex( ("127.0.0.1", port) ) == 0:
+        break
+    time.sleep(0.05)
+  yield context, port
+  loop.call_soon_threadsafe( task.cancel )
+  for _ in range(100):
+    if task.done():
+      break
+    time.sleep(0.05)
+  loop.call_soon_threadsafe( loop.stop )
+  thread.join( timeout=5 )
+
+# Settings for an API connected to the simulator
+def simulator_settings( port, **settings ):
+  return dict( { "MODBUS_IP": "127.0.0.1", "MODBUS_PORT": port, "MODBUS_PORT2": port, "MODBUS_TIMEOUT": 1, "MODBUS_RETRY_BACKOFF": 0 }, **settings )
@@ -0,0 +1,35 @@
+"""
+Adaptive polling: AdaptiveRate and the rate factor of the GroupScheduler
+"""
+from mtecmqtt.scheduler import GroupScheduler, AdaptiveRate
+
+#-------------------------------------------------
+def test_rate_factor():
+  scheduler = GroupScheduler( tick=10 )
+  scheduler.add_group( "config", interval=60 )
+  scheduler.get_due_groups()
+  scheduler.set_rate_factor( 2 )
+  assert scheduler.tick == 20
+  assert scheduler.groups["config"]["interval"] == 120
+  assert scheduler.groups["config"]["deadline"] == scheduler.start + 120
+
+#-------------------------------------------------
+def test_adaptive_rate_backs_off():
+  rate = AdaptiveRate( target_latency=0.1, window=10 )
+  assert rate.update( 0.5, 0, 10 ) == 1.5
+  assert rate.update( 0.5, 0, 15 ) == 1.5 # within the window
+  assert rate.update( 0.5, 0, 20 ) == 2.25
+  assert rate.update( 0.05, 0.5, 30 ) == 3.38 # errors
+  assert rate.update( 0.05, 0.5, 40 ) == 4 # max_factor
+
+def test_adaptive_rate_speeds_up():
+  rate = AdaptiveRate( target_latency=0.1, min_factor=0.8, window=10 )
+  assert rate.update( 0.01, 0, 10 ) == 0.9
+  assert rate.update( 0.01, 0, 20 ) == 0.8
+  assert rate.update( 0.01, 0, 30 ) == 0.8 # min_factor
+  assert rate.update( 0.08, 0, 40 ) == 0.8 # no headroom: unchanged
+
+def test_adaptive_rate_missed_deadlines():
+  rate = AdaptiveRate( target_latency=0.1, window=10 )
+  assert rate.update( 0.08, 0, 10, missed=2 ) == 1.5
+  assert rate.update( 0.08, 0, 20, missed=2 ) == 1.5 # no new missed deadlines
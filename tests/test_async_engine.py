@@ -0,0 +1,40 @@
+"""
+asyncio engine: async Modbus API and the polling cycle shared with the sync engine
+"""
+from mtecmqtt import mtec_mqtt
+from mtecmqtt.config import cfg
+from mtecmqtt.MTECmodbusAPI import MTECmodbusAPI
+from mtecmqtt.MTECmodbusAsyncAPI import MTECmodbusAsyncAPI
+from conftest import simulator_settings
+import asyncio
+
+#-------------------------------------------------
+def test_async_read_matches_sync( simulator ):
+  registers = mtec_mqtt.get_group_registers( "config" )
+  api = MTECmodbusAPI( simulator_settings( simulator[1] ) )
+  assert api.connect()
+  data = api.read_modbus_data( registers=registers )
+  api.disconnect()
+
+  async def read():
+    api = MTECmodbusAsyncAPI( simulator_settings( simulator[1] ) )
+    assert await api.connect()
+    data = await api.read_modbus_data( registers=registers )
+    api.disconnect()
+    return data
+  async_data = asyncio.run( read() )
+  assert { register: item["value"] for register, item in async_data.items() } == { register: item["value"] for register, item in data.items() }
+
+def test_async_poll_cycle( simulator, monkeypatch ):
+  monkeypatch.setitem( cfg, "POLL_SCHEDULE", { "now-base": { "interval": 0.1 }, "day": { "interval": 0.1 } } )
+  monkeypatch.setattr( mtec_mqtt, "run_status", True, raising=False )
+  published = {}
+  def publish( pvdata, base_topic ): # stop after the first cycle
+    published[base_topic] = pvdata
+    mtec_mqtt.run_status = False
+
+  api = MTECmodbusAsyncAPI( simulator_settings( simulator[1] ) )
+  asyncio.run( mtec_mqtt.run_steps_async( api, mtec_mqtt.poll_steps( api, None, publish ) ) )
+  assert set(published) == { cfg["MQTT_TOPIC"] + "/SIMULATOR0001/now-base/", cfg["MQTT_TOPIC"] + "/SIMULATOR0001/day/" }
+  assert "grid_power" in published[cfg["MQTT_TOPIC"] + "/SIMULATOR0001/now-base/"]
+  assert not api.is_connected()
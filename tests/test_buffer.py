@@ -0,0 +1,52 @@
+"""
+PublishBuffer: bounded ring of samples and replay
+"""
+from mtecmqtt import buffer
+from mtecmqtt.buffer import PublishBuffer
+import json
+import pytest
+
+@pytest.fixture
+def published( monkeypatch ):
+  published = []
+  def mqtt_publish( topic, payload ):
+    published.append( (topic, payload) )
+    return True
+  monkeypatch.setattr( buffer, "mqtt_publish", mqtt_publish )
+  monkeypatch.setattr( buffer, "mqtt_is_connected", lambda: True )
+  return published
+
+#-------------------------------------------------
+def test_oldest_samples_dropped( tmp_path, published ):
+  publish_buffer = PublishBuffer( str(tmp_path / "buffer.db"), max_entries=3 )
+  publish_buffer.add( [ ("MTEC/123/now-base/pv", str(idx)) for idx in range(5) ] )
+  assert publish_buffer.entries == 3
+  assert publish_buffer.replay( 10 ) == 3
+  assert [ json.loads(payload)["value"] for topic, payload in published ] == [ "2", "3", "4" ]
+
+def test_replay_topic_and_payload( tmp_path, published ):
+  publish_buffer = PublishBuffer( str(tmp_path / "buffer.db") )
+  publish_buffer.add( [ ("MTEC/123/now-base/pv", "1234"), ("MTEC/123/now-base", '{"timestamp":"2024-01-01 12:00:00","pv":1234}') ] )
+  assert publish_buffer.replay( 1 ) == 1
+  assert publish_buffer.replay( 10 ) == 1
+  assert published[0][0] == "MTEC/replay/123/now-base/pv"
+  assert published[0][1].startswith('{"timestamp":') and published[0][1].endswith(',"value":"1234"}')
+  assert published[1] == ( "MTEC/replay/123/now-base", '{"timestamp":"2024-01-01 12:00:00","pv":1234}' )
+  assert publish_buffer.entries == 0
+
+def test_kept_while_disconnected( tmp_path, published, monkeypatch ):
+  publish_buffer = PublishBuffer( str(tmp_path / "buffer.db") )
+  publish_buffer.add( [ ("MTEC/123/now-base/pv", "1") ] )
+  monkeypatch.setattr( buffer, "mqtt_is_connected", lambda: False ) # connection lost while publishing
+  assert publish_buffer.replay( 10 ) == 0
+  assert publish_buffer.entries == 1
+
+def test_persistent( tmp_path, published ):
+  PublishBuffer( str(tmp_path / "buffer.db") ).add( [ ("MTEC/123/now-base/pv", "1") ] )
+  assert PublishBuffer( str(tmp_path / "buffer.db") ).entries == 1
+
+def test_expired_samples_dropped( tmp_path, published ):
+  publish_buffer = PublishBuffer( str(tmp_path / "buffer.db"), max_age=-1 )
+  publish_buffer.add( [ ("MTEC/123/now-base/pv", "1") ] )
+  publish_buffer.expire()
+  assert publish_buffer.entries == 0
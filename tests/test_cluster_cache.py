@@ -0,0 +1,25 @@
+"""
+Cache of cluster plans
+"""
+from mtecmqtt.config import register_table
+from mtecmqtt.MTECmodbusAPI import MTECmodbusAPI
+from mtecmqtt import metrics
+
+def cache_misses( api ):
+  return metrics.get_snapshot()[0].get( metrics._key("mtec_cluster_cache_misses_total", { "inverter": api.name }), 0 )
+
+#-------------------------------------------------
+def test_cluster_cache_order_independent( api ):
+  registers = [ item["register"] for item in register_table.values() ][:10]
+  assert api._get_register_clusters( registers ) is api._get_register_clusters( list(reversed(registers)) )
+
+def test_least_recently_used_evicted():
+  api = MTECmodbusAPI( { "MODBUS_CLUSTER_CACHE_SIZE": 2 } )
+  registers = [ item["register"] for item in register_table.values() ]
+  misses = cache_misses( api )
+  first = api._get_register_clusters( registers[:1] )
+  api._get_register_clusters( registers[:2] )
+  api._get_register_clusters( registers[:3] )
+  assert len(api._cluster_cache) == 2
+  assert api._get_register_clusters( registers[:1] ) is not first
+  assert cache_misses( api ) - misses == 4
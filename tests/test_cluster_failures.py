@@ -0,0 +1,127 @@
+"""
+Failure handling of clusters: retries, splitting, merging back and quarantine
+"""
+from mtecmqtt.config import register_table
+from mtecmqtt.MTECmodbusAPI import MTECmodbusAPI
+from mtecmqtt.MTECmodbusAsyncAPI import MTECmodbusAsyncAPI
+from conftest import modbus_result
+import asyncio
+
+#-------------------------------------------------
+# Modbus server stand-in: requests which include one of the 'bad' addresses fail
+class FakeServer:
+  def __init__( self, bad ):
+    self.bad = set(bad)
+    self.requests = []
+
+  def read( self, api, start, length ):
+    self.requests.append( (start, length) )
+    api.connection_error = False
+    if any( start <= address < start + length for address in self.bad ):
+      return None
+    return modbus_result( [0] * length )
+
+def create_api( server, cls=MTECmodbusAPI, **settings ):
+  api = cls( dict( { "MODBUS_RETRY_BACKOFF": 0, "MODBUS_CLUSTER_RETRIES": 1 }, **settings ) )
+  if cls is MTECmodbusAsyncAPI:
+    async def read_registers( start, length ):
+      return server.read( api, start, length )
+  else:
+    read_registers = lambda start, length: server.read( api, start, length )
+  api._read_registers = read_registers
+  return api
+
+# Registers of the first cluster with at least 3 registers, and the address of its middle register 
+def cluster_registers( api ):
+  cluster = next( cluster for cluster in api._create_register_clusters( frozenset(register_table) ) if len(cluster["items"]) >= 3 )
+  items = [ item for item in cluster["items"] if item["type"] is not None ]
+  return [ item["register"] for item in items ], items[len(items)//2]["address"]
+
+#-------------------------------------------------
+def test_failing_cluster_split( api ):
+  registers, bad = cluster_registers( api )
+  server = FakeServer( [bad] )
+  api = create_api( server )
+  data = api.read_modbus_data( registers=registers )
+  assert set(data) == set(registers) - { register_table[bad]["register"] }
+  assert any( "split" in cluster for cluster in api._get_register_clusters(registers) )
+
+  # the split is kept: the next read doesn't request the whole cluster again
+  server.requests.clear()
+  api.read_modbus_data( registers=registers )
+  assert all( not (start <= bad < start + length) or length == register_table[bad]["length"] for start, length in server.requests )
+
+def test_split_merged_back( api ):
+  registers, bad = cluster_registers( api )
+  server = FakeServer( [bad] )
+  api = create_api( server, MODBUS_SPLIT_CYCLES=3, MODBUS_QUARANTINE_FAILURES=10 )
+  api.read_modbus_data( registers=registers )
+  server.bad.clear() # failure was temporary
+  for cycle in range(3):
+    assert set( api.read_modbus_data( registers=registers ) ) == set(registers)
+  assert not any( "split" in cluster for cluster in api._get_register_clusters(registers) )
+
+def test_failing_register_quarantined( api ):
+  registers, bad = cluster_registers( api )
+  server = FakeServer( [bad] )
+  api = create_api( server, MODBUS_QUARANTINE_FAILURES=3 )
+  for cycle in range(3):
+    api.read_modbus_data( registers=registers )
+  assert api.get_quarantined_registers() == [bad]
+
+  server.requests.clear()
+  data = api.read_modbus_data( registers=registers )
+  assert set(data) == set(registers) - { register_table[bad]["register"] }
+  assert all( not (start <= bad < start + length) for start, length in server.requests )
+
+def test_quarantine_expires( api ):
+  registers, bad = cluster_registers( api )
+  server = FakeServer( [bad] )
+  api = create_api( server, MODBUS_QUARANTINE_FAILURES=1, MODBUS_QUARANTINE_TIME=0 )
+  api.read_modbus_data( registers=registers )
+  server.bad.clear()
+  assert set( api.read_modbus_data( registers=registers ) ) == set(registers)
+  assert api.get_quarantined_registers() == []
+
+def test_connection_error_not_split( api ):
+  registers, bad = cluster_registers( api )
+  server = FakeServer( [] )
+  api = create_api( server )
+  def read_registers( start, length ):
+    server.requests.append( (start, length) )
+    api.connection_error = True
+    return None
+  api._read_registers = read_registers
+  assert api.read_modbus_data( registers=registers ) == {}
+  assert not any( "split" in cluster for cluster in api._get_register_clusters(registers) )
+  assert api.get_quarantined_registers() == []
+
+def test_async_failing_cluster_split( api ):
+  registers, bad = cluster_registers( api )
+  server = FakeServer( [bad] )
+  api = create_api( server, MTECmodbusAsyncAPI, MODBUS_QUARANTINE_FAILURES=2 )
+  data = asyncio.run( api.read_modbus_data( registers=registers ) )
+  assert set(data) == set(registers) - { register_table[bad]["register"] }
+  asyncio.run( api.read_modbus_data( registers=registers ) )
+  assert api.get_quarantined_registers() == [bad]
+
+def test_startup_config_requires_serial_no( monkeypatch ):
+  from mtecmqtt import mtec_mqtt
+  serial_no = next( address for address, item in register_table.items() if item["mqtt"] == "serial_no" )
+  server = FakeServer( [serial_no] )
+  api = create_api( server )
+  monkeypatch.setattr( mtec_mqtt, "run_status", True, raising=False )
+  steps = mtec_mqtt.poll_steps( api, None, lambda pvdata, base_topic: None )
+  retries = 0
+  step = steps.send( None )
+  while step[0] != "check": # initialization is done, when the polling loop starts
+    if step[0] == "connect":
+      step = steps.send( True )
+    elif step[0] == "sleep":
+      retries += 1
+      server.bad.clear() # serial no. is readable on retry
+      step = steps.send( None )
+    else:
+      step = steps.send( api.read_modbus_data( registers=step[1] ) )
+  steps.close()
+  assert retries == 1
@@ -0,0 +1,66 @@
+"""
+Columnar export formats: NumPy .npy (parsed without numpy) and Parquet round trips
+"""
+from mtecmqtt.columnar import NpyWriter, ParquetWriter
+from datetime import datetime
+import ast
+import math
+import struct
+import pytest
+
+COLUMNS = [ "10000", "10105", "10994", "11022" ] # STR, U16, I32, U32
+SAMPLES = [ (datetime(2024, 5, 1, 12, 0, 0), { "10000": { "value": "SN123" }, "10105": { "value": 2 }, "10994": { "value": -1500 }, "11022": { "value": 123456 } }),
+            (datetime(2024, 5, 1, 12, 0, 10), { "10105": { "value": 3 }, "11022": { "value": 123457 } }) ]
+
+_NPY_FORMATS = { "<f4": "f", "<f8": "d" }
+
+# Read a .npy file of a structured array: returns (descr, rows)
+def load_npy( filename ):
+  with open(filename, "rb") as f:
+    assert f.read(8) == b"\x93NUMPY\x01\x00"
+    header_len, = struct.unpack( "<H", f.read(2) )
+    assert (10 + header_len) % 64 == 0 # aligned data
+    header = ast.literal_eval( f.read(header_len).decode("latin1") )
+    fmt = "<" + "".join( _NPY_FORMATS.get(dtype) or dtype[2:] + "s" for name, dtype in header["descr"] )
+    rows = [ struct.unpack(fmt, f.read(struct.calcsize(fmt))) for idx in range(header["shape"][0]) ]
+    assert f.read() == b"" # no rows beyond the count in the header
+  return header["descr"], rows
+
+#-------------------------------------------------
+def test_npy_round_trip( tmp_path ):
+  filename = str(tmp_path / "trace.npy")
+  writer = NpyWriter( filename, COLUMNS, batch_size=10 )
+  for sample in SAMPLES:
+    writer.write( sample )
+  writer.close()
+
+  descr, rows = load_npy( filename )
+  assert descr == [ ("timestamp", "<f8"), ("10000", "|S16"), ("10105", "<f4"), ("10994", "<f8"), ("11022", "<f8") ]
+  assert rows[0] == ( SAMPLES[0][0].timestamp(), b"SN123" + b"\0" * 11, 2.0, -1500.0, 123456.0 )
+  assert rows[1][:3] == ( SAMPLES[1][0].timestamp(), b"\0" * 16, 3.0 )
+  assert math.isnan( rows[1][3] ) # register not read
+  assert writer.size() == len(open(filename, "rb").read())
+
+def test_npy_valid_after_each_batch( tmp_path ):
+  filename = str(tmp_path / "trace.npy")
+  writer = NpyWriter( filename, COLUMNS, batch_size=2 )
+  for idx in range(5):
+    writer.write( SAMPLES[idx % 2] )
+  assert len( load_npy(filename)[1] ) == 4 # 2 batches written, 1 row pending
+  writer.close()
+  assert len( load_npy(filename)[1] ) == 5
+
+def test_parquet_round_trip( tmp_path ):
+  parquet = pytest.importorskip( "pyarrow.parquet" )
+  filename = str(tmp_path / "trace.parquet")
+  writer = ParquetWriter( filename, COLUMNS, batch_size=1 )
+  for sample in SAMPLES:
+    writer.write( sample )
+  writer.close()
+
+  parquet_file = parquet.ParquetFile( filename )
+  assert parquet_file.metadata.num_row_groups == 2
+  table = parquet_file.read().to_pydict()
+  assert table["10000"] == [ "SN123", None ]
+  assert table["10105"] == [ 2.0, 3.0 ]
+  assert table["10994"] == [ -1500.0, None ]
@@ -0,0 +1,37 @@
+"""
+WriteQueue: validation and coalescing of register writes
+"""
+from mtecmqtt.commands import WriteQueue
+import threading
+
+WRITABLE = "52503" # on_grid_soc_limit
+
+#-------------------------------------------------
+def test_writes_coalesced( api ):
+  write_queue = WriteQueue( api )
+  assert write_queue.put( WRITABLE, "15" )
+  assert write_queue.put( "52502", "1" )
+  assert write_queue.put( WRITABLE, "20" )
+  assert write_queue.get_batch( 10 ) == [ (WRITABLE, "20"), ("52502", "1") ] # last value wins, position is kept
+  assert write_queue.get_batch( 10 ) == []
+
+def test_invalid_writes_rejected( api ):
+  write_queue = WriteQueue( api )
+  assert not write_queue.put( WRITABLE, "abc" )
+  assert not write_queue.put( "10100", "1" )  # read-only
+  assert not write_queue.put( "99999", "1" )  # unknown
+  assert not write_queue.put( WRITABLE, "1000000" ) # out of range
+  assert write_queue.get_batch( 10 ) == []
+
+def test_batch_size_limited( api ):
+  write_queue = WriteQueue( api )
+  write_queue.put( WRITABLE, "15" )
+  write_queue.put( "52502", "1" )
+  assert write_queue.get_batch( 1 ) == [ (WRITABLE, "15") ]
+  assert write_queue.get_batch( 1 ) == [ ("52502", "1") ]
+
+def test_wait_returns_on_put( api ):
+  write_queue = WriteQueue( api )
+  threading.Timer( 0.05, write_queue.put, (WRITABLE, "15") ).start()
+  write_queue.wait( 10 )
+  assert write_queue.get_batch( 10 ) == [ (WRITABLE, "15") ]
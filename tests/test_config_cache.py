@@ -0,0 +1,38 @@
+"""
+Lazy, side-effect free config import and the cache of the register map
+"""
+from mtecmqtt import config
+import os
+import subprocess
+import sys
+import pytest
+
+#-------------------------------------------------
+def test_import_side_effect_free( tmp_path ):
+  code = ( "import logging, mtecmqtt.config as config\n"
+           "assert config.cfg._data is None and config._registers is None\n"
+           "assert not logging.getLogger().handlers\n"
+           "assert config.register_map['10000']['mqtt'] == 'serial_no'\n" )
+  env = dict( os.environ, PYTHONPATH=os.path.join(os.path.dirname(__file__), "..", "src"), XDG_CACHE_HOME=str(tmp_path) )
+  subprocess.run( [sys.executable, "-c", code], env=env, cwd=str(tmp_path), check=True, stdin=subprocess.DEVNULL )
+
+def test_register_map_cached( monkeypatch ):
+  if os.path.exists( config.get_cache_file("registers.pickle") ):
+    os.remove( config.get_cache_file("registers.pickle") )
+  registers = config.load_register_map()
+  assert os.path.exists( config.get_cache_file("registers.pickle") )
+  monkeypatch.setattr( config, "init_register_map", lambda: pytest.fail("registers.yaml parsed again") )
+  cached = config.load_register_map()
+  assert cached[0] == registers[0] and cached[1] == registers[1]
+  assert list(cached[3]) == list(registers[3]) # evaluation order of the pseudo-registers
+
+def test_outdated_cache_ignored( monkeypatch ):
+  config.load_register_map()
+  parsed = []
+  init_register_map = config.init_register_map
+  monkeypatch.setattr( config, "init_register_map", lambda: parsed.append(True) or init_register_map() )
+  monkeypatch.setattr( config, "REGISTER_CACHE_VERSION", config.REGISTER_CACHE_VERSION + 1 )
+  config.load_register_map()
+  assert parsed
+  config.load_register_map() # the cache got updated
+  assert len(parsed) == 1
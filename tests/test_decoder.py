@@ -0,0 +1,61 @@
+"""
+The precompiled cluster decoder must deliver the same values as the former per-register decoding
+"""
+from mtecmqtt.config import register_table
+from pymodbus.client import ModbusTcpClient
+from conftest import modbus_result
+import random
+
+#-------------------------------------------------
+# Per-register decoding as it was done before the decoder got precompiled
+def legacy_decode( registers, offset, item ):
+  convert = ModbusTcpClient.convert_from_registers
+  DATATYPE = ModbusTcpClient.DATATYPE
+  regs = [ int(reg) for reg in registers[offset:offset+item["length"]] ]
+  if item["type"] in ("U16", "I16", "U32", "I32"):
+    size = 1 if item["type"][1:] == "16" else 2
+    data_type = { "U16": DATATYPE.UINT16, "I16": DATATYPE.INT16, "U32": DATATYPE.UINT32, "I32": DATATYPE.INT32 }[item["type"]]
+    val = convert( registers=regs[:size], data_type=data_type )
+  elif item["type"] == "BYTE":
+    template = { 1: "{:02d} {:02d}", 2: "{:02d} {:02d}  {:02d} {:02d}", 4: "{:02d} {:02d} {:02d} {:02d}  {:02d} {:02d} {:02d} {:02d}" }[item["length"]]
+    val = template.format( *[ b for reg in regs for b in (reg>>8, reg&0xff) ] )
+  elif item["type"] == "BIT":
+    val = " ".join( "{:08b}".format(reg) for reg in regs )
+  elif item["type"] == "DAT":
+    val = "{:02d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}".format( *[ b for reg in regs[:3] for b in (reg>>8, reg&0xff) ] )
+  elif item["type"] == "STR":
+    val = convert( registers=regs, data_type=DATATYPE.STRING )
+  if val and item["scale"] > 1:
+    val /= item["scale"]
+  return { "name": item["name"], "value": val, "unit": item["unit"] }
+
+def random_registers( cluster, rnd ):
+  registers = []
+  for item in cluster["items"]:
+    for idx in range(item["length"]):
+      if item["type"] == "STR": # printable ASCII, zero padded
+        registers.append( 0 if idx >= item["length"] - 1 else rnd.randrange(0x20, 0x7f) << 8 | rnd.randrange(0x20, 0x7f) )
+      else:
+        registers.append( rnd.randrange(0, 0x10000) )
+  return registers
+
+#-------------------------------------------------
+def test_decoder_matches_legacy_decoding( api ):
+  rnd = random.Random(42)
+  clusters = api._create_register_clusters( frozenset(register_table) )
+  for run in range(20):
+    for cluster in clusters:
+      registers = random_registers( cluster, rnd )
+      data = api._decode_cluster( modbus_result(registers), cluster )
+      offset = 0
+      for item in cluster["items"]:
+        if item["type"] is not None:
+          assert data[item["register"]] == legacy_decode( registers, offset, item ), item["register"]
+        offset += item["length"]
+
+def test_all_registers_decoded( api ):
+  clusters = api._create_register_clusters( frozenset(register_table) )
+  decoded = set()
+  for cluster in clusters:
+    decoded.update( api._decode_cluster( modbus_result([0] * cluster["length"]), cluster ) )
+  assert decoded == set( item["register"] for item in register_table.values() )
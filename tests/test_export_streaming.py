@@ -0,0 +1,55 @@
+"""
+Streaming mode of mtec_export: fixed column order, rotation and stopping on signals
+"""
+from mtecmqtt import mtec_export
+from datetime import datetime, timedelta
+import json
+import os
+import signal
+import types
+
+SAMPLES = [ (datetime(2024, 5, 1, 12, 0, 0), { "10100": { "value": 1 }, "11000": { "value": 2.5 } }),
+            (datetime(2024, 5, 1, 12, 0, 10), { "11000": { "value": 3 } }) ]
+
+#-------------------------------------------------
+def test_csv_fixed_columns():
+  lines = list( mtec_export.format_csv( SAMPLES, ["11000", "10100"] ) )
+  assert lines == [ "2024-05-01 12:00:00;2.5;1", "2024-05-01 12:00:10;3;" ]
+
+def test_jsonl_fixed_keys():
+  rows = [ json.loads(line) for line in mtec_export.format_jsonl( SAMPLES, ["11000", "10100"] ) ]
+  assert list(rows[0]) == [ "timestamp", "11000", "10100" ]
+  assert rows[1] == { "timestamp": "2024-05-01 12:00:10", "11000": 3, "10100": None }
+
+def test_rotation_by_size( tmp_path ):
+  lines = [ "{:09d}".format(idx) for idx in range(10) ] # 10 bytes per line
+  mtec_export.write_rotating( lines, str(tmp_path / "trace.csv"), lambda filename: mtec_export.TextWriter(filename, "header"), rotate_size=35 )
+  files = sorted( os.listdir(tmp_path) )
+  assert len(files) == 4 # header + 3 lines per file
+  contents = [ (tmp_path / filename).read_text().splitlines() for filename in files ]
+  assert all( content[0] == "header" for content in contents )
+  assert [ line for content in contents for line in content[1:] ] == lines
+
+def test_rotation_daily( tmp_path, monkeypatch ):
+  now = [ datetime(2024, 5, 1, 23, 59, 58) ]
+  def records():
+    for idx in range(4):
+      yield str(idx)
+      now[0] += timedelta(seconds=1)
+  monkeypatch.setattr( mtec_export, "datetime", types.SimpleNamespace( now=lambda: now[0] ) )
+  mtec_export.write_rotating( records(), str(tmp_path / "trace.csv"), lambda filename: mtec_export.TextWriter(filename), rotate_daily=True )
+  assert sorted( os.listdir(tmp_path) ) == [ "trace-20240501_235958.csv", "trace-20240502_000000.csv" ]
+  assert (tmp_path / "trace-20240502_000000.csv").read_text() == "2\n3\n"
+
+def test_poll_stops_on_signal():
+  api = types.SimpleNamespace( read_modbus_data=lambda registers: { "11000": { "value": 1 } } )
+  samples = []
+  try:
+    for sample in mtec_export.poll( api, ["11000"], 0 ):
+      samples.append( sample )
+      if len(samples) == 3: # SIGTERM (e.g. systemctl stop) during the export of a sample
+        mtec_export.signal_handler( signal.SIGTERM, None )
+      assert len(samples) <= 3
+  finally:
+    mtec_export.stop.clear()
+  assert len(samples) == 3
@@ -0,0 +1,42 @@
+"""
+Expressions of calculated pseudo-registers: evaluation and whitelist
+"""
+from mtecmqtt.expressions import parse_expression, compile_expression
+from mtecmqtt.config import pseudo_registers, register_map
+import pytest
+
+#-------------------------------------------------
+def test_references_replaced_by_arguments():
+  source, dependencies = parse_expression( "{11016} - {11000} + {11016}" )
+  assert dependencies == [ "11016", "11000" ]
+  assert source == "_0 - _1 + _0"
+
+def test_compiled_expression():
+  function, dependencies = compile_expression( "max(0, 100 * {a} / {b}) if {b} else 0" )
+  assert dependencies == [ "a", "b" ]
+  assert function( 5, 20 ) == 25
+  assert function( 5, 0 ) == 0
+  assert function( -5, 20 ) == 0
+
+@pytest.mark.parametrize("expression", [
+  "__import__('os').system('true')",          # function which isn't whitelisted
+  "{a}.__class__",                            # attribute access
+  "[x for x in ({a},)]",                      # comprehension
+  "{a}[0]",                                   # subscript
+  "lambda: {a}",                              # lambda
+  "a + 1",                                    # name which isn't a register reference
+  "{a} +",                                    # syntax error
+])
+def test_invalid_expression_rejected( expression ):
+  with pytest.raises(ValueError):
+    parse_expression( expression )
+
+def test_no_builtins():
+  function, dependencies = compile_expression( "abs({a})" )
+  assert function.__globals__["__builtins__"] == {}
+
+def test_registers_yaml_expressions_valid():
+  assert pseudo_registers
+  for register, item in pseudo_registers.items():
+    compile_expression( item["expression"] )
+    assert all( register_map[source]["address"] is not None for source in item["sources"] ), register
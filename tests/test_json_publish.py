@@ -0,0 +1,49 @@
+"""
+JSON publish mode: one document per group and matching home assistant value templates
+"""
+from mtecmqtt import mtec_mqtt
+from mtecmqtt.config import cfg, register_map
+from mtecmqtt.hass_int import HassIntegration
+import json
+import pytest
+
+BASE_TOPIC = "MTEC/123/now-base/"
+PVDATA = { "grid_power": { "value": 1234.56789 }, "battery_soc": { "value": 55 }, "backup_enabled": { "value": True } }
+
+@pytest.fixture
+def published( monkeypatch ):
+  published = []
+  monkeypatch.setattr( mtec_mqtt, "mqtt_publish", lambda topic, payload: published.append( (topic, payload) ) or True )
+  monkeypatch.setattr( mtec_mqtt, "mqtt_is_offline", lambda: False )
+  monkeypatch.setattr( mtec_mqtt, "publish_filter", None )
+  monkeypatch.setattr( mtec_mqtt, "publish_buffer", None )
+  return published
+
+#-------------------------------------------------
+def test_one_document_per_group( published, monkeypatch ):
+  monkeypatch.setitem( cfg, "MQTT_PUBLISH_MODE", "json" )
+  mtec_mqtt.write_to_MQTT( PVDATA, BASE_TOPIC )
+  assert len(published) == 1
+  topic, payload = published[0]
+  assert topic == BASE_TOPIC.rstrip("/")
+  document = json.loads( payload )
+  assert list(document) == [ "timestamp", "grid_power", "battery_soc", "backup_enabled" ]
+  assert document["grid_power"] == float( cfg["MQTT_FLOAT_FORMAT"].format(1234.56789) )
+  assert document["battery_soc"] == 55 and document["backup_enabled"] == 1
+
+def test_both_modes( published, monkeypatch ):
+  monkeypatch.setitem( cfg, "MQTT_PUBLISH_MODE", "both" )
+  mtec_mqtt.write_to_MQTT( PVDATA, BASE_TOPIC )
+  assert [ topic for topic, payload in published ] == [ BASE_TOPIC + param for param in PVDATA ] + [ BASE_TOPIC.rstrip("/") ]
+
+def test_hass_value_templates( monkeypatch ):
+  monkeypatch.setitem( cfg, "MQTT_PUBLISH_MODE", "json" )
+  monkeypatch.setattr( HassIntegration, "send_discovery_info", lambda self: None )
+  hass = HassIntegration()
+  hass.initialize( "123" )
+  sensors = { json.loads(payload)["unique_id"]: json.loads(payload) for topic, payload in hass.devices_array if "/sensor/" in topic }
+  item = next( item for item in register_map.values() if item["mqtt"] and item.get("hass_value_template") and "MTEC_" + item["mqtt"] in sensors )
+  sensor = sensors["MTEC_" + item["mqtt"]]
+  assert sensor["state_topic"] == "MTEC/123/" + item["group"]
+  assert "value_json." + item["mqtt"] in sensor["value_template"]
+  assert "| round(" in sensor["value_template"]
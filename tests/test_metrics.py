@@ -0,0 +1,46 @@
+"""
+Metrics: counters, gauges, histograms and the Prometheus-style HTTP endpoint
+"""
+from mtecmqtt import metrics
+import urllib.request
+import pytest
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+  metrics.reset()
+  yield
+  metrics.reset()
+
+#-------------------------------------------------
+def test_counters_and_gauges():
+  metrics.inc( "mtec_modbus_errors_total", cluster="10000", inverter="a" )
+  metrics.inc( "mtec_modbus_errors_total", 2, cluster="10000", inverter="a" )
+  metrics.set_gauge( "mtec_modbus_connected", 1, inverter="a" )
+  text = metrics.render()
+  assert "# TYPE mtec_modbus_errors_total counter" in text
+  assert 'mtec_modbus_errors_total{cluster="10000",inverter="a"} 3' in text
+  assert 'mtec_modbus_connected{inverter="a"} 1' in text
+
+def test_histogram_buckets_cumulative():
+  for value in (0.0005, 0.003, 0.003, 20):
+    metrics.observe( "mtec_decode_seconds", value )
+  lines = metrics.render().splitlines()
+  assert 'mtec_decode_seconds_bucket{le="0.001"} 1' in lines
+  assert 'mtec_decode_seconds_bucket{le="0.005"} 3' in lines
+  assert 'mtec_decode_seconds_bucket{le="10"} 3' in lines
+  assert 'mtec_decode_seconds_bucket{le="+Inf"} 4' in lines
+  assert "mtec_decode_seconds_count 4" in lines
+  summary = metrics.get_summary()
+  assert summary["mtec_decode_seconds_count"] == 4
+  assert summary["mtec_decode_seconds_avg"] == pytest.approx( 20.0065 / 4 )
+
+def test_http_endpoint():
+  metrics.inc( "mtec_group_retries_total", group="now-base" )
+  server = metrics.start_http_server( 0 )
+  try:
+    with urllib.request.urlopen( "http://127.0.0.1:{}/metrics".format(server.server_address[1]) ) as response:
+      text = response.read().decode("utf-8")
+  finally:
+    server.shutdown()
+  assert "# HELP mtec_group_retries_total Group reads re-scheduled after a failure" in text
+  assert 'mtec_group_retries_total{group="now-base"} 1' in text
@@ -0,0 +1,54 @@
+"""
+Publishing via the persistent MQTT client
+"""
+from mtecmqtt import mqtt
+from mtecmqtt.hass_int import HassIntegration
+import types
+import pytest
+
+#-------------------------------------------------
+# paho client stand-in which records the published messages
+class FakeClient:
+  def __init__( self ):
+    self.published = []
+
+  def publish( self, topic, payload=None, qos=0 ):
+    self.published.append( (topic, payload, qos) )
+    return types.SimpleNamespace( rc=mqtt.mqttcl.MQTT_ERR_SUCCESS )
+
+  def is_connected( self ):
+    return True
+
+@pytest.fixture
+def client( monkeypatch ):
+  client = FakeClient()
+  monkeypatch.setitem( mqtt.cfg, "MQTT_DISABLE", False )
+  monkeypatch.setattr( mqtt, "_mqtt_client", client )
+  monkeypatch.setattr( mqtt.publish, "single", lambda *args, **kwargs: pytest.fail("one-shot connection used") )
+  return client
+
+#-------------------------------------------------
+def test_publish_uses_persistent_client( client, monkeypatch ):
+  monkeypatch.setitem( mqtt.cfg, "MQTT_QOS", 1 )
+  for idx in range(80): # one cycle
+    assert mqtt.mqtt_publish( "MTEC/123/now-base/value{}".format(idx), idx )
+  assert len(client.published) == 80
+  assert client.published[0] == ("MTEC/123/now-base/value0", 0, 1)
+
+def test_discovery_info_uses_persistent_client( client ):
+  hass = HassIntegration()
+  hass.initialize( "123" )
+  assert client.published
+  assert len(client.published) == len(hass.devices_array)
+
+def test_publish_error_reported( client, monkeypatch ):
+  monkeypatch.setattr( client, "publish", lambda topic, payload=None, qos=0: types.SimpleNamespace( rc=mqtt.mqttcl.MQTT_ERR_QUEUE_SIZE ) )
+  assert not mqtt.mqtt_publish( "MTEC/123/now-base/value", 1 )
+
+def test_fallback_without_client( monkeypatch ):
+  published = []
+  monkeypatch.setitem( mqtt.cfg, "MQTT_DISABLE", False )
+  monkeypatch.setattr( mqtt, "_mqtt_client", None )
+  monkeypatch.setattr( mqtt.publish, "single", lambda topic, payload=None, **kwargs: published.append( (topic, payload) ) )
+  assert mqtt.mqtt_publish( "MTEC/123/now-base/value", 1 )
+  assert published == [ ("MTEC/123/now-base/value", 1) ]
@@ -0,0 +1,57 @@
+"""
+Multi-inverter support: per-inverter settings and concurrent polling with isolated failures
+"""
+from mtecmqtt import mtec_mqtt, metrics
+from mtecmqtt.config import cfg
+from mtecmqtt.MTECmodbusAPI import MTECmodbusAPI
+from mtecmqtt.MTECmodbusAsyncAPI import MTECmodbusAsyncAPI
+from conftest import simulator_settings
+import asyncio
+
+#-------------------------------------------------
+def test_inverter_settings():
+  api = MTECmodbusAPI( { "NAME": "garage", "MODBUS_IP": "192.168.1.50", "MODBUS_PORT": 502 } )
+  assert api.name == "garage"
+  assert api.cfg["MODBUS_IP"] == "192.168.1.50" and api.cfg["MODBUS_PORT"] == 502
+  assert api.cfg["MODBUS_SLAVE"] == cfg["MODBUS_SLAVE"] # global setting
+  assert MTECmodbusAPI( { "MODBUS_IP": "192.168.1.51" } ).name == "192.168.1.51"
+
+#-------------------------------------------------
+# Poll the inverters with the asyncio engine until 'cycles' groups have been published
+def poll( inverters, cycles, monkeypatch ):
+  reads = {} # inverter name -> reads
+  class API( MTECmodbusAsyncAPI ):
+    async def read_modbus_data( self, registers=None ):
+      reads[self.name] = reads.get(self.name, 0) + 1
+      if self.name == "broken" and reads[self.name] > 1:
+        raise RuntimeError("decoder crashed")
+      return await super().read_modbus_data( registers=registers )
+
+  published = []
+  def write_to_MQTT( pvdata, base_topic ):
+    published.append( base_topic )
+    if len(published) >= cycles:
+      mtec_mqtt.run_status = False
+
+  monkeypatch.setitem( cfg, "POLL_SCHEDULE", { "now-base": { "interval": 0.05 } } )
+  monkeypatch.setitem( cfg, "HASS_ENABLE", False )
+  monkeypatch.setattr( mtec_mqtt, "run_status", True, raising=False )
+  monkeypatch.setattr( mtec_mqtt, "MTECmodbusAsyncAPI", API )
+  monkeypatch.setattr( mtec_mqtt, "write_to_MQTT", write_to_MQTT )
+  monkeypatch.setattr( mtec_mqtt, "mqtt_start", lambda hass: None )
+  monkeypatch.setattr( mtec_mqtt, "mqtt_stop", lambda client: None )
+  asyncio.run( asyncio.wait_for( mtec_mqtt.main_async( inverters ), timeout=10 ) )
+  return reads, published
+
+def test_inverters_polled_concurrently( simulator, monkeypatch ):
+  inverters = [ simulator_settings( simulator[1], NAME=name ) for name in ("garage", "barn") ]
+  reads, published = poll( inverters, 6, monkeypatch )
+  assert reads["garage"] >= 3 and reads["barn"] >= 3
+
+def test_failing_inverter_isolated( simulator, monkeypatch ):
+  failures = metrics.get_summary().get('mtec_inverter_failures_total{inverter="broken"}', 0)
+  inverters = [ simulator_settings( simulator[1], NAME=name ) for name in ("broken", "garage") ]
+  reads, published = poll( inverters, 5, monkeypatch )
+  assert reads["broken"] == 2
+  assert reads["garage"] >= 5
+  assert metrics.get_summary()['mtec_inverter_failures_total{inverter="broken"}'] == failures + 1
@@ -0,0 +1,47 @@
+"""
+Cluster planning: number of Modbus requests and the max. request size
+"""
+from mtecmqtt.config import register_table
+from mtecmqtt.MTECmodbusAPI import MTECmodbusAPI
+import pytest
+
+def covered( clusters ):
+  return set( item["address"] for cluster in clusters for item in cluster["items"] if item["type"] is not None )
+
+# Pairs of neighbouring registers as (first address, second address, gap)
+def neighbours():
+  items = list(register_table.values())
+  return [ (a["address"], b["address"], b["address"] - a["address"] - a["length"]) for a, b in zip(items, items[1:]) ]
+
+#-------------------------------------------------
+def test_adjacent_registers_single_request( api ):
+  first, second, gap = next( pair for pair in neighbours() if pair[2] == 0 )
+  clusters = api._create_register_clusters( frozenset([first, second]) )
+  assert len(clusters) == 1
+  assert covered(clusters) == { first, second }
+
+def test_small_gap_bridged( api ):
+  first, second, gap = next( pair for pair in neighbours() if 0 < pair[2] < api.cfg["MODBUS_CLUSTER_REQUEST_COST"] )
+  clusters = api._create_register_clusters( frozenset([first, second]) )
+  assert len(clusters) == 1
+  assert clusters[0]["length"] == register_table[first]["length"] + gap + register_table[second]["length"]
+
+def test_large_gap_separate_requests( api ):
+  first, second, gap = next( pair for pair in neighbours() if pair[2] > api.cfg["MODBUS_CLUSTER_REQUEST_COST"] )
+  assert len( api._create_register_clusters( frozenset([first, second]) ) ) == 2
+
+def test_request_count_all_registers( api ):
+  clusters = api._create_register_clusters( frozenset(register_table) )
+  assert covered(clusters) == set(register_table)
+  # at most one request per block of registers separated by a gap which isn't worth bridging
+  blocks = 1 + sum( 1 for first, second, gap in neighbours() if gap >= api.cfg["MODBUS_CLUSTER_REQUEST_COST"] )
+  assert len(clusters) <= blocks
+
+@pytest.mark.parametrize("max_registers", [125, 40, 10])
+def test_request_size_capped( max_registers ):
+  api = MTECmodbusAPI( { "MODBUS_MAX_REGISTERS": max_registers } )
+  clusters = api._create_register_clusters( frozenset(register_table) )
+  assert covered(clusters) == set(register_table)
+  for cluster in clusters:
+    assert cluster["length"] <= max_registers
+    assert cluster["length"] == sum( item["length"] for item in cluster["items"] )
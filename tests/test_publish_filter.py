@@ -0,0 +1,48 @@
+"""
+PublishFilter: suppression of unchanged values, deadbands and heartbeat
+"""
+from mtecmqtt.mqtt import PublishFilter
+
+TOPIC = "MTEC/123/now-base/grid_power"
+
+def publish( publish_filter, payload, value=None, **deadband ):
+  if publish_filter.is_due( TOPIC, payload, value, **deadband ):
+    publish_filter.update( TOPIC, payload, value )
+    return True
+  return False
+
+#-------------------------------------------------
+def test_unchanged_value_suppressed():
+  publish_filter = PublishFilter( max_silence=600 )
+  assert publish( publish_filter, "100", 100 )
+  assert not publish( publish_filter, "100", 100 )
+  assert publish( publish_filter, "101", 101 )
+  assert publish_filter.suppressed == 1
+
+def test_absolute_deadband():
+  publish_filter = PublishFilter( max_silence=600 )
+  assert publish( publish_filter, "100", 100, deadband=10 )
+  assert not publish( publish_filter, "109", 109, deadband=10 )
+  assert publish( publish_filter, "110", 110, deadband=10 )
+  assert not publish( publish_filter, "101", 101, deadband=10 ) # relative to the last published value
+
+def test_percent_deadband():
+  publish_filter = PublishFilter( max_silence=600 )
+  assert publish( publish_filter, "1000", 1000, deadband_percent=5 )
+  assert not publish( publish_filter, "1049", 1049, deadband_percent=5 )
+  assert publish( publish_filter, "950", 950, deadband_percent=5 )
+
+def test_deadband_ignores_non_numeric_values():
+  publish_filter = PublishFilter( max_silence=600 )
+  assert publish( publish_filter, "on", "on", deadband=10 )
+  assert publish( publish_filter, "off", "off", deadband=10 )
+
+def test_heartbeat():
+  publish_filter = PublishFilter( max_silence=0 )
+  assert publish( publish_filter, "100", 100 )
+  assert publish( publish_filter, "100", 100 )
+
+def test_not_updated_value_stays_due():
+  publish_filter = PublishFilter( max_silence=600 )
+  assert publish_filter.is_due( TOPIC, "100", 100 ) # e.g. buffered instead of published: no update()
+  assert publish_filter.is_due( TOPIC, "100", 100 )
@@ -0,0 +1,63 @@
+"""
+Connection manager: background reconnect with exponential backoff, port memory and health checks
+"""
+from mtecmqtt.config import get_cache_file
+from mtecmqtt.MTECmodbusAPI import MTECmodbusAPI
+from conftest import simulator_settings
+import json
+import socket
+import time
+
+def free_port():
+  with socket.socket() as sock:
+    sock.bind( ("127.0.0.1", 0) )
+    return sock.getsockname()[1]
+
+# Wait until the (background) reconnect succeeded
+def wait_connected( api, timeout=5 ):
+  deadline = time.monotonic() + timeout
+  while not api.is_connected() and time.monotonic() < deadline:
+    time.sleep(0.02)
+  return api.is_connected()
+
+#-------------------------------------------------
+def test_backoff_growth( monkeypatch ):
+  api = MTECmodbusAPI( { "MODBUS_RECONNECT_DELAY": 1, "MODBUS_RECONNECT_MAX_DELAY": 5 } )
+  attempts = []
+  monkeypatch.setattr( api, "_open", lambda: attempts.append(True) or len(attempts) > 5 )
+  monkeypatch.setattr( api, "_close", lambda: None )
+  delays = []
+  monkeypatch.setattr( api._stop, "wait", lambda delay: delays.append(delay) )
+  api._reconnect_loop()
+  assert delays == [ 1, 2, 4, 5, 5 ]
+  assert not api._reconnecting
+
+def test_working_port_remembered( simulator ):
+  dead_port = free_port()
+  api = MTECmodbusAPI( simulator_settings( simulator[1], MODBUS_PORT=dead_port ) )
+  assert api._get_ports() == [ dead_port, simulator[1] ]
+  assert api.connect()
+  api.disconnect()
+  with open( get_cache_file("ports.json") ) as f:
+    assert json.load(f)["127.0.0.1"] == simulator[1]
+  # after a restart, the port which worked last is tried first
+  assert MTECmodbusAPI( simulator_settings( simulator[1], MODBUS_PORT=dead_port ) )._get_ports() == [ simulator[1], dead_port ]
+
+def test_reconnect_in_background( simulator ):
+  api = MTECmodbusAPI( simulator_settings( simulator[1] ) )
+  start = time.monotonic()
+  assert api.read_modbus_data( registers=["10000"] ) == {} # fails fast while reconnecting
+  assert time.monotonic() - start < 0.5
+  assert wait_connected( api )
+  assert api.read_modbus_data( registers=["10000"] )["10000"]["value"] == "SIMULATOR0001"
+  api.disconnect()
+
+def test_closed_connection_detected_by_probe( simulator ):
+  api = MTECmodbusAPI( simulator_settings( simulator[1], MODBUS_PROBE_INTERVAL=1 ) )
+  assert api.connect()
+  assert api.check_connection() # probe not due yet
+  api.modbus_client.close()
+  api._last_success -= 1
+  assert not api.check_connection()
+  assert wait_connected( api )
+  api.disconnect()
@@ -0,0 +1,44 @@
+"""
+GroupScheduler: deadlines, priorities and spreading of heavy groups
+"""
+from mtecmqtt.scheduler import GroupScheduler
+import time
+
+#-------------------------------------------------
+def test_due_groups_by_priority():
+  scheduler = GroupScheduler( tick=10 )
+  scheduler.add_group( "config", interval=60, priority=2 )
+  scheduler.add_group( "now-base", interval=10, priority=1 )
+  scheduler.add_group( "day", interval=60, offset=30 )
+  assert scheduler.get_due_groups() == [ "now-base", "config" ]
+  assert scheduler.get_due_groups() == []
+  assert 9 < scheduler.get_sleep_time() <= 10
+
+def test_deadlines_on_fixed_grid():
+  scheduler = GroupScheduler( tick=10 )
+  scheduler.add_group( "now-base", interval=10 )
+  scheduler.get_due_groups()
+  assert scheduler.groups["now-base"]["deadline"] == scheduler.start + 10
+
+def test_missed_deadlines_skipped():
+  scheduler = GroupScheduler( tick=1 )
+  scheduler.add_group( "now-base", interval=1 )
+  scheduler.groups["now-base"]["deadline"] -= 3.5 # e.g. a slow read
+  assert scheduler.get_due_groups() == [ "now-base" ]
+  assert scheduler.get_missed_deadlines() == 3
+  assert scheduler.groups["now-base"]["deadline"] > time.monotonic()
+
+def test_heavy_groups_spread():
+  scheduler = GroupScheduler( tick=10 )
+  scheduler.add_group( "day", interval=60, heavy=True )
+  scheduler.add_group( "total", interval=60, heavy=True )
+  assert scheduler.get_due_groups() == [ "day" ]
+  assert scheduler.groups["total"]["not_before"] > time.monotonic()
+
+def test_retry_keeps_deadline():
+  scheduler = GroupScheduler( tick=10 )
+  scheduler.add_group( "config", interval=60 )
+  scheduler.get_due_groups()
+  scheduler.retry( "config" )
+  assert scheduler.groups["config"]["deadline"] == scheduler.start
+  scheduler.retry( "unknown" ) # ignored
@@ -0,0 +1,42 @@
+"""
+Dependency-aware reads: pseudo-register sources are read with their group, and a register is read once per cycle at most
+"""
+from mtecmqtt import mtec_mqtt
+from mtecmqtt.config import cfg, register_map, pseudo_registers
+from mtecmqtt.MTECmodbusAPI import MTECmodbusAPI
+import pytest
+
+@pytest.fixture
+def reads( monkeypatch ):
+  reads = [] # registers per Modbus read
+  def read_modbus_data( registers=None ):
+    reads.append( list(registers) )
+    return { register: { "value": 100 } for register in registers }
+  api = MTECmodbusAPI()
+  monkeypatch.setattr( api, "read_modbus_data", read_modbus_data )
+  return api, reads
+
+#-------------------------------------------------
+def test_pseudo_register_sources_read_with_group( reads ):
+  api, reads = reads
+  pvdata = mtec_mqtt.read_MTEC_groups( api, ["now-base"] )["now-base"]
+  assert set( pseudo_registers["consumption"]["sources"] ) <= set( reads[0] )
+  assert pvdata[ register_map["consumption"]["mqtt"] ] is not None
+
+def test_shared_register_read_once( reads, monkeypatch ):
+  api, reads = reads
+  get_group_registers = mtec_mqtt.get_group_registers
+  shared = get_group_registers( "now-base" )[0]
+  monkeypatch.setattr( mtec_mqtt, "get_group_registers", lambda group: get_group_registers(group) + ((shared,) if group == "day" else ()) )
+  pvdata = mtec_mqtt.read_MTEC_groups( api, ["now-base", "day"] )
+  assert len(reads) == 2
+  assert shared in reads[0] and shared not in reads[1]
+  assert pvdata["day"] and pvdata["now-base"]
+
+def test_groups_combined( reads, monkeypatch ):
+  api, reads = reads
+  monkeypatch.setitem( cfg, "MODBUS_CLUSTER_ACROSS_GROUPS", True )
+  pvdata = mtec_mqtt.read_MTEC_groups( api, ["now-base", "day", "total"] )
+  assert len(reads) == 1
+  assert len(reads[0]) == len(set(reads[0]))
+  assert all( pvdata[group] for group in ("now-base", "day", "total") )
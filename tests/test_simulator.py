@@ -0,0 +1,48 @@
+"""
+Modbus simulator: values, writes, latency and error injection over Modbus TCP
+"""
+from mtecmqtt.config import register_map
+from mtecmqtt.MTECmodbusAPI import MTECmodbusAPI
+from conftest import simulator_settings
+import time
+import pytest
+
+@pytest.fixture
+def sim_api( simulator ):
+  context, port = simulator
+  api = MTECmodbusAPI( simulator_settings( port ) )
+  assert api.connect()
+  yield api
+  api.disconnect()
+  context.latency, context.error_rate = 0, 0
+
+def register_of( mqtt ):
+  return next( register for register, item in register_map.items() if item["mqtt"] == mqtt )
+
+#-------------------------------------------------
+def test_fixed_and_varying_values( sim_api ):
+  serial_no, frequency = register_of("serial_no"), register_of("grid_fequency")
+  data = sim_api.read_modbus_data( registers=[serial_no, frequency] )
+  assert data[serial_no]["value"] == "SIMULATOR0001"
+  assert 49.9 <= data[frequency]["value"] <= 50.1
+
+def test_all_registers_decodable( sim_api ):
+  registers = [ register for register, item in register_map.items() if item["address"] is not None ]
+  data = sim_api.read_modbus_data( registers=registers )
+  assert set(data) == set(registers)
+
+def test_written_value_read_back( sim_api, simulator ):
+  register = next( register for register, item in register_map.items() if item["writable"] and item["type"] == "U16" )
+  assert sim_api.write_register( register, 42, verify=True )
+  assert sim_api.read_modbus_data( registers=[register] )[register]["value"] == 42
+  simulator[0].written.clear()
+
+def test_latency( sim_api, simulator ):
+  simulator[0].latency = 0.1
+  start = time.monotonic()
+  sim_api.read_modbus_data( registers=[register_of("serial_no")] )
+  assert time.monotonic() - start >= 0.1
+
+def test_error_injection( sim_api, simulator ):
+  simulator[0].error_rate = 1
+  assert sim_api.read_modbus_data( registers=[register_of("serial_no")] ) == {}
@@ -0,0 +1,64 @@
+"""
+Supervisor mode: sharding, restart of workers and aggregation of their metrics
+"""
+from mtecmqtt import mtec_mqtt, metrics
+from mtecmqtt.config import cfg
+from queue import Empty, Queue
+import types
+import pytest
+
+@pytest.fixture
+def clean_metrics():
+  metrics.reset()
+  yield
+  metrics.reset()
+
+#-------------------------------------------------
+def test_worker_metrics_aggregated( clean_metrics ):
+  queue = Queue()
+  metrics.inc( "mtec_modbus_errors_total", cluster="10000", inverter="garage" ) # supervisor
+  for worker_id in range(2):
+    counters = { metrics._key("mtec_modbus_errors_total", { "cluster": "10000", "inverter": "garage" }): 2 }
+    gauges = { metrics._key("mtec_modbus_connected", { "inverter": "worker{}".format(worker_id) }): 1 }
+    queue.put( (worker_id, (counters, gauges, {})) )
+  while not queue.empty():
+    metrics.set_source( *queue.get() )
+  summary = metrics.get_summary()
+  assert summary['mtec_modbus_errors_total{cluster="10000",inverter="garage"}'] == 5
+  assert summary['mtec_modbus_connected{inverter="worker1"}'] == 1
+  assert metrics.get_summary( inverter="worker0" ) == { 'mtec_modbus_connected{inverter="worker0"}': 1 }
+
+def test_workers_sharded_and_restarted( clean_metrics, monkeypatch ):
+  started = [] # (worker id, shard)
+  class Process: # worker which exits at once
+    def __init__( self, target, args, name, daemon ):
+      self.args = args
+      self.exitcode = 1
+    def start( self ):
+      started.append( self.args[:2] )
+      if len(started) >= 6:
+        mtec_mqtt.run_status = False
+    def is_alive( self ):
+      return False
+    def join( self, timeout ):
+      pass
+  class MetricsQueue:
+    def get( self, timeout ):
+      raise Empty
+
+  contexts = []
+  def get_context( method ):
+    contexts.append( method )
+    return types.SimpleNamespace( Process=Process, Queue=MetricsQueue )
+
+  inverters = [ { "NAME": "inverter{}".format(idx) } for idx in range(5) ]
+  monkeypatch.setitem( cfg, "INVERTERS", inverters )
+  monkeypatch.setitem( cfg, "WORKER_RESTART_DELAY", 0 )
+  monkeypatch.setattr( mtec_mqtt, "run_status", True, raising=False )
+  monkeypatch.setattr( mtec_mqtt.multiprocessing, "get_context", get_context )
+  mtec_mqtt.run_supervisor( 2 )
+
+  assert contexts == [ "spawn" ]
+  assert started[:2] == [ (0, inverters[0::2]), (1, inverters[1::2]) ]
+  assert started[2:] == started[:2] * 2 # crashed workers get restarted with the same shard
+  assert metrics.get_summary()['mtec_worker_restarts_total{worker="0"}'] == 2